@@ -99,5 +99,15 @@ def runtime_parameters(dataset, training_model, training_config, config_file ='c
     parameter_dict['validate_every'] = int(config.get('Commons', 'validate_every'))
     parameter_dict['test_every'] = int(config.get('Commons', 'test_every'))
     parameter_dict['prune_corechain_candidates'] = bool(config.get('runtime', 'prune_corechain_candidates'))
+    parameter_dict['path_cache_size'] = int(config.get('runtime', 'path_cache_size'))
+    parameter_dict['relation_encoding_table'] = bool(int(config.get('runtime', 'relation_encoding_table')))
+    parameter_dict['batch_window_ms'] = float(config.get('runtime', 'batch_window_ms'))
+    parameter_dict['max_batch_size'] = int(config.get('runtime', 'max_batch_size'))
+    parameter_dict['neighbourhood_index'] = config.get('runtime', 'neighbourhood_index')
+    parameter_dict['subgraph_cache'] = config.get('runtime', 'subgraph_cache')
+    parameter_dict['subgraph_cache_bytes'] = int(config.get('runtime', 'subgraph_cache_bytes'))
+    parameter_dict['stream_candidates'] = bool(int(config.get('runtime', 'stream_candidates')))
+    parameter_dict['candidate_budget_ms'] = float(config.get('runtime', 'candidate_budget_ms'))
+    parameter_dict['candidate_top_k'] = int(config.get('runtime', 'candidate_top_k'))
 
     return parameter_dict
\ No newline at end of file
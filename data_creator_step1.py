@@ -3,6 +3,8 @@
 '''
 
 import datasetPreparation.create_dataset as cd
+from datasetPreparation import subgraph_cache as sc
+from utils import query_cache as qc
 import traceback
 import pathlib
 import json
@@ -18,6 +20,9 @@ _save_location_unsuccess = 'data/data/raw/%(dataset)s/unsuccess'
 
 file_name = '.json'
 
+# SPARQL results, shared by all the shards of parallel_data_creation.sh
+_cache_location = 'data/cache/sparql.sqlite'
+
 
 def convert_qald_to_lcquad(dataset):
     dataset = dataset['questions']
@@ -30,7 +35,7 @@ def convert_qald_to_lcquad(dataset):
 
 
 def run(_dataset,_save_location_success,_save_location_unsuccess,
-        _file_name,_predicate_blacklist,_relation_file,return_data,_qald=False):
+        _file_name,_predicate_blacklist,_relation_file,return_data,_qald=False,_cache_location=None):
     '''
 
     :param dataset: a list of data node.
@@ -38,6 +43,7 @@ def run(_dataset,_save_location_success,_save_location_unsuccess,
     :param _save_location_unsuccess: location where the data where there was some error is stored.
     :param file_name: name f the file in which data is stored.
     :param return_data: returns the success and unsucess data if true else nothing is returned
+    :param _cache_location: sqlite file to cache SPARQL results in (can be shared by many processes). None for no cache.
     :return:
 
     Note :- flag is used for determining whether the correct path was generated in the dataset
@@ -68,7 +74,10 @@ def run(_dataset,_save_location_success,_save_location_unsuccess,
     fullpath_unsuccess = os.path.join(_save_location_unsuccess,_file_name)
 
     counter = 0
-    cd_node = cd.CreateDataNode(_predicate_blacklist=_predicate_blacklist, _relation_file=_relation_file, _qald=_qald)
+    cache = qc.SQLiteCache(_cache_location) if _cache_location else None
+    # Questions about the same entity share its subgraph
+    cd_node = cd.CreateDataNode(_predicate_blacklist=_predicate_blacklist, _relation_file=_relation_file, _qald=_qald,
+                                _cache_backend=cache, _subgraph_cache=sc.SubgraphCache())
     successful_data = []
     unsuccessful_data = []
 
@@ -113,6 +122,8 @@ if __name__ == "__main__":
     start_index = sys.argv[1]
     end_index = sys.argv[2]
     dataset = sys.argv[3]
+    if len(sys.argv) > 4:
+        _cache_location = sys.argv[4] if sys.argv[4] != 'none' else None
 
 
 
@@ -151,13 +162,15 @@ if __name__ == "__main__":
         run(_dataset=_dataset, _save_location_success=_save_location_success
             , _save_location_unsuccess=_save_location_unsuccess,
             _file_name=file_name,
-            _predicate_blacklist=pb, _relation_file={}, return_data=False, _qald=False)
+            _predicate_blacklist=pb, _relation_file={}, return_data=False, _qald=False,
+            _cache_location=_cache_location)
 
     if dataset == 'qald':
         run(_dataset=_dataset, _save_location_success=_save_location_success
             , _save_location_unsuccess=_save_location_unsuccess,
             _file_name=file_name,
-            _predicate_blacklist=pb, _relation_file={}, return_data=False, _qald=True)
+            _predicate_blacklist=pb, _relation_file={}, return_data=False, _qald=True,
+            _cache_location=_cache_location)
 
 
 
@@ -19,6 +19,7 @@ import numpy as np
 from utils import dbpedia_interface as dbi
 from utils import natural_language_utilities as nlutils
 from utils import embeddings_interface as ei
+from utils import relation_index as ri
 
 ei.__check_prepared__()
 
@@ -152,6 +153,7 @@ def run(dataset):
     _save_location_unsuccess = 'data/data/raw/%(dataset)s/unsuccess'
     relation_dict_location = 'data/data/common/relations.pickle'
     relation_dict_dir = 'data/data/common/'
+    relation_index_location = 'data/data/common/relation_index'
     final_data_location = 'data/data/%(dataset)s/id_big_data.json'
     final_data_location_combine = 'data/data/raw/%(dataset)s/combine'
     final_data_dir = 'data/data/%(dataset)s/'
@@ -209,6 +211,9 @@ def run(dataset):
     print("done dumping relation")
     pickle.dump(relation_dict,open(relation_dict_location,'wb+'))
 
+    # Labels, token ids and label vectors of every relation, for the server and CreateSubgraph to look up
+    ri.build(relation_dict.keys(), relation_index_location, dbp)
+
     '''
         Consider dumping here. So that alsong with relationid file and this dump
         one can do their own form of pre-processing
@@ -15,12 +15,13 @@ from datasetPreparation import rdf_candidates as rdfc
 
 
 class CreateDataNode():
-    def __init__(self,_predicate_blacklist,_relation_file,_qald=False):
-        self.dbp = db_interface.DBPedia(caching=False)
+    def __init__(self,_predicate_blacklist,_relation_file,_qald=False,_cache_backend=None,_subgraph_cache=None):
+        self.dbp = db_interface.DBPedia(caching=False, cache_backend=_cache_backend)
         self.relation_file = _relation_file
         self.predicate_blacklist = _predicate_blacklist
         self.qald = _qald
-        self.create_subgraph = es.CreateSubgraph(self.dbp, self.predicate_blacklist, self.relation_file, qald=_qald)
+        self.create_subgraph = es.CreateSubgraph(self.dbp, self.predicate_blacklist, self.relation_file, qald=_qald,
+                                                 subgraph_cache=_subgraph_cache)
 
     def parse_sparql(self,sparql_query):
         '''
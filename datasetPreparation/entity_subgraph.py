@@ -6,10 +6,20 @@
 import numpy as np
 from utils import embeddings_interface
 from utils import natural_language_utilities as nlutils
-import traceback
+from utils import relation_index as ri
+from datasetPreparation import neighbourhood_index as ni
+from datasetPreparation import subgraph_cache as sc
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from collections import OrderedDict
+import threading
+import warnings
+import math
+import time
 
 class CreateSubgraph:
-    def __init__(self,_dbpedia_interface,_predicate_blacklist,relation_file, qald=False):
+    def __init__(self,_dbpedia_interface,_predicate_blacklist,relation_file, qald=False, hop2_workers=16, hop2_timeout=10.0,
+                 hop2_batch_size=50, neighbourhood_index=None, label_vector_cache_size=100000,
+                 relation_index=None, subgraph_cache=None, hop2_latency=0.5):
 
         self.K_1HOP_GLOVE = 200
         self.K_1HOP_MODEL = 5
@@ -19,8 +29,37 @@ class CreateSubgraph:
         self.TRAINING = True # for older system
         self.qald = qald #Dataset specific stuff. As the predicate blacklist would be differently handled when compared to LC-QuAD.
 
+        # 2-hop expansion: max queries in flight (shared by all subgraph calls), seconds to wait for each,
+        #   and number of predicates expanded per query.
+        self.HOP2_WORKERS = hop2_workers
+        self.HOP2_TIMEOUT = hop2_timeout
+        self.HOP2_BATCH_SIZE = hop2_batch_size
+
+        # Adaptive K (subgraph with a _deadline): K_1HOP_GLOVE and K_2HOP_GLOVE are shrunk (down to these) when the
+        #   candidates wouldn't be fetched and scored in time. Seconds per 2-hop query and per path scored downstream
+        #   are moving averages of what's observed; hop2_latency is the guess till the first query returns.
+        self.K_1HOP_MIN = 20
+        self.K_2HOP_MIN = 200
+        self.LATENCY_SMOOTHING = 0.2
+        self.hop2_latency = hop2_latency
+        self.score_latency = None
+        self._latency_lock = threading.Lock()
+        # Limits applied by the last subgraph/subgraph_stream call, per thread (see last_limits)
+        self._limits = threading.local()
+
         # Useful objects
         self.dbp = _dbpedia_interface
+        self.hop2_pool = ThreadPoolExecutor(max_workers=self.HOP2_WORKERS)
+        # Unit label vectors of predicates, for similar_predicates
+        self.LABEL_VECTOR_CACHE_SIZE = label_vector_cache_size
+        self._label_vectors = OrderedDict()
+        self._label_vectors_lock = threading.Lock()
+        # Precomputed neighbourhoods (datasetPreparation/neighbourhood_index.py). DBpedia is asked only on a miss.
+        self.neighbourhood_index = neighbourhood_index
+        # Precomputed labels and label vectors of known relations (utils/relation_index.py)
+        self.relation_index = relation_index
+        # Question independent part of entities' subgraphs, kept across questions (subgraph_cache.py)
+        self.subgraph_cache = subgraph_cache
 
         #Static resources
         '''
@@ -30,42 +69,39 @@ class CreateSubgraph:
         self.relation = relation_file
 
         self.predicate_blacklist = _predicate_blacklist
+        self.blacklist_version = sc.blacklist_version(_predicate_blacklist)
 
-    def similar_predicates(self,_v_qt, _predicates, _return_indices=False, _k=5):
+    def similar_predicates(self,_v_qt, _predicates, _return_indices=False, _k=5, _uris=None):
         """
             Function used to tokenize the question and compare the tokens with the predicates.
             Then their top k are selected.
+
+            All predicates are scored with one matrix-vector product, against unit label vectors cached
+                per label (see label_vector). Top k is picked by a partial sort. Ties rank the later predicate
+                first (as a reversed stable argsort would).
+
+            _uris: uris of the _predicates (which are labels). Vectors of the ones in self.relation_index are read from it.
         """
 
         # If there are no predicates
         if len(_predicates) == 0:
             return np.asarray([]) if _return_indices else []
 
-
-            # Declare a similarity array
+        # Declare a similarity array
         similarity_arr = np.zeros(len(_predicates))
 
-        # Fill similarity array
-        for i in range(len(_predicates)):
-            try:
-                p = _predicates[i].decode("utf-8")
-            except:
-                p = _predicates[i]
-            v_p = np.mean(embeddings_interface.vectorize(nlutils.tokenize(p), _embedding=self.EMBEDDING).astype(np.float), axis=0)
-
-            # If either of them is a zero vector, the cosine is 0.\
-            if np.sum(v_p) == 0.0 or np.sum(_v_qt) == 0.0 or p.strip() == "":
-                similarity_arr[i] = np.float64(0.0)
-                continue
-            try:
+        # If the question is a zero vector, every cosine is 0.
+        if np.sum(_v_qt) != 0.0:
+            u_qt = _v_qt / np.linalg.norm(_v_qt)
+            vectors = [self.label_vector(p) for p in _predicates] if _uris is None \
+                else [self.relation_vector(u, p) for u, p in zip(_uris, _predicates)]
+            scored = [i for i, v in enumerate(vectors) if v is not None]
+            if scored:
                 # Cos Product
-                similarity_arr[i] = np.dot(v_p, _v_qt) / (np.linalg.norm(v_p) * np.linalg.norm(_v_qt))
-            except:
-                traceback.print_exc()
+                similarity_arr[scored] = np.dot(np.stack([vectors[i] for i in scored]), u_qt)
 
-        # Find the best scoring values for every path
         # Sort ( best match score for each predicate) in descending order, and choose top k
-        argmaxes = np.argsort(similarity_arr, axis=0)[::-1][:_k]
+        argmaxes = self.top_k(similarity_arr, _k)
 
         if _return_indices:
             return argmaxes
@@ -73,6 +109,59 @@ class CreateSubgraph:
         # Use this to choose from _predicates and return
         return [_predicates[i] for i in argmaxes]
 
+    def label_vector(self, _predicate):
+        """
+            Unit vector of the mean embedding of a predicate's label (str/bytes), or None if it is a zero vector/blank.
+            Kept in an LRU of LABEL_VECTOR_CACHE_SIZE labels.
+        """
+        with self._label_vectors_lock:
+            try:
+                self._label_vectors.move_to_end(_predicate)
+                return self._label_vectors[_predicate]
+            except KeyError:
+                pass
+
+        try:
+            p = _predicate.decode("utf-8")
+        except:
+            p = _predicate
+        vector = ri.label_vector(p, self.EMBEDDING)
+
+        with self._label_vectors_lock:
+            self._label_vectors[_predicate] = vector
+            if len(self._label_vectors) > self.LABEL_VECTOR_CACHE_SIZE:
+                self._label_vectors.popitem(last=False)
+        return vector
+
+    def relation_vector(self, _uri, _label):
+        """
+            label_vector of a relation, from self.relation_index if it has it (computed with the same embedding).
+        """
+        if self.relation_index is not None and self.relation_index.embedding == self.EMBEDDING \
+                and _uri in self.relation_index:
+            return self.relation_index.vector(_uri)
+        return self.label_vector(_label)
+
+    def label(self, _uri):
+        """ Surface form of a relation; from self.relation_index if it has it. """
+        if self.relation_index is not None and _uri in self.relation_index:
+            return self.relation_index.label(_uri)
+        return self.dbp.get_label(_uri)
+
+    @staticmethod
+    def top_k(_similarity, _k):
+        """
+            Indices of the _k highest scores, best first. Ties: the higher index first. NaNs rank above everything.
+        """
+        key = np.where(np.isnan(_similarity), np.inf, _similarity)
+        indices = np.arange(len(key))
+        if 0 < _k < len(key):
+            threshold = key[np.argpartition(-key, _k - 1)[_k - 1]]
+            above = indices[key > threshold]
+            tied = indices[key == threshold][::-1]
+            indices = np.concatenate([above, tied[:_k - len(above)]])
+        return indices[np.lexsort((-indices, -key[indices]))][:_k]
+
     @staticmethod
     def filter_predicates(_predicates, predicate_blacklist,_use_blacklist=True, _only_dbo=False, _qald=False):
         """
@@ -249,6 +338,201 @@ class CreateSubgraph:
         # print("len in the function ", len(right_properties),len(left_properties))
         return list(set([r.decode("utf-8")  for r in right_properties])),list(set([l.decode("utf-8") for l in left_properties]))
 
+    def get_hop2_subgraph_batch(self, _entity, _predicates, dbp, _right=True):
+        '''
+            get_hop2_subgraph for many predicates, in one query (see DBPedia.get_hop2_subgraph_batch)
+
+        :return: list of (outgoing, incoming) predicates, in the order of _predicates
+        '''
+        start = time.time()
+        subgraphs = dbp.get_hop2_subgraph_batch(str(_entity), _predicates, right=_right)
+        self.observe_hop2_latency(time.time() - start)
+        return [(list(set([r.decode("utf-8") for r in subgraphs[pred][0]])),
+                 list(set([l.decode("utf-8") for l in subgraphs[pred][1]]))) for pred in _predicates]
+
+    def get_hop2_subgraphs(self, _entity, _predicates, _right=True, _neighbourhood=None, _deadline=None):
+        '''
+            get_hop2_subgraph for many predicates.
+            Predicates are expanded HOP2_BATCH_SIZE to a query, and the queries are run on self.hop2_pool.
+            A query which takes longer than HOP2_TIMEOUT seconds (or isn't back by _deadline) is given up on;
+                its predicates get None.
+
+        :param _entity: central entity
+        :param _predicates: list of predicates after which one needs the subgraph
+        :param _neighbourhood: the entity's neighbourhood_index.Neighbourhood, if indexed. Only the predicates
+            it doesn't cover are queried.
+        :return: list of (outgoing, incoming) predicates (or None), in the order of _predicates
+        '''
+        if _neighbourhood is not None:
+            known = _neighbourhood.hop2_right if _right else _neighbourhood.hop2_left
+            missing = [p for p in _predicates if p not in known]
+            fetched = dict(zip(missing, self.get_hop2_subgraphs(_entity, missing, _right, _deadline=_deadline))) \
+                if missing else {}
+            return [known[p] if p in known else fetched[p] for p in _predicates]
+
+        chunks = [_predicates[i:i + self.HOP2_BATCH_SIZE] for i in range(0, len(_predicates), self.HOP2_BATCH_SIZE)]
+        futures = [self.hop2_pool.submit(self.get_hop2_subgraph_batch, _entity, chunk, self.dbp, _right)
+                   for chunk in chunks]
+
+        results = []
+        try:
+            for chunk, future in zip(chunks, futures):
+                try:
+                    timeout = self.HOP2_TIMEOUT
+                    if _deadline is not None:
+                        timeout = max(0.0, min(timeout, _deadline - time.time()))
+                    results += future.result(timeout=timeout)
+                except TimeoutError:
+                    future.cancel()
+                    warnings.warn("2-hop expansion of %s via %d predicates timed out" % (_entity, len(chunk)))
+                    results += [None for _ in chunk]
+        except:
+            # Don't leave the rest of the queries queued up
+            for future in futures:
+                future.cancel()
+            raise
+
+        return results
+
+    def filtered_hop2_subgraphs(self, _entity, _predicates, _right, _neighbourhood, _cached, _qald, _deadline=None):
+        '''
+            get_hop2_subgraphs, with the blacklist (filter_predicates) applied.
+            Predicates already expanded in _cached (the entity's subgraph_cache entry) aren't expanded again;
+                the ones expanded now are added to it (unless their query timed out).
+
+        :param _cached: neighbourhood_index.Neighbourhood of the entity, with blacklist filtered predicates
+        :return: list of (outgoing, incoming) predicates, in the order of _predicates
+        '''
+        known = _cached.hop2_right if _right else _cached.hop2_left
+        missing = [p for p in _predicates if p not in known]
+        fetched = {}
+        for pred, hop2 in zip(missing, self.get_hop2_subgraphs(_entity, missing, _right, _neighbourhood=_neighbourhood,
+                                                                   _deadline=_deadline)):
+            if hop2 is None:
+                fetched[pred] = ([], [])
+                continue
+            known[pred] = self.filter_hop2(hop2, _qald)
+        return [known[p] if p in known else fetched[p] for p in _predicates]
+
+    def filter_hop2(self, _hop2, _qald):
+        ''' filter_predicates on both the (outgoing, incoming) predicates of a 2-hop expansion '''
+        temp_r, temp_l = _hop2
+        return (self.filter_predicates(temp_r, predicate_blacklist=self.predicate_blacklist, _use_blacklist=True,
+                                       _only_dbo=_qald, _qald=_qald),
+                self.filter_predicates(temp_l, predicate_blacklist=self.predicate_blacklist, _use_blacklist=True,
+                                       _only_dbo=_qald, _qald=_qald))
+
+    def iter_hop2_subgraphs(self, _entity, _right_predicates, _left_predicates, _neighbourhood, _cached, _qald,
+                            _deadline=None):
+        '''
+            filtered_hop2_subgraphs of both sides, as they come: the ones in _cached and the neighbourhood index first,
+                then the ones queried (HOP2_BATCH_SIZE to a query), as each query returns.
+            The queries are submitted right away, before the first result is asked for.
+            Stops at _deadline (time.time()), or when the queries take too long. Closing the generator cancels the
+                queries not sent yet.
+
+        :return: generator of (sign, [(predicate, (outgoing, incoming)), ...]), sign '+' for right predicates
+        '''
+        ready, jobs = [], {}
+        for sign, predicates in (('+', _right_predicates), ('-', _left_predicates)):
+            known = _cached.hop2_right if sign == '+' else _cached.hop2_left
+            indexed = {} if _neighbourhood is None else \
+                _neighbourhood.hop2_right if sign == '+' else _neighbourhood.hop2_left
+            for p in predicates:
+                if p not in known and p in indexed:
+                    known[p] = self.filter_hop2(indexed[p], _qald)
+            if any(p in known for p in predicates):
+                ready.append((sign, [(p, known[p]) for p in predicates if p in known]))
+
+            missing = [p for p in predicates if p not in known]
+            for i in range(0, len(missing), self.HOP2_BATCH_SIZE):
+                future = self.hop2_pool.submit(self.get_hop2_subgraph_batch, _entity,
+                                               missing[i:i + self.HOP2_BATCH_SIZE], self.dbp, sign == '+')
+                jobs[future] = (sign, missing[i:i + self.HOP2_BATCH_SIZE])
+
+        results = self._hop2_results(_entity, ready, jobs, _cached, _qald, _deadline)
+        # Step into the try block, so that closing the generator cancels the queries even before it's iterated over
+        next(results)
+        return results
+
+    def _hop2_results(self, _entity, _ready, _jobs, _cached, _qald, _deadline):
+        try:
+            yield None
+            for batch in _ready:
+                yield batch
+
+            # Every query gets about HOP2_TIMEOUT seconds once a worker picks it up
+            timeout = self.HOP2_TIMEOUT * math.ceil(len(_jobs) / float(self.HOP2_WORKERS))
+            if _deadline is not None:
+                timeout = max(0.0, min(timeout, _deadline - time.time()))
+            try:
+                for future in as_completed(_jobs, timeout=timeout):
+                    sign, chunk = _jobs[future]
+                    known = _cached.hop2_right if sign == '+' else _cached.hop2_left
+                    for p, hop2 in zip(chunk, future.result()):
+                        known[p] = self.filter_hop2(hop2, _qald)
+                    yield sign, [(p, known[p]) for p in chunk]
+            except TimeoutError:
+                warnings.warn("2-hop expansion of %s stopped with %d queries pending"
+                              % (_entity, len([f for f in _jobs if not f.done()])))
+        finally:
+            # Don't leave the rest of the queries queued up
+            for future in _jobs:
+                future.cancel()
+
+    def subgraph_stream(self, _entities, _question, _use_blacklist=True, _qald=False, _deadline=None):
+        '''
+            subgraph, as batches of paths, so that they can be scored while the rest are still being fetched:
+                first the 1-hop paths, then the 2-hop paths of each 2-hop expansion (see iter_hop2_subgraphs).
+            The 2-hop paths of every batch are cut down to the K_2HOP_GLOVE most similar to the question.
+            Two entity subgraphs come as the two batches (1-hop, 2-hop) subgraph returns.
+
+        :param _deadline: time.time() after which no more 2-hop expansions are waited for. The Ks are fit to it,
+            as in subgraph (see last_limits).
+        :return: generator of lists of paths (eg. ['+', p] or ['-', p1, '+', p2])
+        '''
+        if len(_entities) != 1:
+            subgraph = self.subgraph(_entities, _question, {}, _use_blacklist=_use_blacklist, _qald=_qald,
+                                     _deadline=_deadline)
+            for batch in (subgraph or []):
+                if batch:
+                    yield batch
+            return
+
+        limits = self._limits.last = {'k_1hop': self.K_1HOP_GLOVE, 'k_2hop': self.K_2HOP_GLOVE}
+        v_qt = self.question_vector(_question)
+        hop1 = self.hop1_subgraph(_entities[0], v_qt, _use_blacklist, _qald, _deadline=_deadline)
+        if hop1 is None:
+            return
+        neighbourhood, cache_key, cached, right_properties, left_properties = hop1
+
+        # 2-hop queries go out before the 1-hop paths are handed over (and scored)
+        expansions = self.iter_hop2_subgraphs(_entities[0], right_properties, left_properties, neighbourhood, cached,
+                                              _qald, _deadline)
+        try:
+            paths_hop1_uri = [['+', _p] for _p in right_properties] + [['-', _p] for _p in left_properties]
+            candidates = len(paths_hop1_uri)
+            if paths_hop1_uri:
+                yield paths_hop1_uri
+
+            for sign, expanded in expansions:
+                paths = []
+                for pred, (temp_r, temp_l) in expanded:
+                    paths += [[sign, pred, '+', r2] for r2 in temp_r] + [[sign, pred, '-', r2] for r2 in temp_l]
+                uris = [path[3] for path in paths]
+                k = self.hop2_limit(candidates, 1, _deadline)
+                limits['k_2hop'] = min(limits['k_2hop'], k)
+                indices = self.similar_predicates(_v_qt=v_qt, _predicates=[self.label(uri) for uri in uris],
+                                                  _return_indices=True, _k=k, _uris=uris)
+                candidates += len(indices)
+                if len(indices):
+                    yield [paths[i] for i in indices]
+        finally:
+            expansions.close()
+            if self.subgraph_cache is not None:
+                # Hand the 2-hop predicates expanded to the other questions
+                self.subgraph_cache.merge(cache_key, cached)
+
     @classmethod
     def two_topic_entity(cls, te1, te2, dbp):
         '''
@@ -286,13 +570,158 @@ class CreateSubgraph:
 
         return data
 
+    def observe_hop2_latency(self, _seconds):
+        with self._latency_lock:
+            self.hop2_latency += self.LATENCY_SMOOTHING * (_seconds - self.hop2_latency)
+
+    def observe_scoring(self, _paths, _seconds):
+        ''' To be told by whoever scores the paths (server.py) how long _paths paths took, so K_2HOP can be fit to it '''
+        if not _paths:
+            return
+        per_path = _seconds / float(_paths)
+        with self._latency_lock:
+            if self.score_latency is None:
+                self.score_latency = per_path
+            else:
+                self.score_latency += self.LATENCY_SMOOTHING * (per_path - self.score_latency)
+
+    @property
+    def last_limits(self):
+        '''
+            The limits the last subgraph (or subgraph_stream) call of this thread went with:
+                {'k_1hop': .., 'k_2hop': .., 'adapted': True if either is below K_1HOP_GLOVE/K_2HOP_GLOVE}
+        '''
+        limits = getattr(self._limits, 'last', None)
+        if limits is None:
+            return None
+        return dict(limits, adapted=limits['k_1hop'] < self.K_1HOP_GLOVE or limits['k_2hop'] < self.K_2HOP_GLOVE)
+
+    def hop1_limit(self, _right, _left, _neighbourhood, _cached, _deadline):
+        '''
+            K_1HOP_GLOVE, or less if the 2-hop queries of that many 1-hop predicates (of each side) wouldn't be back
+                by _deadline: HOP2_BATCH_SIZE predicates to a query, HOP2_WORKERS at a time, hop2_latency seconds each.
+            Predicates expanded already (in _cached or the neighbourhood index) take no query. Not less than K_1HOP_MIN.
+        '''
+        if _deadline is None:
+            return self.K_1HOP_GLOVE
+        remaining = _deadline - time.time()
+
+        # (number of predicates, share of them which need a query) of each side
+        sides = []
+        for predicates, known, indexed in ((_right, _cached.hop2_right, _neighbourhood.hop2_right if _neighbourhood else {}),
+                                           (_left, _cached.hop2_left, _neighbourhood.hop2_left if _neighbourhood else {})):
+            missing = len([p for p in predicates if p not in known and p not in indexed])
+            sides.append((len(predicates), missing / float(len(predicates)) if predicates else 0.0))
+
+        def _seconds(k):
+            queries = sum(math.ceil(min(n, k) * share / self.HOP2_BATCH_SIZE) for n, share in sides)
+            return math.ceil(queries / float(self.HOP2_WORKERS)) * self.hop2_latency
+
+        # The largest k which fits
+        low, high = min(self.K_1HOP_MIN, self.K_1HOP_GLOVE), self.K_1HOP_GLOVE
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _seconds(middle) <= remaining:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def hop2_limit(self, _candidates, _lists, _deadline):
+        '''
+            K_2HOP_GLOVE (for each of _lists lists of 2-hop paths), or less if downstream wouldn't be done scoring them,
+                on top of the _candidates paths there are already, by _deadline (score_latency seconds a path).
+            Not less than K_2HOP_MIN, which is what's left once the deadline has passed.
+        '''
+        if _deadline is None:
+            return self.K_2HOP_GLOVE
+        remaining = _deadline - time.time()
+        if remaining <= 0:
+            return min(self.K_2HOP_MIN, self.K_2HOP_GLOVE)
+        if not self.score_latency or not _lists:
+            return self.K_2HOP_GLOVE
+        allowed = (remaining / self.score_latency - _candidates) / _lists
+        return int(max(min(self.K_2HOP_MIN, self.K_2HOP_GLOVE), min(self.K_2HOP_GLOVE, allowed)))
+
+    def hop1_subgraph(self, _entity, _v_qt, _use_blacklist=True, _qald=False, _deadline=None):
+        '''
+            The filtered 1-hop predicates of the entity which are most similar to the question (K_1HOP_GLOVE of each
+                side, or hop1_limit's K with a _deadline).
+
+        :return: None if the entity has no predicates, else
+            (neighbourhood_index record or None, subgraph_cache key, the entity's cached Neighbourhood, right, left predicates)
+        '''
+        # Get 1-hop subgraph around the entity
+        neighbourhood = self.neighbourhood_index.get(_entity) if self.neighbourhood_index is not None else None
+
+        # The filtered 1-hop (and the 2-hop expanded so far) may be there from an earlier question
+        cache_key = (_entity, self.blacklist_version if _use_blacklist else None, _qald)
+        cached = self.subgraph_cache.get(cache_key) if self.subgraph_cache is not None else None
+        if cached is None:
+            if neighbourhood is not None:
+                right_properties, left_properties = list(neighbourhood.right), list(neighbourhood.left)
+            else:
+                right_properties, left_properties = self.dbp.get_properties(_uri=_entity, label=False)
+                right_properties, left_properties = list(set([r.decode("utf-8") for r in right_properties])),list(set([l.decode("utf-8")for l in left_properties]))
+
+            right_properties = list(set(self.filter_predicates(right_properties, predicate_blacklist=self.predicate_blacklist,_use_blacklist=_use_blacklist, _only_dbo=_qald,
+                                                      _qald=_qald)))
+            left_properties = list(set(self.filter_predicates(left_properties, predicate_blacklist=self.predicate_blacklist,_use_blacklist=_use_blacklist, _only_dbo=_qald, _qald=_qald)))
+            cached = ni.Neighbourhood(right_properties, left_properties, {}, {})
+            if self.subgraph_cache is not None:
+                self.subgraph_cache.put(cache_key, cached)
+
+        # The entry is shared with other questions (threads): 2-hop expansions go to a copy, merged back when done
+        cached = cached._replace(hop2_right=dict(cached.hop2_right), hop2_left=dict(cached.hop2_left))
+        right_properties, left_properties = list(cached.right), list(cached.left)
+
+
+        #Converting all of them to the relation id space as defined by _relations. Also if the relation doesn't exists in
+        #the relation space it is automatically removed.
+
+        # If no paths are returned  by the dbpedia interface.
+        if not right_properties and not left_properties :
+            return None
+
+        k = self.hop1_limit(right_properties, left_properties, neighbourhood, cached, _deadline)
+        if getattr(self._limits, 'last', None) is not None:
+            self._limits.last['k_1hop'] = k
+
+        # We need surface form to find the most similar predicates. We do this to reduce search space and create higher quality negative examples.
+        right_properties_sf = [self.label(x) for x in right_properties]
+        left_properties_sf = [self.label(x) for x in left_properties]
+
+        # WORD-EMBEDDING FILTERING
+        right_properties_filter_indices = self.similar_predicates(_v_qt=_v_qt,_predicates=right_properties_sf,
+                                                                  _return_indices=True,
+                                                                  _k=k, _uris=right_properties)
+        left_properties_filter_indices = self.similar_predicates(_v_qt=_v_qt,_predicates=left_properties_sf,
+                                                                 _return_indices=True,
+                                                                 _k=k, _uris=left_properties)
+
+        # Generate their URI counterparts
+        right_properties_filtered_uri = [right_properties[i] for i in right_properties_filter_indices]
+        left_properties_filtered_uri = [left_properties[i] for i in left_properties_filter_indices]
+
+        return neighbourhood, cache_key, cached, right_properties_filtered_uri, left_properties_filtered_uri
+
+    def question_vector(self, _question):
+        # Tokenize question
+        qt = nlutils.tokenize(_question, _remove_stopwords=False)
+
+        # Vectorize question
+        return np.mean(embeddings_interface.vectorize(qt, _embedding=self.EMBEDDING).astype(np.float), axis=0)
+
     # data.append(cls.get_something(SPARQL3, te2, te1, 3, dbp))
-    def subgraph(self,_entities,_question,_relations,_use_blacklist=True,_qald=False):
+    def subgraph(self,_entities,_question,_relations,_use_blacklist=True,_qald=False,_deadline=None):
         '''
 
 
         :param _entities: A list of entity for which the sub-graph needs to be retrived with first being the topic entity.
         :param _relations: check constructor --> static resource section.
+        :param _deadline: time.time() by which the paths should be fetched and scored. K_1HOP_GLOVE and K_2HOP_GLOVE
+            are shrunk as needed (hop1_limit, hop2_limit) and 2-hop queries not back by then are given up on.
+            The limits applied are in last_limits.
         :return: Subgraph
 
         Even though the _entities in theory can have multiple entity, this function only works for single entity. Two entity subgraph is handled in a different manner.
@@ -305,48 +734,17 @@ class CreateSubgraph:
 
         #Note that for now two length entitypaths_hop2_uri has not been implemented. The two entity sub graph is handled in a different manner.
 
-        # Tokenize question
-        qt = nlutils.tokenize(_question, _remove_stopwords=False)
-
-        # Vectorize question
-        # v_qt = " "
-        v_qt = np.mean(embeddings_interface.vectorize(qt, _embedding=self.EMBEDDING).astype(np.float), axis=0)
+        limits = self._limits.last = {'k_1hop': self.K_1HOP_GLOVE, 'k_2hop': self.K_2HOP_GLOVE}
+        v_qt = self.question_vector(_question)
 
         if len(_entities) == 1:
 
-            # Get 1-hop subgraph around the entity
-            right_properties, left_properties = self.dbp.get_properties(_uri=_entities[0], label=False)
-            right_properties, left_properties = list(set([r.decode("utf-8") for r in right_properties])),list(set([l.decode("utf-8")for l in left_properties]))
-
-            right_properties = list(set(self.filter_predicates(right_properties, predicate_blacklist=self.predicate_blacklist,_use_blacklist=_use_blacklist, _only_dbo=_qald,
-                                                      _qald=_qald)))
-            left_properties = list(set(self.filter_predicates(left_properties, predicate_blacklist=self.predicate_blacklist,_use_blacklist=_use_blacklist, _only_dbo=_qald, _qald=_qald)))
-
-
-
-            #Converting all of them to the relation id space as defined by _relations. Also if the relation doesn't exists in
-            #the relation space it is automatically removed.
-
+            hop1 = self.hop1_subgraph(_entities[0], v_qt, _use_blacklist, _qald, _deadline=_deadline)
             # If no paths are returned  by the dbpedia interface.
-            if not right_properties and not left_properties :
+            if hop1 is None:
                 NO_PATHS = True
                 return None
-
-            # We need surface form to find the most similar predicates. We do this to reduce search space and create higher quality negative examples.
-            right_properties_sf = [self.dbp.get_label(x ) for x in right_properties]
-            left_properties_sf = [self.dbp.get_label(x) for x in left_properties]
-
-            # WORD-EMBEDDING FILTERING
-            right_properties_filter_indices = self.similar_predicates(_v_qt=v_qt,_predicates=right_properties_sf,
-                                                                      _return_indices=True,
-                                                                      _k=self.K_1HOP_GLOVE)
-            left_properties_filter_indices = self.similar_predicates(_v_qt=v_qt,_predicates=left_properties_sf,
-                                                                     _return_indices=True,
-                                                                     _k=self.K_1HOP_GLOVE)
-
-            # Generate their URI counterparts
-            right_properties_filtered_uri = [right_properties[i] for i in right_properties_filter_indices]
-            left_properties_filtered_uri = [left_properties[i] for i in left_properties_filter_indices]
+            neighbourhood, cache_key, cached, right_properties_filtered_uri, left_properties_filtered_uri = hop1
 
             paths_hop1_uri = [['+', _p] for _p in right_properties_filtered_uri]
             paths_hop1_uri += [['-', _p] for _p in left_properties_filtered_uri]
@@ -364,54 +762,66 @@ class CreateSubgraph:
             e_out_to_e_out_out = {}
             e_out_in_to_e_out = {}
 
-            for pred in right_properties_filtered:
-                temp_r, temp_l = self.get_hop2_subgraph(_entity=_entities[0], _predicate=pred,dbp=self.dbp, _right=True)
-                e_out_to_e_out_out[pred] = self.filter_predicates(temp_r,predicate_blacklist=self.predicate_blacklist, _use_blacklist=True, _only_dbo=_qald,
-                                                                  _qald=_qald)
-                e_out_in_to_e_out[pred] = self.filter_predicates(temp_l, predicate_blacklist=self.predicate_blacklist,_use_blacklist=True, _only_dbo=_qald,
-                                                                 _qald=_qald)
+            hop2_right = self.filtered_hop2_subgraphs(_entities[0], right_properties_filtered, True, neighbourhood,
+                                                      cached, _qald, _deadline=_deadline)
+            hop2_left = self.filtered_hop2_subgraphs(_entities[0], left_properties_filtered, False, neighbourhood,
+                                                     cached, _qald, _deadline=_deadline)
+            if self.subgraph_cache is not None:
+                # Hand the 2-hop predicates expanded to the other questions
+                self.subgraph_cache.merge(cache_key, cached)
+
+            for pred, (temp_r, temp_l) in zip(right_properties_filtered, hop2_right):
+                e_out_to_e_out_out[pred] = list(temp_r)
+                e_out_in_to_e_out[pred] = list(temp_l)
 
-            for pred in left_properties_filtered:
-                temp_r, temp_l = self.get_hop2_subgraph(_entity=_entities[0], _predicate=pred,dbp=self.dbp, _right=False)
-                e_in_to_e_in_out[pred] = self.filter_predicates(temp_r, predicate_blacklist=self.predicate_blacklist,_use_blacklist=True, _only_dbo=_qald,
-                                                                _qald=_qald)
-                e_in_in_to_e_in[pred] = self.filter_predicates(temp_l, predicate_blacklist=self.predicate_blacklist,_use_blacklist=True, _only_dbo=_qald,
-                                                               _qald=_qald)
+            for pred, (temp_r, temp_l) in zip(left_properties_filtered, hop2_left):
+                e_in_to_e_in_out[pred] = list(temp_r)
+                e_in_in_to_e_in[pred] = list(temp_l)
 
             # Get their surface forms, maintain a key-value store
             sf_vocab = {}
             for key in e_in_in_to_e_in.keys():
                 for uri in e_in_in_to_e_in[key]:
-                    sf_vocab[uri] = self.dbp.get_label(uri)
+                    sf_vocab[uri] = self.label(uri)
             for key in e_in_to_e_in_out.keys():
                 for uri in e_in_to_e_in_out[key]:
-                    sf_vocab[uri] = self.dbp.get_label(uri)
+                    sf_vocab[uri] = self.label(uri)
             for key in e_out_to_e_out_out.keys():
                 for uri in e_out_to_e_out_out[key]:
-                    sf_vocab[uri] = self.dbp.get_label(uri)
+                    sf_vocab[uri] = self.label(uri)
             for key in e_out_in_to_e_out.keys():
                 for uri in e_out_in_to_e_out[key]:
-                    sf_vocab[uri] = self.dbp.get_label(uri)
+                    sf_vocab[uri] = self.label(uri)
 
             # Flatten the four kind of predicates, and use their surface forms.
-            e_in_in_to_e_in_sf = [sf_vocab[x] for uris in e_in_in_to_e_in.values() for x in uris]
-            e_in_to_e_in_out_sf = [sf_vocab[x] for uris in e_in_to_e_in_out.values() for x in uris]
-            e_out_to_e_out_out_sf = [sf_vocab[x] for uris in e_out_to_e_out_out.values() for x in uris]
-            e_out_in_to_e_out_sf = [sf_vocab[x] for uris in e_out_in_to_e_out.values() for x in uris]
+            e_in_in_to_e_in_uris = [x for uris in e_in_in_to_e_in.values() for x in uris]
+            e_in_in_to_e_in_sf = [sf_vocab[x] for x in e_in_in_to_e_in_uris]
+            e_in_to_e_in_out_uris = [x for uris in e_in_to_e_in_out.values() for x in uris]
+            e_in_to_e_in_out_sf = [sf_vocab[x] for x in e_in_to_e_in_out_uris]
+            e_out_to_e_out_out_uris = [x for uris in e_out_to_e_out_out.values() for x in uris]
+            e_out_to_e_out_out_sf = [sf_vocab[x] for x in e_out_to_e_out_out_uris]
+            e_out_in_to_e_out_uris = [x for uris in e_out_in_to_e_out.values() for x in uris]
+            e_out_in_to_e_out_sf = [sf_vocab[x] for x in e_out_in_to_e_out_uris]
+
+            # As many as can be scored in time (with a _deadline)
+            k2 = self.hop2_limit(len(paths_hop1_uri), len([uris for uris in [e_in_in_to_e_in_uris, e_in_to_e_in_out_uris,
+                                                                             e_out_to_e_out_out_uris, e_out_in_to_e_out_uris]
+                                                               if uris]), _deadline)
+            limits['k_2hop'] = k2
 
             # WORD-EMBEDDING FILTERING
             e_in_in_to_e_in_filter_indices = self.similar_predicates(_v_qt=v_qt,_predicates=e_in_in_to_e_in_sf,
                                                                      _return_indices=True,
-                                                                     _k=self.K_2HOP_GLOVE)
+                                                                     _k=k2, _uris=e_in_in_to_e_in_uris)
             e_in_to_e_in_out_filter_indices = self.similar_predicates(_v_qt=v_qt,_predicates=e_in_to_e_in_out_sf,
                                                                       _return_indices=True,
-                                                                      _k=self.K_2HOP_GLOVE)
+                                                                      _k=k2, _uris=e_in_to_e_in_out_uris)
             e_out_to_e_out_out_filter_indices = self.similar_predicates(_v_qt=v_qt,_predicates=e_out_to_e_out_out_sf,
                                                                         _return_indices=True,
-                                                                        _k=self.K_2HOP_GLOVE)
+                                                                        _k=k2, _uris=e_out_to_e_out_out_uris)
             e_out_in_to_e_out_filter_indices = self.similar_predicates(_v_qt=v_qt,_predicates=e_out_in_to_e_out_sf,
                                                                        _return_indices=True,
-                                                                       _k=self.K_2HOP_GLOVE)
+                                                                       _k=k2, _uris=e_out_in_to_e_out_uris)
 
             # Impose these indices to generate filtered predicate list.
             e_in_in_to_e_in_filtered = [e_in_in_to_e_in_sf[i] for i in e_in_in_to_e_in_filter_indices]
@@ -0,0 +1,243 @@
+'''
+
+    Precomputed neighbourhoods of entities, so that CreateSubgraph.subgraph doesn't have to ask DBpedia for them.
+
+    For every entity the index keeps
+        right and left (outgoing and incoming) predicates,
+        and for every one of those, the right and left predicates of the entities at the other end (2-hop).
+    Predicates are stored once, in a table; records are arrays of uint32 ids into it.
+    The file is memory mapped, and an entity is found with one probe (mostly) of an open addressing hash table.
+    Entities not in the index are fetched from DBpedia at serve time, as before.
+
+    Build (all entities of LC-QuAD and QALD, plus those listed in the optional files, one uri per line):
+        python -m datasetPreparation.neighbourhood_index data/neighbourhood/index.bin [top_entities.txt ...]
+
+    Use:
+        index = NeighbourhoodIndex('data/neighbourhood/index.bin')
+        subgraph_maker = CreateSubgraph(dbp, predicate_blacklist, {}, neighbourhood_index=index)
+
+'''
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from array import array
+import hashlib
+import struct
+import mmap
+import json
+import sys
+import os
+import re
+
+MAGIC = b'KQANBR01'
+# n_entities, n_slots, slots_offset, predicates_offset, predicates_length
+HEADER = struct.Struct('<QQQQQ')
+# hash, record offset, record length
+SLOT = struct.Struct('<QQQ')
+# Predicates expanded per hop2 query while building
+HOP2_BATCH_SIZE = 50
+
+ENTITY_RE = re.compile(r'<(http://dbpedia\.org/resource/[^>]+)>')
+QALD_ENTITY_RE = re.compile(r'\b(?:res|dbr):([^\s;,{}()]+?)\.?(?=[\s;,{}()]|$)')
+
+Neighbourhood = namedtuple('Neighbourhood', ['right', 'left', 'hop2_right', 'hop2_left'])
+Neighbourhood.__doc__ = '''
+    right, left: lists of predicates (uris) of the entity.
+    hop2_right: right predicate -> (right, left predicates of the entities it leads to). hop2_left: the same, for left.
+'''
+
+
+def _hash(entity):
+    h = struct.unpack('<Q', hashlib.blake2b(entity.encode('utf-8'), digest_size=8).digest())[0]
+    # 0 marks an empty slot
+    return h or 1
+
+
+def _strip(entity):
+    return entity[1:-1] if entity.startswith('<') else entity
+
+
+class NeighbourhoodIndex:
+    def __init__(self, location):
+        self.location = location
+        self._file = open(location, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a neighbourhood index" % location)
+
+        self.n_entities, self.n_slots, self._slots_offset, predicates_offset, predicates_length = \
+            HEADER.unpack_from(self._map, len(MAGIC))
+        self.predicates = json.loads(self._map[predicates_offset:predicates_offset + predicates_length].decode('utf-8'))
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return self.n_entities
+
+    def __contains__(self, entity):
+        return self._find(_strip(entity)) is not None
+
+    def _find(self, entity):
+        """ (offset, length) of the entity's record, or None """
+        h = _hash(entity)
+        slot = h % self.n_slots
+        for _ in range(self.n_slots):
+            slot_hash, offset, length = SLOT.unpack_from(self._map, self._slots_offset + slot * SLOT.size)
+            if slot_hash == 0:
+                return None
+            if slot_hash == h:
+                name_length = struct.unpack_from('<I', self._map, offset)[0]
+                if self._map[offset + 4:offset + 4 + name_length].decode('utf-8') == entity:
+                    return offset + 4 + name_length, length - 4 - name_length
+            slot = (slot + 1) % self.n_slots
+        return None
+
+    def get(self, entity):
+        """ The Neighbourhood of the entity (uri, with or without <>), or None if it isn't indexed """
+        found = self._find(_strip(entity))
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        ids = array('I')
+        ids.frombytes(self._map[found[0]:found[0] + found[1]])
+        if sys.byteorder != 'little':
+            ids.byteswap()
+        predicates = self.predicates
+        position = [0]
+
+        def _take():
+            n = ids[position[0]]
+            taken = [predicates[i] for i in ids[position[0] + 1:position[0] + 1 + n]]
+            position[0] += 1 + n
+            return taken
+
+        right, left = _take(), _take()
+        hop2_right = {p: (_take(), _take()) for p in right}
+        hop2_left = {p: (_take(), _take()) for p in left}
+        return Neighbourhood(right, left, hop2_right, hop2_left)
+
+    def stats(self):
+        return {'entities': self.n_entities, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _decode(uris):
+    return list(set([u.decode('utf-8') if isinstance(u, bytes) else u for u in uris]))
+
+
+def fetch_neighbourhood(entity, dbp, hop2_batch_size=HOP2_BATCH_SIZE):
+    """ The Neighbourhood of the entity, from DBpedia (through dbp, a utils.dbpedia_interface.DBPedia) """
+    right, left = dbp.get_properties(_uri=entity, label=False)
+    right, left = _decode(right), _decode(left)
+
+    hop2 = []
+    for predicates, _right in [(right, True), (left, False)]:
+        expanded = {}
+        for i in range(0, len(predicates), hop2_batch_size):
+            subgraphs = dbp.get_hop2_subgraph_batch(entity, predicates[i:i + hop2_batch_size], right=_right)
+            expanded.update({p: (_decode(r), _decode(l)) for p, (r, l) in subgraphs.items()})
+        hop2.append(expanded)
+    return Neighbourhood(right, left, hop2[0], hop2[1])
+
+
+def build(entities, dbp, location, workers=8):
+    """
+        Fetches the neighbourhood of every entity and writes the index to location.
+        Entities which can't be fetched are left out (and will be fetched live).
+
+    :param entities: list of uris
+    :param dbp: utils.dbpedia_interface.DBPedia
+    :return: number of entities indexed
+    """
+    entities = list(dict.fromkeys(_strip(e) for e in entities))
+    predicate_ids = {}
+    slots = []
+
+    def _ids(uris):
+        ids = [predicate_ids.setdefault(u, len(predicate_ids)) for u in uris]
+        return [len(ids)] + ids
+
+    def _fetch(entity):
+        try:
+            return entity, fetch_neighbourhood(entity, dbp)
+        except Exception as e:
+            print("Couldn't fetch the neighbourhood of %s: %r" % (entity, e))
+            return entity, None
+
+    temporary = location + '.tmp'
+    with open(temporary, 'wb') as f, ThreadPoolExecutor(max_workers=workers) as pool:
+        f.write(MAGIC + HEADER.pack(0, 0, 0, 0, 0))
+        for counter, (entity, neighbourhood) in enumerate(pool.map(_fetch, entities)):
+            if neighbourhood is None:
+                continue
+            record = _ids(neighbourhood.right) + _ids(neighbourhood.left)
+            for p in neighbourhood.right:
+                record += _ids(neighbourhood.hop2_right.get(p, ([], []))[0]) + \
+                          _ids(neighbourhood.hop2_right.get(p, ([], []))[1])
+            for p in neighbourhood.left:
+                record += _ids(neighbourhood.hop2_left.get(p, ([], []))[0]) + \
+                          _ids(neighbourhood.hop2_left.get(p, ([], []))[1])
+
+            ids = array('I', record)
+            if sys.byteorder != 'little':
+                ids.byteswap()
+            name = entity.encode('utf-8')
+            slots.append((_hash(entity), f.tell(), 4 + len(name) + len(ids) * ids.itemsize))
+            f.write(struct.pack('<I', len(name)) + name + ids.tobytes())
+            if counter % 100 == 0:
+                print("done with, ", counter)
+
+        # Predicate table
+        predicates = [None] * len(predicate_ids)
+        for uri, i in predicate_ids.items():
+            predicates[i] = uri
+        predicates = json.dumps(predicates).encode('utf-8')
+        predicates_offset = f.tell()
+        f.write(predicates)
+
+        # Hash table, at most half full
+        n_slots = max(2 * len(slots), 1)
+        table = [(0, 0, 0)] * n_slots
+        for h, offset, length in slots:
+            slot = h % n_slots
+            while table[slot][0] != 0:
+                slot = (slot + 1) % n_slots
+            table[slot] = (h, offset, length)
+        slots_offset = f.tell()
+        f.write(b''.join(SLOT.pack(*s) for s in table))
+
+        f.seek(len(MAGIC))
+        f.write(HEADER.pack(len(slots), n_slots, slots_offset, predicates_offset, len(predicates)))
+
+    os.replace(temporary, location)
+    return len(slots)
+
+
+def lcquad_entities(location='resources/lcquad_data_set.json'):
+    return [e for node in json.load(open(location)) for e in ENTITY_RE.findall(node['sparql_query'])]
+
+
+def qald_entities(location='resources/qald-7-train-multilingual.json'):
+    entities = []
+    for node in json.load(open(location))['questions']:
+        sparql = node['query'].get('sparql', '')
+        entities += ENTITY_RE.findall(sparql)
+        entities += ['http://dbpedia.org/resource/' + e for e in QALD_ENTITY_RE.findall(sparql)]
+    return entities
+
+
+if __name__ == "__main__":
+    from utils import dbpedia_interface as db_interface
+
+    location = sys.argv[1]
+    entities = lcquad_entities() + qald_entities()
+    for entity_file in sys.argv[2:]:
+        entities += [line.strip() for line in open(entity_file) if line.strip()]
+
+    if os.path.dirname(location):
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+    dbp = db_interface.DBPedia(caching=False, local_caching=False)
+    print("Indexed %d entities" % build(entities, dbp, location))
@@ -0,0 +1,128 @@
+'''
+    Subgraphs of entities, kept across questions (and, with save/load, across runs) by CreateSubgraph.
+
+    Questions often share their topic entity. What's kept is everything about its neighbourhood that doesn't
+        depend on the question: the (blacklist filtered) right and left predicates, and the (filtered) 2-hop
+        predicates of every 1-hop predicate expanded so far. The similarity filtering against the question is
+        done afresh every time, on top of it.
+
+    Keys are (entity, blacklist_version, qald): changing the blacklist or the dataset specific filtering
+        makes a new entry rather than serving a stale one.
+
+    Usage:
+        cache = SubgraphCache.load('data/cache/subgraph.pickle', max_bytes=256 * 1024 * 1024)
+        subgraph_maker = CreateSubgraph(dbp, predicate_blacklist, {}, subgraph_cache=cache)
+        ...
+        cache.save('data/cache/subgraph.pickle')
+'''
+from collections import OrderedDict
+import threading
+import warnings
+import hashlib
+import pickle
+import os
+
+# Bytes taken by a predicate (reference + share of the string) and by a hop2 entry, roughly
+PREDICATE_BYTES = 64
+ENTRY_BYTES = 256
+
+
+def blacklist_version(predicate_blacklist):
+    """ md5 of the (sorted) blacklist """
+    return hashlib.md5('\n'.join(sorted(predicate_blacklist)).encode('utf-8')).hexdigest()
+
+
+def entry_size(neighbourhood):
+    """ Rough size (bytes) of a neighbourhood_index.Neighbourhood """
+    size = ENTRY_BYTES + PREDICATE_BYTES * (len(neighbourhood.right) + len(neighbourhood.left))
+    for hop2 in (neighbourhood.hop2_right, neighbourhood.hop2_left):
+        for r, l in hop2.values():
+            size += ENTRY_BYTES + PREDICATE_BYTES * (len(r) + len(l))
+    return size
+
+
+class SubgraphCache:
+    """
+        An LRU of neighbourhood_index.Neighbourhood keyed by (entity, blacklist_version, qald),
+            bounded by (roughly estimated) bytes.
+
+        Entries are shared by every thread, and never changed once in: CreateSubgraph adds the 2-hop predicates
+            it expands to a copy of the entry, and merges the copy back.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._store = OrderedDict()
+        self._sizes = {}
+        self.size = 0
+        self._lock = threading.RLock()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._store.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._store[key]
+
+    def put(self, key, neighbourhood):
+        """ Adds/replaces an entry. """
+        size = entry_size(neighbourhood)
+        with self._lock:
+            self.size += size - self._sizes.get(key, 0)
+            self._store[key] = neighbourhood
+            self._store.move_to_end(key)
+            self._sizes[key] = size
+            while self.size > self.max_bytes and len(self._store) > 1:
+                evicted, _ = self._store.popitem(last=False)
+                self.size -= self._sizes.pop(evicted)
+
+    def merge(self, key, neighbourhood):
+        """
+            Replaces the entry with one holding the 2-hop expansions of both it and neighbourhood (a copy of it,
+                expanded further), so that concurrent expansions of the same entity don't undo each other.
+        """
+        with self._lock:
+            current = self._store.get(key)
+            if current is not None and current is not neighbourhood:
+                hop2_right, hop2_left = dict(current.hop2_right), dict(current.hop2_left)
+                hop2_right.update(neighbourhood.hop2_right)
+                hop2_left.update(neighbourhood.hop2_left)
+                neighbourhood = neighbourhood._replace(hop2_right=hop2_right, hop2_left=hop2_left)
+            self.put(key, neighbourhood)
+
+    def stats(self):
+        return {'entries': len(self._store), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+    def save(self, location):
+        """ Dumps the entries, most recently used last """
+        with self._lock:
+            entries = list(self._store.items())
+        temporary = location + '.tmp'
+        with open(temporary, 'wb+') as f:
+            pickle.dump(entries, f)
+        os.replace(temporary, location)
+
+    @classmethod
+    def load(cls, location, max_bytes=256 * 1024 * 1024):
+        """
+            Loads a dump made by save (keeping the most recently used entries if it doesn't fit in max_bytes).
+            An empty cache is returned if there is no dump (or it can't be read).
+        """
+        cache = cls(max_bytes=max_bytes)
+        if not os.path.isfile(location):
+            return cache
+        try:
+            entries = pickle.load(open(location, 'rb'))
+        except Exception as e:
+            warnings.warn("Couldn't read the subgraph cache at %s (%r). Starting afresh." % (location, e))
+            return cache
+        for key, neighbourhood in entries:
+            cache.put(key, neighbourhood)
+        return cache
@@ -0,0 +1,307 @@
+'''
+    Stores for encodings which depend only on the (trained) model and not on the question.
+
+    Every store is stamped with the checkpoint it was computed from (see checkpoint_stamp).
+        A store loaded against some other checkpoint is discarded, so stale encodings are never served.
+
+    Usage (dot product models):
+        cache = PathEncodingCache.load(location, stamp=checkpoint_stamp(model_path), max_size=100000)
+        model.path_cache = cache
+        ...
+        model.predict(ques, paths, device)      # encodes only the paths missing from the cache
+
+    Slot pointer models use a RelationEncodingTable (model.relation_table) instead.
+'''
+import os
+import pickle
+import hashlib
+import warnings
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def checkpoint_stamp(location):
+    """
+        md5 of the checkpoint on disk. Any retraining/reloading of weights changes the stamp.
+
+    :param location: path to model.torch
+    :return: str
+    """
+    md5 = hashlib.md5()
+    with open(location, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def path_key(path):
+    """
+        Key of a path in the store: the tuple of its token ids, without padding.
+
+    :param path: iterable of token ids (list/np array/1d tensor)
+    :return: tuple of ints
+    """
+    return tuple(int(token) for token in path if int(token) != 0)
+
+
+class PathEncodingCache(object):
+    """
+        An LRU store of path encodings keyed by path_key.
+        Encodings are kept as torch tensors on whichever device they were computed.
+        Safe to share between threads (eg. the server's batcher threads and answer_many).
+
+        max_size: max number of encodings held in memory. None means unbounded (used while precomputing).
+    """
+
+    def __init__(self, stamp, max_size=None):
+        self.stamp = stamp
+        self.max_size = max_size
+        # Width of the encodings, once one is in
+        self.dim = None
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._store
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._store.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._store[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._store[key] = value
+            self._store.move_to_end(key)
+            self.dim = value.shape[-1]
+            if self.max_size is not None:
+                while len(self._store) > self.max_size:
+                    self._store.popitem(last=False)
+
+    def save(self, location):
+        """
+            Dumps the encodings (most recently used last) along with the stamp.
+        """
+        with self._lock:
+            items = list(self._store.items())
+        keys = [key for key, _ in items]
+        encodings = np.stack([value.detach().cpu().numpy() for _, value in items]) if items else None
+        with open(location, 'wb+') as f:
+            pickle.dump({'stamp': self.stamp, 'keys': keys, 'encodings': encodings}, f)
+
+    @classmethod
+    def load(cls, location, stamp, max_size=None, device=None):
+        """
+            Loads a dump made by save. If the dump does not exist, or was made with a different checkpoint,
+                an empty cache is returned instead.
+
+        :param location: str: dump location
+        :param stamp: str: checkpoint_stamp of the model which will use the cache
+        :param max_size: int/None
+        :param device: torch device on which the encodings are put
+        :return: PathEncodingCache
+        """
+        cache = cls(stamp=stamp, max_size=max_size)
+        if not os.path.isfile(location):
+            return cache
+
+        dump = pickle.load(open(location, 'rb'))
+        if dump['stamp'] != stamp:
+            warnings.warn("Path encodings at %s were computed with another checkpoint. Ignoring them." % location)
+            return cache
+
+        if dump['encodings'] is not None:
+            encodings = torch.tensor(dump['encodings'], device=device)
+            # Keep the most recently used ones if the dump is bigger than max_size
+            start = 0 if max_size is None else max(0, len(dump['keys']) - max_size)
+            for i in range(start, len(dump['keys'])):
+                cache.put(dump['keys'][i], encodings[i])
+        return cache
+
+
+def encode_paths_cached(model, paths):
+    """
+        Encodes paths with model.encode_paths, serving whatever it can from model.path_cache.
+        All the misses are encoded together, in one batch, and put in the cache.
+
+    :param model: network.Model with encode_paths
+    :param paths: torch tensor (batch, seq)
+    :return: torch tensor (batch, dim). (0, dim) for no paths (dim is 0 if nothing was ever encoded).
+    """
+    cache = model.path_cache
+    keys = [path_key(path) for path in paths.tolist()]
+    if not keys:
+        return torch.zeros((0, cache.dim or 0), device=paths.device)
+    encodings = [cache.get(key) for key in keys]
+
+    # Unique paths which need to be encoded, and their first row in the batch
+    missing = OrderedDict()
+    for i, key in enumerate(keys):
+        if encodings[i] is None and key not in missing:
+            missing[key] = i
+
+    if missing:
+        rows = torch.tensor(list(missing.values()), dtype=torch.long, device=paths.device)
+        encoded = model.encode_paths(paths.index_select(0, rows))
+        fresh = {}
+        for j, key in enumerate(missing.keys()):
+            fresh[key] = encoded[j]
+            cache.put(key, encoded[j])
+        encodings = [fresh[key] if encoding is None else encoding for key, encoding in zip(keys, encodings)]
+
+    return torch.stack(encodings)
+
+
+def precompute_path_encodings(model, paths, max_length, batch_size=500):
+    """
+        Offline: fills model.path_cache with encodings of the given paths.
+        Call save on the cache afterwards.
+
+    :param model: network.Model with encode_paths and path_cache set
+    :param paths: list of paths (lists of token ids), eg. from every datapoint of id_big_data.json
+    :param max_length: paths are padded/cut to this length (parameter_dict['rel_pad'])
+    :param batch_size: int
+    :return: None
+    """
+    # Keys as they'd be seen at runtime, ie. after cutting the path to max_length
+    unique = [key for key in OrderedDict.fromkeys(path_key(path[:max_length]) for path in paths) if key]
+    unique = [key for key in unique if key not in model.path_cache]
+
+    with torch.no_grad():
+        for _, module in model.prepare_save():
+            module.eval()
+        for start in range(0, len(unique), batch_size):
+            batch = unique[start:start + batch_size]
+            P = np.zeros((len(batch), max_length))
+            for i, key in enumerate(batch):
+                P[i, :len(key)] = key
+            P = torch.tensor(P, dtype=torch.long, device=model.device)
+            encoded = model.encode_paths(P)
+            for i, key in enumerate(batch):
+                model.path_cache.put(key, encoded[i])
+        model.resume_training(*[module for _, module in model.prepare_save()])
+
+
+class RelationEncodingTable(object):
+    """
+        Encodings of single relation slots (sign + relation tokens) for slot pointer models,
+            which encode the two slots of a core chain separately and concatenate them.
+        Candidates of a question share a handful of relations, so a chain's encoding
+            is assembled by gathering the rows of its two slots.
+
+        Slots not in the table (eg. relations unseen when the table was built) are encoded
+            on the fly and added to it.
+        The table is bounded by the number of relations, hence not an LRU.
+        Safe to share between threads: the table only grows under a lock, and rows are gathered under the same lock.
+    """
+
+    def __init__(self, stamp):
+        self.stamp = stamp
+        self.index = {}
+        self.encodings = None
+        # Reentrant, as encode_chains holds it across two lookups
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.index
+
+    def _add(self, model, keys, width):
+        """ Encode the given (new) slots together and append them to the table. Call with the lock held. """
+        S = np.zeros((len(keys), width))
+        for i, key in enumerate(keys):
+            S[i, :min(len(key), width)] = key[:width]
+        S = torch.tensor(S, dtype=torch.long, device=model.device)
+        encoded = model.encode_relations(S)
+
+        for key in keys:
+            self.index[key] = len(self.index)
+        self.encodings = encoded if self.encodings is None else torch.cat([self.encodings, encoded], 0)
+
+    def lookup(self, model, slots):
+        """
+            Row of every slot in the table, encoding the slots which are not there yet.
+
+        :param model: network.Model with encode_relations
+        :param slots: torch tensor (batch, width) of slot token ids
+        :return: torch long tensor (batch)
+        """
+        keys = [path_key(slot) for slot in slots.tolist()]
+        with self._lock:
+            unseen = [key for key in OrderedDict.fromkeys(keys) if key not in self.index]
+            if unseen:
+                self._add(model, unseen, slots.shape[1])
+            device = self.encodings.device if self.encodings is not None else slots.device
+            return torch.tensor([self.index[key] for key in keys], dtype=torch.long, device=device)
+
+    def encode_chains(self, model, paths_rel1, paths_rel2):
+        """
+            Drop in for model.encode_chains: paths_rel1, paths_rel2: (batch, width) -> (batch, 2*dim)
+        """
+        with self._lock:
+            rows1, rows2 = self.lookup(model, paths_rel1), self.lookup(model, paths_rel2)
+            # The rows of both are in the table as it is now
+            encodings = self.encodings
+        return torch.cat([encodings.index_select(0, rows1), encodings.index_select(0, rows2)], 1)
+
+    def build(self, model, slots, width, batch_size=500):
+        """
+            Offline/at load: encode all the given slots (lists of token ids).
+
+        :param model: network.Model with encode_relations
+        :param slots: list of slots, eg. ['+' id] + relation tokens for every relation in relations.pickle
+        :param width: slots are padded/cut to this length (parameter_dict['relsp_pad'])
+        :param batch_size: int
+        :return: None
+        """
+        with torch.no_grad(), self._lock:
+            unique = [key for key in OrderedDict.fromkeys(path_key(slot[:width]) for slot in slots)
+                      if key and key not in self.index]
+            for _, module in model.prepare_save():
+                module.eval()
+            for start in range(0, len(unique), batch_size):
+                self._add(model, unique[start:start + batch_size], width)
+            model.resume_training(*[module for _, module in model.prepare_save()])
+
+    def save(self, location):
+        with self._lock:
+            keys = sorted(self.index, key=self.index.get)
+            encodings = self.encodings.detach().cpu().numpy() if self.encodings is not None else None
+        with open(location, 'wb+') as f:
+            pickle.dump({'stamp': self.stamp, 'keys': keys, 'encodings': encodings}, f)
+
+    @classmethod
+    def load(cls, location, stamp, device=None):
+        """
+            Loads a dump made by save. If the dump does not exist, or was made with a different checkpoint,
+                an empty table is returned instead.
+        """
+        table = cls(stamp=stamp)
+        if not os.path.isfile(location):
+            return table
+
+        dump = pickle.load(open(location, 'rb'))
+        if dump['stamp'] != stamp:
+            warnings.warn("Relation encodings at %s were computed with another checkpoint. Ignoring them." % location)
+            return table
+
+        if dump['encodings'] is not None:
+            table.index = {key: i for i, key in enumerate(dump['keys'])}
+            table.encodings = torch.tensor(dump['encodings'], device=device)
+        return table
@@ -7,6 +7,7 @@ import os, sys
 os.environ['QT_QPA_PLATFORM']='offscreen'
 
 import torch
+import threading
 import traceback
 
 sys.path.append('/data/priyansh/conda/fastai')
@@ -17,6 +18,7 @@ from fastai.text import *
 
 # Local imports
 import components as com
+import encoding_cache as ec
 from utils import tensor_utils as tu
 
 class Model(object):
@@ -24,8 +26,105 @@ class Model(object):
         Boilerplate class which helps others have some common functionality.
         These are made with some debugging/loading and with corechains in mind
 
+        broadcast_question: True for models which encode the question independently of the path.
+            Their predict accepts a single question row (1, seq) which is encoded once and
+            broadcast against all the candidate path encodings.
+
+        path_cache: an encoding_cache.PathEncodingCache. When set (at runtime, never while training),
+            models with encode_paths only encode the paths they have not seen before.
+        relation_table: an encoding_cache.RelationEncodingTable. Same, for slot pointer models (encode_relations),
+            whose chain encodings are then gathered from the encodings of their two relations.
+
+        inference, lock: set by prepare_inference, when the model is served rather than trained.
     """
 
+    broadcast_question = False
+    path_cache = None
+    relation_table = None
+    inference = False
+    lock = None
+
+    def prepare_inference(self):
+        """
+            For serving: puts the modules in eval mode for good (predict no longer puts them back in train mode),
+                and gives the model a lock, to be held around every forward when threads share the model.
+        """
+        self.inference = True
+        self.lock = threading.RLock()
+        for _, module in self.prepare_save():
+            module.eval()
+
+    def resume_training(self, *modules):
+        """
+            Puts the modules back in train mode at the end of a predict. Not for models being served (see prepare_inference).
+        """
+        if not self.inference:
+            for module in modules:
+                module.train()
+
+    def cached_encode_paths(self, paths):
+        """
+            paths: (batch, seq) -> (batch, dim), through self.path_cache if there is one.
+        """
+        if self.path_cache is None:
+            return self.encode_paths(paths)
+        return ec.encode_paths_cached(self, paths)
+
+    def cached_encode_chains(self, paths_rel1, paths_rel2):
+        """
+            paths_rel1, paths_rel2: (batch, seq) -> (batch, 2*dim), gathered from self.relation_table if there is one.
+        """
+        if self.relation_table is None:
+            return self.encode_chains(paths_rel1, paths_rel2)
+        return self.relation_table.encode_chains(self, paths_rel1, paths_rel2)
+
+    def encode_questions(self, ques):
+        """
+            For broadcast_question models: ques (num_questions, seq) -> (num_questions, dim), outside of predict.
+            Used to encode a question while its candidate paths are still being fetched (see predict_many).
+        """
+        modules = [module for _, module in self.prepare_save()]
+        with torch.no_grad():
+            for module in modules:
+                module.eval()
+
+            question = self.encode_question(ques)
+            if isinstance(question, tuple):
+                # Slot pointer models also return the attention scores
+                question = question[0]
+
+            self.resume_training(*modules)
+            return question
+
+    def predict_many(self, ques, owner, paths, device, paths_rel1=None, paths_rel2=None, ques_encoded=False):
+        """
+            For broadcast_question models: scores the candidate paths of several questions in one forward.
+
+            ques: (num_questions, seq), or (num_questions, dim) if ques_encoded (output of encode_questions)
+            owner: (num_paths) long tensor: row in ques of the question each path belongs to
+            paths: (num_paths, seq). paths_rel1, paths_rel2: (num_paths, seq) for slot pointer models.
+
+            returns score: (num_paths)
+        """
+        if not ques_encoded:
+            ques = self.encode_questions(ques)
+
+        modules = [module for _, module in self.prepare_save()]
+        with torch.no_grad():
+            for module in modules:
+                module.eval()
+
+            question = ques
+            if paths_rel1 is not None:
+                paths = self.cached_encode_chains(paths_rel1, tu.no_one_left_behind(paths_rel2))
+            else:
+                paths = self.cached_encode_paths(paths)
+
+            score = torch.sum(question.index_select(0, owner) * paths, -1)
+
+            self.resume_training(*modules)
+            return score
+
     def prepare_save(self):
         pass
 
@@ -162,7 +261,7 @@ class BiLstmDotOld(Model):
             paths, _ = self.encoder(paths.long(), hidden)
             score = torch.sum(question[-1] * paths[-1], -1)
 
-            self.encoder.train()
+            self.resume_training(self.encoder)
 
             return score
 
@@ -179,6 +278,8 @@ class BiLstmDotOld(Model):
 
 class BiLstmDot(Model):
 
+    broadcast_question = True
+
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -303,17 +404,34 @@ class BiLstmDot(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, dim). Expects to be called within predict (no_grad, eval mode).
+        """
+        hidden = self.encoder.init_hidden(ques.shape[0], self.device)
+        _, question, _, _ = self.encoder(tu.trim(ques.long()), hidden)
+        return question
+
+    def encode_paths(self, paths):
+        """
+            paths: (batch, seq) -> (batch, dim). Expects to be called within predict (no_grad, eval mode).
+        """
+        hidden = self.encoder.init_hidden(paths.shape[0], self.device)
+        _, paths, _, _ = self.encoder(tu.trim(paths.long()), hidden)
+        return paths
+
     def predict(self, ques, paths, device):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq). In the latter case,
+                the question is encoded once and broadcast against every path.
         """
         with torch.no_grad():
 
             self.encoder.eval()
-            hidden = self.encoder.init_hidden(ques.shape[0], self.device)
 
-            _, question, _, _ = self.encoder(tu.trim(ques.long()), hidden)
-            _, paths, _, _ = self.encoder(tu.trim(paths.long()), hidden)
+            question = self.encode_question(ques)
+            paths = self.cached_encode_paths(paths)
 
             if self.pointwise:
                 # question = F.normalize(F.relu(question),p=1,dim=1)
@@ -325,7 +443,7 @@ class BiLstmDot(Model):
             else:
                 score = torch.sum(question * paths, -1)
 
-            self.encoder.train()
+            self.resume_training(self.encoder)
             return score
 
     def prepare_save(self):
@@ -466,7 +584,7 @@ class BiLstmDense(Model):
             _, question, _, _ = self.encoder(tu.trim(ques.long()), hidden)
             _, paths, _, _ = self.encoder(tu.trim(paths.long()), hidden)
             score = self.dense(torch.cat((question, paths), dim=1)).squeeze()
-            self.encoder.train()
+            self.resume_training(self.encoder)
 
             return score
 
@@ -489,6 +607,8 @@ class BiLstmDenseDot(Model):
         Like before, we have both pairwise and pointwise versions.
     """
 
+    broadcast_question = True
+
     def __init__(self, _parameter_dict, _word_to_id,  _device, _pointwise=False, _debug=False):
         self.debug = _debug
         self.parameter_dict = _parameter_dict
@@ -602,27 +722,38 @@ class BiLstmDenseDot(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, dim) after the dense layers.
+        """
+        hidden = self.encoder.init_hidden(ques.shape[0], self.device)
+        _, question, _, _ = self.encoder(tu.trim(ques.long()), hidden)
+        return self.dense(question)
+
+    def encode_paths(self, paths):
+        """
+            paths: (batch, seq) -> (batch, dim) after the dense layers.
+        """
+        hidden = self.encoder.init_hidden(paths.shape[0], self.device)
+        _, paths, _, _ = self.encoder(tu.trim(paths.long()), hidden)
+        return self.dense(paths)
+
     def predict(self, ques, paths, device):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
 
         with torch.no_grad():
 
             self.encoder.eval()
 
-            hidden = self.encoder.init_hidden(ques.shape[0], self.device)
-
-            _, question, _, _ = self.encoder(tu.trim(ques.long()), hidden)
-            _, paths, _, _ = self.encoder(tu.trim(paths.long()), hidden)
-
-            # Dense
-            question = self.dense(question)
-            paths = self.dense(paths)
+            question = self.encode_question(ques)
+            paths = self.cached_encode_paths(paths)
 
             score = torch.sum(question * paths, -1)
 
-            self.encoder.train()
+            self.resume_training(self.encoder)
 
             return score
 
@@ -639,6 +770,8 @@ https://arxiv.org/pdf/1606.01933.pdf
 
 class CNNDot(Model):
 
+    broadcast_question = True
+
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -729,16 +862,29 @@ class CNNDot(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, output_dim)
+        """
+        return self.encoder(ques.long())
+
+    def encode_paths(self, paths):
+        """
+            paths: (batch, seq) -> (batch, output_dim)
+        """
+        return self.encoder(paths.long())
+
     def predict(self, ques, paths, device):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
         with torch.no_grad():
 
             self.encoder.eval()
 
-            question = self.encoder(ques.long())
-            paths = self.encoder(paths.long())
+            question = self.encode_question(ques)
+            paths = self.cached_encode_paths(paths)
 
             if self.pointwise:
                 # question = F.normalize(F.relu(question),p=1,dim=1)
@@ -750,7 +896,7 @@ class CNNDot(Model):
             else:
                 score = torch.sum(question * paths, -1)
 
-            self.encoder.train()
+            self.resume_training(self.encoder)
             return score
 
     def prepare_save(self):
@@ -887,7 +1033,7 @@ class DecomposableAttention(Model):
             paths, _, _, paths_mask = self.encoder(tu.trim(paths.long()), hidden)
             score = self.scorer(question, paths, question_mask, paths_mask)
 
-            self.encoder.train()
+            self.resume_training(self.encoder)
             return score.squeeze()
 
     def prepare_save(self):
@@ -999,7 +1145,7 @@ class RelDetection(Model):
                                  path_rel_1=paths_rel1,
                                  path_rel_2=paths_rel2,
                                  _h=_h).squeeze()
-            self.encoder.train()
+            self.resume_training(self.encoder)
             return score
 
     def prepare_save(self):
@@ -1011,6 +1157,8 @@ class QelosSlotPointerModel(Model):
     """
         Eating Denis's shit
     """
+
+    broadcast_question = True
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -1126,9 +1274,29 @@ class QelosSlotPointerModel(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, 2*dim), attention scores over the two slots.
+        """
+        return self.encoder_q(tu.trim(ques))
+
+    def encode_chains(self, paths_rel1, paths_rel2):
+        """
+            paths_rel1, paths_rel2: (batch, seq) -> (batch, 2*dim).
+            paths_rel2 is expected to have already gone through tu.no_one_left_behind.
+        """
+        return self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+
+    def encode_relations(self, slots):
+        """
+            slots: (batch, seq) -> (batch, dim). One slot of a chain, as encoded within encode_chains.
+        """
+        return self.encoder_p.enc(slots)
+
     def predict(self, ques, paths, paths_rel1,paths_rel2, device,attention_value=False):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
         with torch.no_grad():
             self.encoder_q.eval()
@@ -1139,14 +1307,13 @@ class QelosSlotPointerModel(Model):
             paths_rel2 = tu.no_one_left_behind(paths_rel2)
 
             # Encoding all the data
-            ques_encoded,attention_score = self.encoder_q(tu.trim(ques))
-            path_encoded = self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+            ques_encoded, attention_score = self.encode_question(ques)
+            path_encoded = self.cached_encode_chains(paths_rel1, paths_rel2)
 
             # Pass them to the comparison module
             score = torch.sum(ques_encoded * path_encoded, dim=-1)
 
-            self.encoder_q.train()
-            self.encoder_p.train()
+            self.resume_training(self.encoder_q, self.encoder_p)
             if attention_value:
                 return score,attention_score
             else:
@@ -1339,9 +1506,7 @@ class SlotPointerModel(Model):
                                   path_2_emb=pos_2_embedded,
                                   path_2_mask=pos_2_mask).squeeze()
 
-            self.encoder_q.train()
-            self.encoder_p.train()
-            self.comparer.train()
+            self.resume_training(self.encoder_q, self.encoder_p, self.comparer)
             return score
 
     def prepare_save(self):
@@ -1349,6 +1514,9 @@ class SlotPointerModel(Model):
 
 
 class BiLstmDot_skip(Model):
+
+    broadcast_question = True
+
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -1453,16 +1621,29 @@ class BiLstmDot_skip(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, dim)
+        """
+        return self.encoder(tu.trim(ques.long()))
+
+    def encode_paths(self, paths):
+        """
+            paths: (batch, seq) -> (batch, dim)
+        """
+        return self.encoder(tu.trim(paths.long()))
+
     def predict(self, ques, paths, device):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
         with torch.no_grad():
 
             self.encoder.eval()
 
-            question = self.encoder(tu.trim(ques.long()))
-            paths = self.encoder(tu.trim(paths.long()))
+            question = self.encode_question(ques)
+            paths = self.cached_encode_paths(paths)
 
             if self.pointwise:
                 # question = F.normalize(F.relu(question),p=1,dim=1)
@@ -1474,7 +1655,7 @@ class BiLstmDot_skip(Model):
             else:
                 score = torch.sum(question * paths, -1)
 
-            self.encoder.train()
+            self.resume_training(self.encoder)
             return score
 
     def prepare_save(self):
@@ -1496,6 +1677,8 @@ class BiLstmDot_skip(Model):
 
 class BiLstmDot_multiencoder(Model):
 
+    broadcast_question = True
+
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -1638,18 +1821,34 @@ class BiLstmDot_multiencoder(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, dim)
+        """
+        hidden = self.encoder_q.init_hidden(ques.shape[0], self.device)
+        _, question, _, _ = self.encoder_q(tu.trim(ques.long()), hidden)
+        return question
+
+    def encode_paths(self, paths):
+        """
+            paths: (batch, seq) -> (batch, dim)
+        """
+        hidden = self.encoder_p.init_hidden(paths.shape[0], self.device)
+        _, paths, _, _ = self.encoder_p(tu.trim(paths.long()), hidden)
+        return paths
+
     def predict(self, ques, paths, device):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
         with torch.no_grad():
 
             self.encoder_q.eval()
             self.encoder_p.eval()
-            hidden = self.encoder_q.init_hidden(ques.shape[0], self.device)
 
-            _, question, _, _ = self.encoder_q(tu.trim(ques.long()), hidden)
-            _, paths, _, _ = self.encoder_p(tu.trim(paths.long()), hidden)
+            question = self.encode_question(ques)
+            paths = self.cached_encode_paths(paths)
 
             if self.pointwise:
                 # question = F.normalize(F.relu(question),p=1,dim=1)
@@ -1661,8 +1860,7 @@ class BiLstmDot_multiencoder(Model):
             else:
                 score = torch.sum(question * paths, -1)
 
-            self.encoder_q.train()
-            self.encoder_p.train()
+            self.resume_training(self.encoder_q, self.encoder_p)
             return score
 
     def prepare_save(self):
@@ -1911,7 +2109,7 @@ class BiLstmDot_ulmfit(Model):
             else:
                 score = torch.sum(question * paths, -1)
 
-            self.encoder.train()
+            self.resume_training(self.encoder)
             return score
 
     def prepare_save(self):
@@ -1938,6 +2136,8 @@ class QelosSlotPointerModelOrthogonal(Model):
     """
         Eating Denis's shit
     """
+
+    broadcast_question = True
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -2064,9 +2264,29 @@ class QelosSlotPointerModelOrthogonal(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, 2*dim), attention scores over the two slots.
+        """
+        return self.encoder_q(tu.trim(ques))
+
+    def encode_chains(self, paths_rel1, paths_rel2):
+        """
+            paths_rel1, paths_rel2: (batch, seq) -> (batch, 2*dim).
+            paths_rel2 is expected to have already gone through tu.no_one_left_behind.
+        """
+        return self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+
+    def encode_relations(self, slots):
+        """
+            slots: (batch, seq) -> (batch, dim). One slot of a chain, as encoded within encode_chains.
+        """
+        return self.encoder_p.enc(slots)
+
     def predict(self, ques, paths, paths_rel1,paths_rel2, device,attention_value=False):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
         with torch.no_grad():
             self.encoder_q.eval()
@@ -2077,14 +2297,13 @@ class QelosSlotPointerModelOrthogonal(Model):
             paths_rel2 = tu.no_one_left_behind(paths_rel2)
 
             # Encoding all the data
-            ques_encoded,attention_score = self.encoder_q(tu.trim(ques))
-            path_encoded = self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+            ques_encoded, attention_score = self.encode_question(ques)
+            path_encoded = self.cached_encode_chains(paths_rel1, paths_rel2)
 
             # Pass them to the comparison module
             score = torch.sum(ques_encoded * path_encoded, dim=-1)
 
-            self.encoder_q.train()
-            self.encoder_p.train()
+            self.resume_training(self.encoder_q, self.encoder_p)
             if attention_value:
                 return score,attention_score
             else:
@@ -2099,6 +2318,8 @@ class QelosSlotPointerModelOrthogonalEntity(Model):
     """
         Eating Denis's shit
     """
+
+    broadcast_question = True
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -2217,9 +2438,29 @@ class QelosSlotPointerModelOrthogonalEntity(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, 2*dim), attention scores over the two slots.
+        """
+        return self.encoder_q(tu.trim(ques))
+
+    def encode_chains(self, paths_rel1, paths_rel2):
+        """
+            paths_rel1, paths_rel2: (batch, seq) -> (batch, 2*dim).
+            paths_rel2 is expected to have already gone through tu.no_one_left_behind.
+        """
+        return self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+
+    def encode_relations(self, slots):
+        """
+            slots: (batch, seq) -> (batch, dim). One slot of a chain, as encoded within encode_chains.
+        """
+        return self.encoder_p.enc(slots)
+
     def predict(self, ques, paths, paths_rel1,paths_rel2, device,attention_value=False):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
         with torch.no_grad():
             self.encoder_q.eval()
@@ -2230,14 +2471,13 @@ class QelosSlotPointerModelOrthogonalEntity(Model):
             paths_rel2 = tu.no_one_left_behind(paths_rel2)
 
             # Encoding all the data
-            ques_encoded,attention_score = self.encoder_q(tu.trim(ques))
-            path_encoded = self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+            ques_encoded, attention_score = self.encode_question(ques)
+            path_encoded = self.cached_encode_chains(paths_rel1, paths_rel2)
 
             # Pass them to the comparison module
             score = torch.sum(ques_encoded * path_encoded, dim=-1)
 
-            self.encoder_q.train()
-            self.encoder_p.train()
+            self.resume_training(self.encoder_q, self.encoder_p)
             if attention_value:
                 return score,attention_score
             else:
@@ -2252,6 +2492,8 @@ class ULMFITQelosSlotPointerModel(Model):
         Eating Denis's shit
     """
 
+    broadcast_question = True
+
     def __init__(self, _parameter_dict, _word_to_id, _device, _pointwise=False, _debug=False):
 
         self.debug = _debug
@@ -2370,9 +2612,29 @@ class ULMFITQelosSlotPointerModel(Model):
 
         return loss
 
+    def encode_question(self, ques):
+        """
+            ques: (batch, seq) -> (batch, 2*dim), attention scores over the two slots.
+        """
+        return self.encoder_q(tu.trim(ques))
+
+    def encode_chains(self, paths_rel1, paths_rel2):
+        """
+            paths_rel1, paths_rel2: (batch, seq) -> (batch, 2*dim).
+            paths_rel2 is expected to have already gone through tu.no_one_left_behind.
+        """
+        return self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+
+    def encode_relations(self, slots):
+        """
+            slots: (batch, seq) -> (batch, dim). One slot of a chain, as encoded within encode_chains.
+        """
+        return self.encoder_p.enc(slots)
+
     def predict(self, ques, paths, paths_rel1, paths_rel2, device, attention_value=False):
         """
-            Same code works for both pairwise or pointwise
+            Same code works for both pairwise or pointwise.
+            ques can either be (num_paths, seq) or (1, seq) (encoded once, broadcast against paths).
         """
         with torch.no_grad():
             self.encoder_q.eval()
@@ -2383,14 +2645,13 @@ class ULMFITQelosSlotPointerModel(Model):
             paths_rel2 = tu.no_one_left_behind(paths_rel2)
 
             # Encoding all the data
-            ques_encoded, attention_score = self.encoder_q(tu.trim(ques))
-            path_encoded = self.encoder_p(tu.trim(paths_rel1), tu.trim(paths_rel2))
+            ques_encoded, attention_score = self.encode_question(ques)
+            path_encoded = self.cached_encode_chains(paths_rel1, paths_rel2)
 
             # Pass them to the comparison module
             score = torch.sum(ques_encoded * path_encoded, dim=-1)
 
-            self.encoder_q.train()
-            self.encoder_p.train()
+            self.resume_training(self.encoder_q, self.encoder_p)
             if attention_value:
                 return score, attention_score
             else:
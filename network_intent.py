@@ -259,8 +259,7 @@ class IntentClassifier(net.Model):
             # Calculating dot score
             out = self.dense(ques_batch)
 
-            self.encoder.train()
-            self.dense.train()
+            self.resume_training(self.encoder, self.dense)
 
             return out
 
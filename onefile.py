@@ -5,11 +5,13 @@ from utils import dbpedia_interface as db_interface
 from utils import embeddings_interface
 from configs import config_loader as cl
 from utils import natural_language_utilities as nlutils
+from utils.goodies import *
 import network_rdftype as net_rdftype
 import network_intent as net_intent
 import data_loader as dl
 import auxiliary as aux
 import network as net
+import encoding_cache as ec
 
 import os
 import sys
@@ -26,6 +28,8 @@ else: import ConfigParser
 COMMON_DATA_DIR = 'data/data/common'
 INTENTS = ['count', 'ask', 'list']
 RDFTYPES = ['x', 'uri', 'none']
+# Corechain models which score a path along with its two relations (slots) broken apart
+SLOTPTR_MODELS = ['slotptr', 'slotptr_common_encoder', 'slotptrortho', 'ulmfit_slotptr']
 # params for ULMFit
 # parameter_dict['intentmodel'] = 'bilstm_dense'
 # parameter_dict['intentmodelnumber'] = '16'
@@ -72,6 +76,11 @@ class QuestionAnswering:
         self._load_intentmodel()
         self.parameters['dataset'] = _dataset
 
+        # Models stay in eval mode from here on. Every forward holds its model's lock, as the server (and answer_many)
+        #   run them from several threads, and the encoding caches are shared too.
+        for model in [self.corechain_model, self.rdftype_model, self.rdfclass_model, self.intent_model]:
+            model.prepare_inference()
+
     def _load_corechain_model(self):
 
         # Initialize the model
@@ -131,9 +140,65 @@ class QuestionAnswering:
 
         self.corechain_model.load_from(model_path)
 
+        # Path encodings don't depend on the question; keep them around across questions (see encoding_cache)
+        self.path_cache_location = None
+        if self.parameters.get('path_cache_size') and hasattr(self.corechain_model, 'encode_paths'):
+            self.path_cache_location = os.path.join(os.path.dirname(model_path), 'path_encodings.pickle')
+            self.corechain_model.path_cache = ec.PathEncodingCache.load(self.path_cache_location,
+                                                                        stamp=ec.checkpoint_stamp(model_path),
+                                                                        max_size=self.parameters['path_cache_size'],
+                                                                        device=self.device)
+
+        # Same for slot pointer models, at the level of single relations
+        if self.parameters.get('relation_encoding_table') and hasattr(self.corechain_model, 'encode_relations'):
+            self.corechain_model.relation_table = self._load_relation_table(model_path)
+
         self.parameters['corechainmodel'] = m
         self.parameters['bidirectional'] = True
 
+    def _load_relation_table(self, model_path):
+        """
+            Loads the relation encodings dumped next to the checkpoint.
+            If there are none for this checkpoint, encodes every relation (with both signs) and dumps them.
+        """
+        location = os.path.join(os.path.dirname(model_path), 'relation_encodings.pickle')
+        table = ec.RelationEncodingTable.load(location, stamp=ec.checkpoint_stamp(model_path), device=self.device)
+        if len(table) == 0:
+            relations = aux.load_inverse_relation(COMMON_DATA_DIR)
+            signs = [embeddings_interface.vocabularize(['+']).tolist(), embeddings_interface.vocabularize(['-']).tolist()]
+            slots = [sign + relations[key][3].tolist() for key in relations for sign in signs]
+            table.build(self.corechain_model, slots, width=self.parameters['relsp_pad'])
+            table.save(location)
+        return table
+
+    def precompute_path_encodings(self, data, relations):
+        """
+            Offline: encodes every candidate path of the given datapoints (id_big_data.json)
+                and dumps them next to the corechain checkpoint, to be picked up by _load_corechain_model.
+
+        :param data: list of id_big_data nodes
+        :param relations: inverse relations dict (aux.load_inverse_relation)
+        :return: number of path encodings stored
+        """
+        if self.corechain_model.path_cache is None:
+            raise BadParameters('path_cache_size')
+
+        paths = []
+        for datum in data:
+            _, positive_path, negative_paths = dl.construct_paths(datum, relations=relations)
+            if positive_path.tolist() != [-1]:
+                paths.append(positive_path.tolist())
+            paths += [negative_path.tolist() for negative_path in negative_paths]
+
+        # The dump holds every path; only the in-memory copy is bounded.
+        cache = self.corechain_model.path_cache
+        cache.max_size = None
+        with self.corechain_model.lock:
+            ec.precompute_path_encodings(self.corechain_model, paths, max_length=self.parameters['rel_pad'])
+        cache.save(self.path_cache_location)
+        cache.max_size = self.parameters['path_cache_size']
+        return len(cache)
+
     def _load_rdfclass_model(self):
 
         # Initialize the model
@@ -195,10 +260,13 @@ class QuestionAnswering:
             returns score: (100/500)
         """
 
-        # Pad questions
-        Q = np.zeros((len(_p), self.parameters['max_length']))
+        # Pad questions.
+        # Models which encode the question independently of the paths get it only once,
+        #   and broadcast its encoding against all the paths.
+        num_ques = 1 if self.corechain_model.broadcast_question else len(_p)
+        Q = np.zeros((num_ques, self.parameters['max_length']))
         Q[:, :min(len(_q), self.parameters['max_length'])] = \
-            np.repeat(_q[np.newaxis, :min(len(_q), self.parameters['max_length'])], repeats=len(_p), axis=0)
+            np.repeat(_q[np.newaxis, :min(len(_q), self.parameters['max_length'])], repeats=num_ques, axis=0)
 
         # Pad paths
         P = np.zeros((len(_p), self.parameters['max_length']))
@@ -220,7 +288,7 @@ class QuestionAnswering:
             P1 = torch.tensor(P1, dtype=torch.long, device=self.device)
             P2 = torch.tensor(P2, dtype=torch.long, device=self.device)
 
-            if self.parameters['corechainmodel'] == 'slotptr':
+            if self.parameters['corechainmodel'] in SLOTPTR_MODELS:
                 P1 = P1[:,:self.parameters['relsp_pad']]
                 P2 = P2[:,:self.parameters['relsp_pad']]
             else:
@@ -234,13 +302,14 @@ class QuestionAnswering:
             # print("Q: ", Q.shape, " P: ", P.shape)
 
             # We then pass them through a predict function and get a score array.
-        if self.parameters['corechainmodel'] == 'slotptr' or self.parameters['corechainmodel'] == 'reldet':
+        if self.parameters['corechainmodel'] in SLOTPTR_MODELS or self.parameters['corechainmodel'] == 'reldet':
             # print("path rel 1 main ", P1)
             # print("path rel 2 main ", P2)
             # print("path rel 2 main ", P1.shape)
             # print("path rel 2 main ", P2.shape)
 
-            score = self.corechain_model.predict(ques=Q, paths=P, paths_rel1=P1, paths_rel2=P2, device=self.device)
+            with self.corechain_model.lock:
+                score = self.corechain_model.predict(ques=Q, paths=P, paths_rel1=P1, paths_rel2=P2, device=self.device)
             #Visual stuff.
             # score,attention_score = self.corechain_model.predict(ques=Q, paths=P, paths_rel1=P1, paths_rel2=P2, device=self.device,attention_value=True)
             # score1 = attention_score.squeeze(-1)[0, :, 0]
@@ -248,7 +317,8 @@ class QuestionAnswering:
             # return score.detach().cpu().numpy(), score1.detach().cpu().numpy(), score2.detach().cpu().numpy()
 
         else:
-            score = self.corechain_model.predict(ques=Q, paths=P, device=self.device)
+            with self.corechain_model.lock:
+                score = self.corechain_model.predict(ques=Q, paths=P, device=self.device)
         return score.detach().cpu().numpy()
 
     def _predict_rdfclass(self, _q, _p):
@@ -262,10 +332,11 @@ class QuestionAnswering:
             returns score: (100/500)
         """
 
-        # Pad questions
-        Q = np.zeros((len(_p), self.parameters['max_length']))
+        # Pad questions (see _predict_corechain)
+        num_ques = 1 if self.rdfclass_model.broadcast_question else len(_p)
+        Q = np.zeros((num_ques, self.parameters['max_length']))
         Q[:, :min(len(_q), self.parameters['max_length'])] = \
-            np.repeat(_q[np.newaxis, :min(len(_q), self.parameters['max_length'])], repeats=len(_p), axis=0)
+            np.repeat(_q[np.newaxis, :min(len(_q), self.parameters['max_length'])], repeats=num_ques, axis=0)
 
         # Pad paths
         P = np.zeros((len(_p), self.parameters['max_length']))
@@ -279,7 +350,8 @@ class QuestionAnswering:
 
         # We then pass them through a predict function and get a score array.
 
-        score = self.rdfclass_model.predict(ques=Q, paths=P, device=self.device)
+        with self.rdfclass_model.lock:
+            score = self.rdfclass_model.predict(ques=Q, paths=P, device=self.device)
 
         return score.detach().cpu().numpy()
 
@@ -299,7 +371,8 @@ class QuestionAnswering:
         data = {'ques_batch': Q.reshape(1, Q.shape[0])}
 
         # Get prediction
-        score = self.intent_model.predict(data, self.device)
+        with self.intent_model.lock:
+            score = self.intent_model.predict(data, self.device)
 
         return score.detach().cpu().numpy()
 
@@ -320,10 +393,270 @@ class QuestionAnswering:
         data = {'ques_batch': Q.reshape(1, Q.shape[0])}
 
         # Get prediction
-        score = self.rdftype_model.predict(data, self.device)
+        with self.rdftype_model.lock:
+            score = self.rdftype_model.predict(data, self.device)
 
         return score.detach().cpu().numpy()
 
+    '''
+        Batched versions of the _predict_* functions above.
+        Each takes the arguments of many calls (eg. of concurrent requests, see scheduler.MicroBatcher),
+            runs one forward for all of them, and returns the respective outputs in the same order.
+    '''
+
+    def _pad(self, seqs, length=None):
+        """
+            List of var len id sequences -> long tensor (len(seqs), max_length), optionally cut to length
+        """
+        X = np.zeros((len(seqs), self.parameters['max_length']))
+        for i, seq in enumerate(seqs):
+            X[i, :min(len(seq), self.parameters['max_length'])] = seq[:min(len(seq), self.parameters['max_length'])]
+        X = torch.tensor(X, dtype=torch.long, device=self.device)
+        return X if length is None else X[:, :length]
+
+    def _encode_question_many(self, batch):
+        """
+            batch: list of _q
+            returns: list of corechain question encodings (1, dim), which can stand in for _q in _predict_corechain_many.
+            Only for corechain models with broadcast_question.
+        """
+        with self.corechain_model.lock:
+            encoded = self.corechain_model.encode_questions(self._pad(batch))
+        return [encoded[i:i + 1] for i in range(len(batch))]
+
+    def _predict_corechain_many(self, batch):
+        """
+            batch: list of (_q, _p, _p1, _p2) as passed to _predict_corechain (_p1, _p2 can be None).
+                For broadcast_question models, _q can also be its encoding (see _encode_question_many).
+
+            returns: list of score arrays: (len(_p))
+        """
+        model, m = self.corechain_model, self.parameters['corechainmodel']
+        sizes = [len(_p) for _, _p, _, _ in batch]
+        if not sum(sizes):
+            # Nothing to score (and some encoders don't take empty batches)
+            return [np.zeros(0, dtype=np.float32) for _ in batch]
+        P = self._pad([path for _, _p, _, _ in batch for path in _p], self.parameters['rel_pad'])
+
+        if m in SLOTPTR_MODELS:
+            P1 = self._pad([path for _, _, _p1, _ in batch for path in _p1], self.parameters['relsp_pad'])
+            P2 = self._pad([path for _, _, _, _p2 in batch for path in _p2], self.parameters['relsp_pad'])
+        elif m == 'reldet':
+            P1 = self._pad([path for _, _, _p1, _ in batch for path in _p1], self.parameters['relrd_pad'])
+            P2 = self._pad([path for _, _, _, _p2 in batch for path in _p2], self.parameters['relrd_pad'])
+        else:
+            P1, P2 = None, None
+
+        if model.broadcast_question:
+            # Every question is encoded once (unless it comes encoded already, see _encode_question_many),
+            #   and its encoding is used for all its paths
+            encoded = [_q if torch.is_tensor(_q) else None for _q, _, _, _ in batch]
+            raw = [i for i in range(len(batch)) if encoded[i] is None]
+            owner = torch.tensor(np.repeat(np.arange(len(batch)), sizes), dtype=torch.long, device=self.device)
+            with model.lock:
+                if raw:
+                    fresh = model.encode_questions(self._pad([batch[i][0] for i in raw]))
+                    for j, i in enumerate(raw):
+                        encoded[i] = fresh[j:j + 1]
+                Q = torch.cat(encoded, 0)
+                score = model.predict_many(ques=Q, owner=owner, paths=P, paths_rel1=P1, paths_rel2=P2,
+                                           device=self.device, ques_encoded=True)
+        else:
+            Q = self._pad([_q for (_q, _p, _, _) in batch for _ in range(len(_p))])
+            with model.lock:
+                if m == 'reldet':
+                    score = model.predict(ques=Q, paths=P, paths_rel1=P1, paths_rel2=P2, device=self.device)
+                else:
+                    score = model.predict(ques=Q, paths=P, device=self.device)
+
+        return np.split(score.detach().cpu().numpy(), np.cumsum(sizes)[:-1])
+
+    def _predict_rdfclass_many(self, batch):
+        """
+            batch: list of (_q, _p) as passed to _predict_rdfclass
+
+            returns: list of score arrays: (len(_p))
+        """
+        sizes = [len(_p) for _, _p in batch]
+        Q = self._pad([_q for _q, _ in batch])
+        P = self._pad([path for _, _p in batch for path in _p])
+        owner = torch.tensor(np.repeat(np.arange(len(batch)), sizes), dtype=torch.long, device=self.device)
+
+        with self.rdfclass_model.lock:
+            score = self.rdfclass_model.predict_many(ques=Q, owner=owner, paths=P, device=self.device)
+
+        return np.split(score.detach().cpu().numpy(), np.cumsum(sizes)[:-1])
+
+    def _predict_intent_many(self, batch):
+        """
+            batch: list of _q as passed to _predict_intent
+
+            returns: list of np.arr shape (1, 3)
+        """
+        data = {'ques_batch': self._pad(batch).cpu().numpy()}
+        with self.intent_model.lock:
+            score = self.intent_model.predict(data, self.device).detach().cpu().numpy()
+        return [score[i:i + 1] for i in range(len(batch))]
+
+    def _predict_rdftype_many(self, batch):
+        """
+            batch: list of _q as passed to _predict_rdftype
+
+            returns: list of np.arr shape (1, 3)
+        """
+        data = {'ques_batch': self._pad(batch).cpu().numpy()}
+        with self.rdftype_model.lock:
+            score = self.rdftype_model.predict(data, self.device).detach().cpu().numpy()
+        return [score[i:i + 1] for i in range(len(batch))]
+
+    def answer_many(self, questions, dbp, subgraph_maker, entity_linker, workers=8, batch_size=None, batchers=None,
+                    relation_index=None):
+        """
+            Answers a list of questions (str) end to end, like server.answer_question, but stage by stage:
+                every stage runs for all the questions before the next one starts.
+                Entity linking, subgraph and constraint generation and fetching answers (I/O bound) run on a thread pool,
+                and model predictions are made batch_size questions at a time (see _predict_*_many).
+
+        :param questions: list of str
+        :param dbp: utils.dbpedia_interface.DBPedia
+        :param subgraph_maker: datasetPreparation.entity_subgraph.CreateSubgraph
+        :param entity_linker: fn(question: str) -> list of entity uris (eg. server.get_entities)
+        :param workers: number of threads for the I/O bound stages
+        :param batch_size: questions per forward pass. Defaults to parameters['max_batch_size']
+        :param batchers: {'corechain': scheduler.MicroBatcher, 'intent': .., 'rdftype': .., 'rdfclass': ..} over these
+            models' _predict_*_many, when some are running (eg. in server.py). The forwards are then submitted to them,
+            rather than run here alongside theirs; batch_size is theirs.
+        :param relation_index: utils.relation_index.RelationIndex, to read relations' token ids from rather than
+            labelling them live. Defaults to subgraph_maker's.
+        :return: list of graphs (same keys as server.answer_question) in the order of questions.
+            A question which failed at some stage has the graph made till then, and an 'error' key:
+                'no_entity', 'no_best_path', 'entity_server_error' or '500'.
+        """
+        # Imported here as rdf_candidates pulls in the DBpedia interface at import time.
+        from datasetPreparation import rdf_candidates as rdfc
+        from concurrent.futures import ThreadPoolExecutor
+        from utils import relation_index as ri
+
+        batch_size = batch_size or self.parameters.get('max_batch_size', 32)
+        vocabularize = lambda text: embeddings_interface.vocabularize(nlutils.tokenize(text))
+        if relation_index is None:
+            relation_index = getattr(subgraph_maker, 'relation_index', None)
+        vocabularize_relation = lambda path: ri.vocabularize_relation(path, dbp, relation_index)
+
+        graphs = [{'question': question, 'entities': [], 'best_path': [], 'intent': "", 'rdf_constraint': False,
+                   'rdf_constraint_type': '', 'rdf_best_path': '', 'answers': [], 'sparql': ''}
+                  for question in questions]
+        question_ids = [vocabularize(question) for question in questions]
+
+        def alive():
+            return [i for i in range(len(graphs)) if 'error' not in graphs[i]]
+
+        def fail(i, e, default='500'):
+            if isinstance(e, NoEntitiesFound):
+                graphs[i]['error'] = 'no_entity'
+            elif isinstance(e, NoPathsFound):
+                graphs[i]['error'] = 'no_best_path'
+            else:
+                graphs[i]['error'] = default
+
+        def in_pool(fn, indices, error='500'):
+            """ Runs fn(i) for all indices on the pool. Returns {i: output} for the ones which went through. """
+            futures = [(i, pool.submit(fn, i)) for i in indices]
+            outputs = {}
+            for i, future in futures:
+                try:
+                    outputs[i] = future.result()
+                except Exception as e:
+                    fail(i, e, error)
+            return outputs
+
+        def in_batches(name, requests):
+            """ Runs _predict_<name>_many for the requests ({i: request}), through batchers[name] if there are batchers """
+            keys = sorted(requests)
+            outputs = {}
+            if batchers is not None:
+                futures = [(i, batchers[name].submit(requests[i])) for i in keys]
+                for i, future in futures:
+                    try:
+                        outputs[i] = future.result()
+                    except Exception as e:
+                        fail(i, e)
+                return outputs
+
+            fn = getattr(self, '_predict_%s_many' % name)
+            for start in range(0, len(keys), batch_size):
+                chunk = keys[start:start + batch_size]
+                try:
+                    outputs.update(zip(chunk, fn([requests[i] for i in chunk])))
+                except Exception as e:
+                    for i in chunk:
+                        fail(i, e)
+            return outputs
+
+        def link(i):
+            entities = entity_linker(questions[i])
+            if not entities: raise NoEntitiesFound
+            graphs[i]['entities'] = entities
+
+        def subgraph(i):
+            subgraph = subgraph_maker.subgraph(graphs[i]['entities'], questions[i], {}, _use_blacklist=True, _qald=False)
+            if subgraph is None or (len(subgraph[0]) == 0 and len(subgraph[1]) == 0): raise NoPathsFound
+            paths_sf = subgraph[0] + subgraph[1]
+            return paths_sf, [[token for rel in path for token in vocabularize_relation(rel)] for path in paths_sf]
+
+        def rdf_candidates(i):
+            x_constraint, uri_constraint = rdfc.generate_rdf_candidates(path=graphs[i]['best_path'],
+                                                                        topic_entity=graphs[i]['entities'], dbp=dbp)
+            constraint_sf = x_constraint + uri_constraint
+            constraint = [vocabularize(" ".join(['x', dbp.get_label(x)])) for x in x_constraint]
+            constraint += [vocabularize(" ".join(['uri', dbp.get_label(uri)])) for uri in uri_constraint]
+            return constraint_sf, ['x'] * len(x_constraint) + ['uri'] * len(uri_constraint), constraint
+
+        def answers(i):
+            graphs[i]['sparql'] = sparql_constructor.convert_runtime(graphs[i])
+            graphs[i]['answers'] = sparql_answer(graphs[i]['sparql'], dbp)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+
+            # Entity linking, subgraphs
+            in_pool(link, alive(), error='entity_server_error')
+            candidates = in_pool(subgraph, alive())
+
+            # Core chains
+            requests = {}
+            for i in alive():
+                paths_sf, paths_id = candidates[i]
+                if self.parameters['corechainmodel'] in SLOTPTR_MODELS:
+                    paths_rel1, paths_rel2, _, _ = create_rd_sp_paths(paths_id)
+                elif self.parameters['corechainmodel'] == 'reldet':
+                    _, _, paths_rel1, paths_rel2 = create_rd_sp_paths(paths_id)
+                else:
+                    paths_rel1, paths_rel2 = None, None
+                requests[i] = (question_ids[i], paths_id, paths_rel1, paths_rel2)
+            for i, score in in_batches('corechain', requests).items():
+                graphs[i]['best_path'] = candidates[i][0][np.argmax(score)]
+
+            # Intent, rdftype
+            intents = in_batches('intent', {i: question_ids[i] for i in alive()})
+            rdftypes = in_batches('rdftype', {i: question_ids[i] for i in alive()})
+            for i in alive():
+                graphs[i]['intent'] = INTENTS[np.argmax(intents[i])]
+
+            # Rdf constraints for the ones which need them
+            needs_constraint = [i for i in alive() if RDFTYPES[np.argmax(rdftypes[i])] != 'none']
+            constraints = {i: c for i, c in in_pool(rdf_candidates, needs_constraint).items() if len(c[0]) > 0}
+            scores = in_batches('rdfclass', {i: (question_ids[i], c[2]) for i, c in constraints.items()})
+            for i, score in scores.items():
+                best = np.argmax(score)
+                graphs[i]['rdf_constraint'] = True
+                graphs[i]['rdf_constraint_type'] = constraints[i][1][best]
+                graphs[i]['rdf_best_path'] = constraints[i][0][best]
+
+            # Sparqls and their answers
+            in_pool(answers, alive())
+
+        return graphs
+
 
 def construct_paths(data, relations, gloveid_to_embeddingid, qald=False):
     """
@@ -510,7 +843,7 @@ def corechain_prediction(question, paths, positive_path, negative_paths, no_posi
             # print("paths rel1 rd are loop1 ", paths_rel1_rd)
             # print("paths rel2 rd are loop1 ", paths_rel2_rd)
             output = quesans._predict_corechain(question,paths,paths_rel1_rd,paths_rel2_rd)
-        elif model == 'slotptr':
+        elif model in SLOTPTR_MODELS:
             paths_rel1_sp, paths_rel2_sp, _, _ = create_rd_sp_paths(paths)
             output= quesans._predict_corechain(question,paths,paths_rel1_sp,paths_rel2_sp)
         else:
@@ -530,7 +863,7 @@ def corechain_prediction(question, paths, positive_path, negative_paths, no_posi
             # print("paths rel2 rd are loop1 ", paths_rel2_rd)
 
             output = quesans._predict_corechain(question,paths,paths_rel1_rd,paths_rel2_rd)
-        elif model == 'slotptr':
+        elif model in SLOTPTR_MODELS:
             paths_rel1_sp, paths_rel2_sp, _, _ = create_rd_sp_paths(paths)
             # print("paths rel1 rd are loop1 ", paths_rel1_sp)
             # print("paths rel2 rd are loop1 ", paths_rel2_sp)
@@ -717,9 +1050,9 @@ def answer_question(qa, index, data, relations, parameter_dict):
     return log, metrics
 
 
-def sparql_answer(sparql):
+def sparql_answer(sparql, _dbp=None):
     test_answer = []
-    interface_test_answer = dbp.get_answer(sparql)
+    interface_test_answer = (_dbp or dbp).get_answer(sparql)
     for key in interface_test_answer:
         test_answer = test_answer + interface_test_answer[key]
     return list(set(test_answer))
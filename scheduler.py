@@ -0,0 +1,88 @@
+'''
+    Micro batching for the models behind the server.
+
+    Concurrent requests each want a small forward pass of the same model.
+    A MicroBatcher collects whatever is submitted within a short window, makes one call for all of it
+        (one of the QuestionAnswering._predict_*_many functions), and hands every caller its own output.
+
+    Usage:
+        intent = MicroBatcher(quesans._predict_intent_many, window_ms=5, max_batch=32, name='intent')
+        score = intent(question_id)             # blocks till the batch it landed in is done
+        future = intent.submit(question_id)     # or, get a concurrent.futures.Future
+'''
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher(object):
+    """
+        run_batch: fn(list of requests) -> list of outputs (same order, same length).
+        window_ms: how long to wait for more requests after the first one arrives.
+        max_batch: a batch is run as soon as it has these many requests.
+    """
+
+    def __init__(self, run_batch, window_ms=5, max_batch=32, name=None):
+        self.run_batch = run_batch
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.name = name
+
+        # Some stats
+        self.batches, self.requests = 0, 0
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name='microbatcher-%s' % name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, request):
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def __call__(self, request):
+        return self.submit(request).result()
+
+    def _collect(self):
+        """ Blocks for the first request, then collects more till the window closes or the batch is full. """
+        batch = [self._queue.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, batch):
+        requests = [request for request, _ in batch]
+        outputs = self.run_batch(requests)
+        if len(outputs) != len(batch):
+            raise ValueError("%s returned %d outputs for %d requests" % (self.name or 'run_batch', len(outputs), len(batch)))
+        for (_, future), output in zip(batch, outputs):
+            future.set_result(output)
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            self.batches += 1
+            self.requests += len(batch)
+
+            try:
+                self._run(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+
+                # Don't let one bad request fail the others: retry them one at a time.
+                for item in batch:
+                    try:
+                        self._run([item])
+                    except Exception as e:
+                        item[1].set_exception(e)
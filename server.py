@@ -10,6 +10,7 @@
     >urls
         /answer -> returns answers to the user question
         /sparql -> returns sparql formed for the user question
+        /graph/batch -> POST {"questions": [...]}, returns a list of graphs in the same order (see QuestionAnswering.answer_many)
     >template requests code
         import requests
         question = 'What is the capital of India ?'
@@ -30,23 +31,30 @@
 
 import os
 import sys
+import time
+import heapq
+import atexit
 import json
 import math
 import torch
 import pickle
 import warnings
-import requests
 import traceback
 import numpy as np
-from bottle import get, request, run, response, HTTPError
+from bottle import get, post, request, run, response, HTTPError, ServerAdapter
 
 
 import onefile as qa
+from scheduler import MicroBatcher
 
 from datasetPreparation import rdf_candidates as rdfc
 from configs import config_loader as cl
 from datasetPreparation import entity_subgraph as es
+from datasetPreparation import neighbourhood_index as ni
+from datasetPreparation import subgraph_cache as sc
 from utils import dbpedia_interface as dbi
+from utils import http_transport as ht
+from utils import relation_index as ri
 from utils import natural_language_utilities as nlutils
 from utils.goodies import *
 from utils import embeddings_interface as ei
@@ -54,12 +62,86 @@ from utils import query_graph_to_sparql as qgts
 ei.__check_prepared__()
 
 quesans, dbp, subgraph_maker, relations, parameter_dict = None, None, None, None, None
+# One MicroBatcher per model (see start)
+batchers = {}
 
 
-# path --> 'http://dbpedia.org/property/stadium'
-vocabularize_relation = lambda path: ei.vocabularize(nlutils.tokenize(dbp.get_label(path))).tolist()
+# Precomputed token ids (and labels, label vectors) of known relations (see start)
+relation_index = None
+
+
+def vocabularize_relation(path):
+    '''
+    :param path: 'http://dbpedia.org/property/stadium' (or a sign)
+    :return: list of token ids of its label
+    '''
+    return ri.vocabularize_relation(path, dbp, relation_index)
+
+
+def vocabularize_path(path):
+    '''
+    :param path: ['+', 'http://dbpedia.org/property/stadium'] or ['+', r1, '-', r2]
+    :return: list of token ids
+    '''
+    return [token for part in path for token in vocabularize_relation(part)]
+
+
+def score_paths(question_encoded, paths):
+    '''
+        Corechain scores of the (vocabularized) paths for the question.
+        The time it takes is told to subgraph_maker, which fits the number of candidates to the budget with it.
+    '''
+    start = time.time()
+    if parameter_dict['corechainmodel'] in qa.SLOTPTR_MODELS:
+        paths_rel1_sp, paths_rel2_sp, _, _ = qa.create_rd_sp_paths(paths)
+        output = batchers['corechain']((question_encoded, paths, paths_rel1_sp, paths_rel2_sp))
+    elif parameter_dict['corechainmodel'] == 'bilstm_dot':
+        output = batchers['corechain']((question_encoded, paths, None, None))
+    else:
+        raise BadParameters('corechainmodel')
+    subgraph_maker.observe_scoring(len(paths), time.time() - start)
+    return output
+
+
+def score_stream(question_encoded, batches, deadline=None, k=10):
+    '''
+        Scores batches of candidate paths as they come (see CreateSubgraph.subgraph_stream), keeping the k best.
+        No more batches are taken after the deadline (time.time()); the ones scored till then count.
+
+    :param batches: generator of lists of paths (surface forms); closed when done
+    :return: list of (score, path), best first. Of equal scores, the path seen first.
+    '''
+    best, seen = [], 0
+    try:
+        for paths_sf in batches:
+            if not paths_sf:
+                continue
+            output = score_paths(question_encoded, [vocabularize_path(path) for path in paths_sf])
+            for score, path in zip(np.asarray(output).reshape(-1), paths_sf):
+                entry = (float(score), -seen, path)
+                seen += 1
+                if len(best) < k:
+                    heapq.heappush(best, entry)
+                elif entry[:2] > best[0][:2]:
+                    heapq.heapreplace(best, entry)
+            if deadline is not None and time.time() >= deadline:
+                break
+    finally:
+        batches.close()
+    return [(score, path) for score, _, path in sorted(best, key=lambda entry: entry[:2], reverse=True)]
 # vocabularize_specia_char = lambda char: [ei.SPECIAL_CHARACTERS.index(char)]
 
+def linker_transport():
+    '''
+        What entity linking goes through: dbp's transport when it records/replays (so that the entity linker's
+            answers are recorded/replayed along with the SPARQL ones; see utils/fixture_transport.py), else the
+            process' pooled one.
+    '''
+    if dbp is not None and dbp.mode is not None:
+        return dbp.transport
+    return ht.shared()
+
+
 def get_entities(question):
     """
         uses EARL to find all the entites present in the question.
@@ -73,8 +155,7 @@ def get_entities(question):
     # data = {"nlquery":question}
     # data = str(data)
     data = '{"nlquery":"%(p)s"}'% {"p":question}
-    response = requests.post('http://sda.tech/earl/api/processQuery', headers=headers, data=data)
-    a = json.loads(response.content)
+    a = linker_transport().post_json('http://sda.tech/earl/api/processQuery', headers=headers, data=data)
     entity_list = []
     for i in range(len(a['ertypes'])):
         if a['ertypes'][i] == 'entity':
@@ -84,6 +165,21 @@ def get_entities(question):
 
 
 
+class ThreadedWSGIRefServer(ServerAdapter):
+    """
+        Bottle's default (wsgiref) server handles one request at a time.
+        Concurrent requests are what the batchers feed on, so here's one with a thread per request.
+    """
+    def run(self, app):
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import make_server, WSGIServer
+
+        class _ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        make_server(self.host, self.port, app, server_class=_ThreadedWSGIServer, **self.options).serve_forever()
+
+
 def start():
     '''
         Pulls the parameters from disk
@@ -95,10 +191,10 @@ def start():
         CHANGE MAJOR CONFIGS HERE
     :return:
     '''
-    global quesans, dbp, subgraph_maker, relations, parameter_dict
+    global quesans, dbp, subgraph_maker, relations, parameter_dict, relation_index
 
     device =  torch.device("cpu")
-    dbp = dbi.DBPedia(caching=False)
+    dbp = dbi.DBPedia(caching=False, local_caching=True, health_check_interval=30)
 
     training_config = False
     training_model = "bilstm_dot"
@@ -106,11 +202,31 @@ def start():
     predicate_blacklist = open('resources/predicate.blacklist').readlines()
     predicate_blacklist[-1] = predicate_blacklist[-1] + '\n'
     predicate_blacklist = [r[:-1] for r in predicate_blacklist]
-    subgraph_maker = es.CreateSubgraph(dbp, predicate_blacklist, {}, qald=False)
 
     # Preparing configs
     parameter_dict = cl.runtime_parameters(dataset='lcquad', training_model=training_model,
                                            training_config=training_config, config_file='configs/macros.cfg')
+
+    neighbourhood_index = None
+    if parameter_dict['neighbourhood_index'] and os.path.exists(parameter_dict['neighbourhood_index']):
+        neighbourhood_index = ni.NeighbourhoodIndex(parameter_dict['neighbourhood_index'])
+    elif parameter_dict['neighbourhood_index']:
+        warnings.warn("Neighbourhood index %s not found. Every subgraph will be fetched from DBpedia."
+                      % parameter_dict['neighbourhood_index'])
+    relation_index_location = os.path.join(qa.COMMON_DATA_DIR, 'relation_index')
+    if os.path.exists(os.path.join(relation_index_location, 'meta.json')):
+        relation_index = ri.RelationIndex(relation_index_location)
+    else:
+        warnings.warn("Relation index %s not found (see data_creator_step2.py). Relations will be vocabularized "
+                      "on every request." % relation_index_location)
+    subgraph_cache = None
+    if parameter_dict['subgraph_cache']:
+        subgraph_cache = sc.SubgraphCache.load(parameter_dict['subgraph_cache'], parameter_dict['subgraph_cache_bytes'])
+        nlutils.create_dir(os.path.dirname(parameter_dict['subgraph_cache']))
+        atexit.register(subgraph_cache.save, parameter_dict['subgraph_cache'])
+    subgraph_maker = es.CreateSubgraph(dbp, predicate_blacklist, {}, qald=False,
+                                       neighbourhood_index=neighbourhood_index, relation_index=relation_index,
+                                       subgraph_cache=subgraph_cache)
     parameter_dict['_dataset_specific_data_dir'] = qa._dataset_specific_data_dir
     parameter_dict['_model_dir'] = './data/models/'
 
@@ -132,9 +248,19 @@ def start():
     relations = pickle.load(open(os.path.join(qa.COMMON_DATA_DIR,'relations.pickle'),'rb'),encoding='bytes')
 
     quesans = qa.QuestionAnswering(parameters=parameter_dict, pointwise=training_config,
-                                        word_to_id=None, device=device, debug=False)
+                                        word_to_id=None, device=device, _dataset='lcquad', debug=False)
 
-    run(host=URL, port=PORT)
+    # Concurrent requests share the forward passes of every model
+    for name, fn in [('corechain', quesans._predict_corechain_many), ('intent', quesans._predict_intent_many),
+                     ('rdftype', quesans._predict_rdftype_many), ('rdfclass', quesans._predict_rdfclass_many)]:
+        batchers[name] = MicroBatcher(fn, window_ms=parameter_dict['batch_window_ms'],
+                                      max_batch=parameter_dict['max_batch_size'], name=name)
+    # Corechain models which encode the question on its own can do so before the paths come in
+    if quesans.corechain_model.broadcast_question:
+        batchers['question'] = MicroBatcher(quesans._encode_question_many, window_ms=parameter_dict['batch_window_ms'],
+                                            max_batch=parameter_dict['max_batch_size'], name='question')
+
+    run(host=URL, port=PORT, server=ThreadedWSGIRefServer)
 
 
 def answer_question(question):
@@ -157,80 +283,82 @@ def answer_question(question):
         'rdf_constraint_type':'',
         'rdf_best_path':'',
         'answers':[],
-        'sparql':''
+        'sparql':'',
+        'candidate_limits':None
     }
 
     # @TODO: put in type checks if needed here.
     question_id = ei.vocabularize(nlutils.tokenize(question))
 
+    '''
+        The stages form a graph:
+            entities -> subgraph -> corechain -> rdf constraints -> sparql -> answers
+            intent, rdftype, question encoding ----^
+        The ones which only need the question are submitted right away and run on the batchers' threads
+            while we link entities and fetch the subgraph here.
+    '''
+    intent_future = batchers['intent'].submit(question_id)
+    rdftype_future = batchers['rdftype'].submit(question_id)
+    question_future = batchers['question'].submit(question_id) if 'question' in batchers else None
+
     entities = get_entities(question)
     _graph['entities'] = entities
 
     if not entities: raise NoEntitiesFound
 
-    hop1, hop2 = subgraph_maker.subgraph(entities, question, {}, _use_blacklist=True, _qald=False)
-    if len(hop1) == 0 and len(hop2) == 0: raise NoPathsFound
-
+    # How many candidates are fetched and scored is fit to the budget (see CreateSubgraph.subgraph)
+    deadline = time.time() + parameter_dict['candidate_budget_ms'] / 1000.0 \
+        if parameter_dict['candidate_budget_ms'] else None
+
+    if parameter_dict['stream_candidates']:
+        # Score the 1-hop paths (and every 2-hop expansion) while the rest of the subgraph is being fetched
+        batches = subgraph_maker.subgraph_stream(entities, question, _use_blacklist=True, _qald=False,
+                                                 _deadline=deadline)
+        question_encoded = question_future.result() if question_future is not None else question_id
+        best = score_stream(question_encoded, batches, deadline=deadline, k=parameter_dict['candidate_top_k'])
+        _graph['candidate_limits'] = subgraph_maker.last_limits
+        if not best: raise NoPathsFound
+        best_path_sf = best[0][1]
+    else:
+        subgraph = subgraph_maker.subgraph(entities, question, {}, _use_blacklist=True, _qald=False,
+                                           _deadline=deadline)
+        _graph['candidate_limits'] = subgraph_maker.last_limits
+        if subgraph is None or (len(subgraph[0]) == 0 and len(subgraph[1]) == 0): raise NoPathsFound
+        hop1, hop2 = subgraph
 
+        paths = [vocabularize_path(path) for path in hop1 + hop2]
+        paths_sf = hop1+hop2
 
-    _hop1 = [vocabularize_relation(h[0])+vocabularize_relation(h[1]) for h in hop1]
-    _hop2 = [vocabularize_relation(h[0])+vocabularize_relation(h[1])+
-             vocabularize_relation(h[2])+vocabularize_relation(h[3]) for h in hop2]
-    paths = _hop1+ _hop2
-    paths_sf = hop1+hop2
+        # The question is (most likely) encoded by now
+        question_encoded = question_future.result() if question_future is not None else question_id
 
-    if parameter_dict['corechainmodel'] == 'slotptr':
-        paths_rel1_sp, paths_rel2_sp, _, _ = qa.create_rd_sp_paths(paths)
-        output = quesans._predict_corechain(question_id, paths, paths_rel1_sp, paths_rel2_sp)
-    elif parameter_dict['corechainmodel'] == 'bilstm_dot':
-        output = quesans._predict_corechain(question_id, np.asarray(paths))
-    else:
-        raise BadParameters('corechainmodel')
+        output = score_paths(question_encoded, paths)
+        best_path_index = np.argmax(output)
+        best_path_sf = paths_sf[best_path_index]
 
-    best_path_index = np.argmax(output)
-    best_path_sf = paths_sf[best_path_index]
-    # # ##############################################
-    # """
-    #     Intent, rdftype prediction
-    #
-    #     Straightforward.
-    #
-    #     Metrics: accuracy
-    # """
-    # # ##############################################
-    # # Get intent
-    intent_pred = np.argmax(quesans._predict_intent(question_id))
-    rdftype_pred = np.argmax(quesans._predict_rdftype(question_id))
-    intent = qa.INTENTS[intent_pred]
-    rdftype = qa.RDFTYPES[rdftype_pred]
+    # Intent, rdftype: done alongside everything above
+    intent = qa.INTENTS[np.argmax(intent_future.result())]
+    rdftype = qa.RDFTYPES[np.argmax(rdftype_future.result())]
 
     _graph['best_path'] = best_path_sf
     _graph['intent'] = intent
 
-
-
     if rdftype != 'none':
-        _graph['rdf_constraint'] = True
         x_constraint,uri_constraint = rdfc.generate_rdf_candidates(path=best_path_sf,topic_entity=entities,dbp=dbp)
         constraint_sf = x_constraint+uri_constraint
-        x_constraint = [ei.vocabularize(nlutils.tokenize(" ".join(['x',dbp.get_label(x)]))) for x in x_constraint]
-        uri_constraint = [ei.vocabularize(nlutils.tokenize(" ".join(['uri',dbp.get_label(uri)]))) for uri in uri_constraint]
-        constraint = x_constraint+uri_constraint
-        constraint_output_index = np.argmax(quesans._predict_rdfclass(question_id,constraint))
-        constraint_output_sf = constraint_sf[constraint_output_index]
-        if constraint[constraint_output_index][0] == 'x':
-            _graph['rdf_constraint_type'] = 'x'
-            _graph['rdf_best_path'] = constraint_output_sf
-        else:
-            _graph['rdf_constraint_type'] = 'uri'
-            _graph['rdf_best_path'] = constraint_output_sf
-
+        constraint = [ei.vocabularize(nlutils.tokenize(" ".join(['x',dbp.get_label(x)]))) for x in x_constraint]
+        constraint += [ei.vocabularize(nlutils.tokenize(" ".join(['uri',dbp.get_label(uri)]))) for uri in uri_constraint]
+        if constraint:
+            _graph['rdf_constraint'] = True
+            constraint_output_index = np.argmax(batchers['rdfclass']((question_id, constraint)))
+            _graph['rdf_constraint_type'] = 'x' if constraint_output_index < len(x_constraint) else 'uri'
+            _graph['rdf_best_path'] = constraint_sf[constraint_output_index]
 
     sparql = qgts.convert_runtime(_graph)
     _graph['sparql'] = sparql
 
     #@TODO: handle error
-    answers = qa.sparql_answer(sparql)
+    answers = qa.sparql_answer(sparql, dbp)
     _graph['answers'] = answers
 
 
@@ -247,6 +375,21 @@ def answer():
         raise HTTPError(500, 'Internal Server Error')
 
 
+@post('/graph/batch')
+def answer_batch():
+    try:
+        questions = request.json['questions']
+    except (TypeError, KeyError):
+        raise HTTPError(400, 'Expected {"questions": [...]}')
+    try:
+        # Forwards go through the batchers, which own the models
+        _graphs = quesans.answer_many(questions, dbp=dbp, subgraph_maker=subgraph_maker, entity_linker=get_entities,
+                                      batchers=batchers, relation_index=relation_index)
+        return json.dumps(_graphs)
+    except:
+        raise HTTPError(500, 'Internal Server Error')
+
+
 
 
 
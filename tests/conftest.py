@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the repo's modules the way its scripts do: utils.x, datasetPreparation.x, scheduler, ..
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
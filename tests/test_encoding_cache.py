@@ -0,0 +1,97 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import encoding_cache as ec
+
+
+class FakeModel:
+    """ Encodes a path as (sum, max) of its token ids, counting the rows it is asked to encode """
+    device = torch.device('cpu')
+
+    def __init__(self, path_cache=None):
+        self.path_cache = path_cache
+        self.encoded = []
+
+    def encode_paths(self, P):
+        self.encoded.append(P.shape[0])
+        P = P.float()
+        return torch.stack([P.sum(1), P.max(1)[0]], 1)
+
+    encode_relations = encode_paths
+
+    def prepare_save(self):
+        return []
+
+    def resume_training(self, *modules):
+        pass
+
+
+def test_path_key_ignores_padding():
+    assert ec.path_key([3, 4, 0, 0]) == ec.path_key(torch.tensor([3, 4, 0])) == (3, 4)
+
+
+def test_encode_paths_cached():
+    model = FakeModel(ec.PathEncodingCache(stamp='x'))
+    first = ec.encode_paths_cached(model, torch.tensor([[1, 2, 0], [3, 0, 0], [1, 2, 0]]))
+    assert first.tolist() == [[3, 2], [3, 3], [3, 2]]
+    # Duplicates encoded once
+    assert model.encoded == [2]
+
+    second = ec.encode_paths_cached(model, torch.tensor([[3, 0, 0], [5, 0, 0]]))
+    assert second.tolist() == [[3, 3], [5, 5]]
+    assert model.encoded == [2, 1] and model.path_cache.hits == 1
+
+
+def test_encode_no_paths():
+    model = FakeModel(ec.PathEncodingCache(stamp='x'))
+    assert ec.encode_paths_cached(model, torch.zeros((0, 3), dtype=torch.long)).shape == (0, 0)
+    ec.encode_paths_cached(model, torch.tensor([[1, 2, 0]]))
+    assert ec.encode_paths_cached(model, torch.zeros((0, 3), dtype=torch.long)).shape == (0, 2)
+
+
+def test_lru_and_save_load(tmp_path):
+    location = str(tmp_path / 'paths.pickle')
+    cache = ec.PathEncodingCache(stamp='x', max_size=2)
+    for key in [(1,), (2,), (3,)]:
+        cache.put(key, torch.tensor([float(key[0]), 0.0]))
+    assert (1,) not in cache and len(cache) == 2
+    cache.save(location)
+
+    loaded = ec.PathEncodingCache.load(location, stamp='x', max_size=1)
+    assert len(loaded) == 1 and loaded.get((3,)).tolist() == [3.0, 0.0]
+    with pytest.warns(UserWarning):
+        assert len(ec.PathEncodingCache.load(location, stamp='retrained')) == 0
+    assert len(ec.PathEncodingCache.load(str(tmp_path / 'missing.pickle'), stamp='x')) == 0
+
+
+def test_precompute_path_encodings():
+    model = FakeModel(ec.PathEncodingCache(stamp='x'))
+    ec.precompute_path_encodings(model, [[1, 2, 7], [1, 2, 9], [4]], max_length=2, batch_size=1)
+    assert len(model.path_cache) == 2 and model.path_cache.get((1, 2)).tolist() == [3, 2]
+    assert model.encoded == [1, 1]
+
+
+def test_relation_table_encode_chains():
+    model = FakeModel()
+    table = ec.RelationEncodingTable(stamp='x')
+    encoded = table.encode_chains(model, torch.tensor([[1, 0], [2, 0]]), torch.tensor([[2, 0], [3, 0]]))
+    assert encoded.tolist() == [[1, 1, 2, 2], [2, 2, 3, 3]]
+    # Only the slots unseen so far are encoded
+    assert len(table) == 3 and model.encoded == [2, 1]
+    table.encode_chains(model, torch.tensor([[3, 0]]), torch.tensor([[1, 0]]))
+    assert model.encoded == [2, 1]
+
+
+def test_relation_table_build_save_load(tmp_path):
+    location = str(tmp_path / 'relations.pickle')
+    model = FakeModel()
+    table = ec.RelationEncodingTable(stamp='x')
+    table.build(model, [[2, 5], [2, 6], [2, 5], [3, 5, 8]], width=2, batch_size=2)
+    assert len(table) == 3 and model.encoded == [2, 1]
+    table.save(location)
+
+    loaded = ec.RelationEncodingTable.load(location, stamp='x')
+    assert loaded.index == table.index and torch.equal(loaded.encodings, table.encodings)
+    with pytest.warns(UserWarning):
+        assert len(ec.RelationEncodingTable.load(location, stamp='retrained')) == 0
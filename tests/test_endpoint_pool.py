@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from utils import endpoint_pool as ep
+
+
+class Unavailable(Exception):
+    pass
+
+
+class MalformedQuery(Exception):
+    pass
+
+
+def fail(pool):
+    with pytest.raises(Unavailable):
+        with pool.request():
+            raise Unavailable()
+
+
+def test_round_robin():
+    pool = ep.EndpointPool(['a', 'b', 'c'], method='round-robin')
+    assert [pool.select() for _ in range(4)] == ['a', 'b', 'c', 'a']
+
+
+def test_circuit_opens_after_max_failures():
+    pool = ep.EndpointPool(['a', 'b'], method='select-one', max_failures=2, cooldown=60)
+    with pytest.warns(UserWarning):
+        fail(pool)
+        fail(pool)
+    assert pool.select() == 'b'
+    stats = pool.stats()
+    assert stats['a']['ejected'] and stats['a']['failures'] == 2 and stats['a']['outstanding'] == 0
+
+
+def test_circuit_half_open_lets_one_trial_through(monkeypatch):
+    pool = ep.EndpointPool(['a'], max_failures=1, cooldown=10, fail_fast=True)
+    with pytest.warns(UserWarning):
+        fail(pool)
+    with pytest.raises(ep.EndpointsUnavailable):
+        pool.select()
+    assert pool.stats()['rejected'] == 1
+
+    # Cooldown over: a single trial request is admitted ..
+    later = time.time() + 11
+    monkeypatch.setattr(ep.time, 'time', lambda: later)
+    with pool.request() as url:
+        assert url == 'a'
+        with pytest.raises(ep.EndpointsUnavailable):
+            pool.select()
+    # .. and closes the circuit as it succeeded
+    with pool.request() as url:
+        assert url == 'a'
+    assert pool.endpoints[0].consecutive_failures == 0
+
+
+def test_all_open_without_fail_fast_uses_first_back():
+    pool = ep.EndpointPool(['a', 'b'], max_failures=1, cooldown=60)
+    with pytest.warns(UserWarning):
+        fail(pool)
+        fail(pool)
+    assert pool.select() == 'a'
+
+
+def test_errors_not_held_against_endpoint():
+    pool = ep.EndpointPool(['a'], max_failures=1, is_failure=lambda e: not isinstance(e, MalformedQuery))
+    with pytest.raises(MalformedQuery):
+        with pool.request():
+            raise MalformedQuery()
+    assert pool.stats()['a']['failures'] == 0 and not pool.stats()['a']['ejected']
+
+
+def test_outstanding_released_when_block_abandoned():
+    pool = ep.EndpointPool(['a'])
+
+    def stream():
+        with pool.request() as url:
+            yield url
+            yield url
+
+    consumer = stream()
+    next(consumer)
+    assert pool.stats()['a']['outstanding'] == 1
+    consumer.close()
+    stats = pool.stats()['a']
+    assert stats['outstanding'] == 0 and stats['requests'] == 0 and stats['failures'] == 0
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from utils import fixture_transport as ft
+
+QUERY = 'SELECT DISTINCT ?p WHERE { <http://dbpedia.org/resource/Berlin> ?p ?o }'
+RESPONSE = {'head': {'vars': ['p']},
+            'results': {'bindings': [{'p': {'type': 'uri', 'value': 'http://dbpedia.org/ontology/country'}}]}}
+
+
+EARL = 'http://sda.tech/earl/api/processQuery'
+LINKED = {'ertypes': ['entity'], 'rerankedlists': {'0': [[1.0, 'http://dbpedia.org/resource/Berlin']]}}
+
+
+class FakeTransport:
+    def __init__(self):
+        self.queries = []
+        self.posts = []
+
+    def mount(self, prefix, pool_maxsize=None):
+        pass
+
+    def sparql(self, endpoint, query, timeout=None):
+        self.queries.append(query)
+        return RESPONSE
+
+    def post_json(self, url, data=None, headers=None, timeout=None):
+        self.posts.append((url, data))
+        return LINKED
+
+
+def test_record_then_replay(tmp_path):
+    location = str(tmp_path / 'fixtures.sqlite')
+    http = FakeTransport()
+    recording = ft.wrap(http, 'record', location)
+    assert recording.sparql('http://dbpedia.org/sparql', QUERY) == RESPONSE
+    assert http.queries == [QUERY]
+
+    replay = ft.wrap(None, 'replay', location)
+    response = replay.sparql('http://dbpedia.org/sparql', QUERY)
+    assert response['results']['bindings'] == [{'p': {'value': 'http://dbpedia.org/ontology/country'}}]
+    assert asyncio.run(replay.asparql('http://dbpedia.org/sparql', QUERY)) == response
+    assert len(replay.store) == 1
+
+
+def test_replay_miss(tmp_path):
+    replay = ft.wrap(None, 'replay', str(tmp_path / 'fixtures.sqlite'))
+    with pytest.raises(ft.FixtureMissing):
+        replay.sparql('http://dbpedia.org/sparql', QUERY)
+    with pytest.raises(KeyError):
+        asyncio.run(replay.asparql('http://dbpedia.org/sparql', QUERY))
+    assert replay.store.stats() == {'hits': 0, 'misses': 2}
+
+
+def test_injected_latency(tmp_path, monkeypatch):
+    store = ft.FixtureStore(str(tmp_path / 'fixtures.sqlite'))
+    store.record(QUERY, RESPONSE, 0.25)
+    slept = []
+    monkeypatch.setattr(ft.time, 'sleep', slept.append)
+    for latency in (None, 'recorded', 0.1, lambda: 0.5):
+        ft.ReplayTransport(store, latency).sparql('http://dbpedia.org/sparql', QUERY)
+    assert slept == [0.25, 0.1, 0.5]
+
+
+def test_mode_checked(tmp_path):
+    http = FakeTransport()
+    assert ft.wrap(http, None, str(tmp_path / 'fixtures.sqlite')) is http
+    with pytest.raises(ValueError):
+        ft.wrap(http, 'playback', str(tmp_path / 'fixtures.sqlite'))
+
+
+def test_record_then_replay_posts(tmp_path):
+    location = str(tmp_path / 'fixtures.sqlite')
+    http = FakeTransport()
+    data = '{"nlquery":"Where is Berlin?"}'
+    assert ft.wrap(http, 'record', location).post_json(EARL, data=data) == LINKED
+    assert http.posts == [(EARL, data)]
+
+    replay = ft.wrap(None, 'replay', location)
+    assert replay.post_json(EARL, data=data, headers={'Content-Type': 'application/json'}) == LINKED
+    # Another question, or the same text sent as a SPARQL query, wasn't recorded
+    with pytest.raises(ft.FixtureMissing):
+        replay.post_json(EARL, data='{"nlquery":"Where is Paris?"}')
+    with pytest.raises(ft.FixtureMissing):
+        replay.sparql('http://dbpedia.org/sparql', data)
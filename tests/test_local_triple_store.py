@@ -0,0 +1,86 @@
+import gzip
+
+import pytest
+
+from utils import local_triple_store as lts
+
+TRIPLES = '''
+<http://dbpedia.org/resource/Berlin> <http://dbpedia.org/ontology/country> <http://dbpedia.org/resource/Germany> .
+<http://dbpedia.org/resource/Berlin> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://dbpedia.org/ontology/City> .
+<http://dbpedia.org/resource/Berlin> <http://www.w3.org/2000/01/rdf-schema#label> "Berlin"@en .
+<http://dbpedia.org/resource/Berlin> <http://www.w3.org/2000/01/rdf-schema#label> "Berlino"@it .
+<http://dbpedia.org/resource/Hamburg> <http://dbpedia.org/ontology/country> <http://dbpedia.org/resource/Germany> .
+<http://dbpedia.org/resource/Germany> <http://dbpedia.org/ontology/leader> <http://dbpedia.org/resource/Olaf_Scholz> .
+<http://dbpedia.org/resource/Germany> <http://dbpedia.org/property/population> "83190556"^^<http://www.w3.org/2001/XMLSchema#integer> .
+<http://dbpedia.org/ontology/City> <http://www.w3.org/2000/01/rdf-schema#subClassOf> <http://dbpedia.org/ontology/Settlement> .
+<http://dbpedia.org/ontology/Settlement> <http://www.w3.org/2000/01/rdf-schema#subClassOf> <http://dbpedia.org/ontology/Place> .
+this line is not a triple
+'''
+
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    location = str(tmp_path_factory.mktemp('triples') / 'subset.nt.gz')
+    with gzip.open(location, 'wt', encoding='utf-8') as f:
+        f.write(TRIPLES)
+    return lts.LocalTripleStore.from_files([location])
+
+
+def values(response, var):
+    return sorted(binding[var]['value'] for binding in response['results']['bindings'] if var in binding)
+
+
+def test_load_skips_malformed_lines(store):
+    assert len(store) == 9
+
+
+def test_select_with_prefixes_and_distinct(store):
+    response = store.sparql('http://dbpedia.org/sparql',
+                            'PREFIX dbo: <http://dbpedia.org/ontology/> '
+                            'SELECT DISTINCT ?city WHERE { ?city dbo:country dbr:Germany . ?city a dbo:City }')
+    assert response['head']['vars'] == ['city']
+    assert values(response, 'city') == ['http://dbpedia.org/resource/Berlin']
+
+
+def test_right_and_left_properties(store):
+    # As DBPedia.get_properties asks for them
+    right = store.query('SELECT DISTINCT ?p WHERE { <http://dbpedia.org/resource/Germany> ?p ?o . }')
+    left = store.query('SELECT DISTINCT ?p WHERE { ?s ?p <http://dbpedia.org/resource/Germany> . }')
+    assert values(right, 'p') == ['http://dbpedia.org/ontology/leader', 'http://dbpedia.org/property/population']
+    assert values(left, 'p') == ['http://dbpedia.org/ontology/country']
+
+
+def test_union_optional_filter(store):
+    response = store.query('SELECT ?s ?leader WHERE { { ?s dbo:country ?c } UNION { ?s dbo:leader ?x } '
+                           'OPTIONAL { ?s dbo:leader ?leader } FILTER (?s != dbr:Hamburg) }')
+    assert values(response, 's') == ['http://dbpedia.org/resource/Berlin', 'http://dbpedia.org/resource/Germany']
+    assert values(response, 'leader') == ['http://dbpedia.org/resource/Olaf_Scholz']
+
+
+def test_language_tags(store):
+    response = store.query('SELECT ?label WHERE { dbr:Berlin rdfs:label ?label . FILTER (lang(?label) = "en") }')
+    assert response['results']['bindings'] == [{'label': {'type': 'literal', 'value': 'Berlin', 'xml:lang': 'en'}}]
+    assert store.query('ASK { dbr:Berlin rdfs:label "Berlin"@en }')['boolean']
+    assert not store.query('ASK { dbr:Berlin rdfs:label "Berlin"@de }')['boolean']
+    assert not store.query('ASK { dbr:Berlin rdfs:label "Berlin" }')['boolean']
+
+
+def test_count_paths_values_and_paging(store):
+    count = store.query('SELECT (COUNT(DISTINCT ?s) AS ?n) WHERE { ?s dbo:country dbr:Germany }')
+    assert count['results']['bindings'][0]['n']['value'] == '2'
+    path = store.query('SELECT ?c WHERE { dbo:City rdfs:subClassOf+ ?c }')
+    assert values(path, 'c') == ['http://dbpedia.org/ontology/Place', 'http://dbpedia.org/ontology/Settlement']
+    pinned = store.query('SELECT ?s WHERE { VALUES ?s { dbr:Hamburg dbr:Paris } ?s dbo:country ?c }')
+    assert values(pinned, 's') == ['http://dbpedia.org/resource/Hamburg']
+    pages = [store.query('SELECT ?s ?p ?o WHERE { ?s ?p ?o } LIMIT 4 OFFSET %d' % offset)['results']['bindings']
+             for offset in (0, 4, 8)]
+    assert [len(page) for page in pages] == [4, 4, 1]
+    assert store.query('SELECT ?o WHERE { dbr:Germany dbp:population ?o }')['results']['bindings'][0]['o'] == \
+        {'type': 'literal', 'value': '83190556'}
+
+
+def test_unsupported_query(store):
+    with pytest.raises(lts.UnsupportedQuery):
+        store.query('SELECT ?s WHERE { ?s ?p ?o } ORDER BY ?s')
+    with pytest.raises(lts.UnsupportedQuery):
+        store.query('SELECT ?o WHERE { ?s rdfs:subClassOf* ?o }')
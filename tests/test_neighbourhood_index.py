@@ -0,0 +1,60 @@
+import pytest
+
+from datasetPreparation import neighbourhood_index as ni
+
+DBO = 'http://dbpedia.org/ontology/'
+BERLIN, PARIS, BROKEN = 'http://dbpedia.org/resource/Berlin', 'http://dbpedia.org/resource/Paris', \
+    'http://dbpedia.org/resource/Broken'
+
+
+class FakeDBPedia:
+    """ The two calls fetch_neighbourhood makes, answering like utils.dbpedia_interface.DBPedia (bytes) """
+
+    GRAPH = {BERLIN: ([DBO + 'country', DBO + 'leader'], [DBO + 'capital']),
+             PARIS: ([DBO + 'country'], [])}
+
+    def __init__(self):
+        self.batches = []
+
+    def get_properties(self, _uri, label=False):
+        if _uri == BROKEN:
+            raise IOError('endpoint down')
+        right, left = self.GRAPH[_uri]
+        return [p.encode('utf-8') for p in right], [p.encode('utf-8') for p in left]
+
+    def get_hop2_subgraph_batch(self, _uri, predicates, right=True):
+        self.batches.append(len(predicates))
+        return {p: ([(p + '/right').encode('utf-8')], [(p + '/left').encode('utf-8')]) for p in predicates}
+
+
+def test_build_and_get(tmp_path):
+    location = str(tmp_path / 'index.bin')
+    dbp = FakeDBPedia()
+    assert ni.build([BERLIN, '<%s>' % PARIS, BERLIN, BROKEN], dbp, location, workers=2) == 2
+
+    index = ni.NeighbourhoodIndex(location)
+    try:
+        assert len(index) == 2 and BERLIN in index and '<%s>' % PARIS in index and BROKEN not in index
+        neighbourhood = index.get('<%s>' % BERLIN)
+        assert sorted(neighbourhood.right) == [DBO + 'country', DBO + 'leader']
+        assert neighbourhood.left == [DBO + 'capital']
+        assert neighbourhood.hop2_right[DBO + 'leader'] == ([DBO + 'leader/right'], [DBO + 'leader/left'])
+        assert neighbourhood.hop2_left[DBO + 'capital'] == ([DBO + 'capital/right'], [DBO + 'capital/left'])
+        assert index.get(PARIS).left == [] and index.get(PARIS).hop2_left == {}
+        assert index.get('http://dbpedia.org/resource/Rome') is None
+        assert index.stats() == {'entities': 2, 'hits': 3, 'misses': 1}
+    finally:
+        index.close()
+
+
+def test_hop2_fetched_in_batches():
+    dbp = FakeDBPedia()
+    ni.fetch_neighbourhood(BERLIN, dbp, hop2_batch_size=1)
+    assert dbp.batches == [1, 1, 1]
+
+
+def test_not_an_index(tmp_path):
+    location = tmp_path / 'index.bin'
+    location.write_bytes(b'not an index at all, but long enough to be mapped')
+    with pytest.raises(ValueError):
+        ni.NeighbourhoodIndex(str(location))
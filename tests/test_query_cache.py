@@ -0,0 +1,165 @@
+import threading
+import asyncio
+
+from utils import query_cache as qc
+
+RESPONSE = {'head': {'vars': ['p', 'o']},
+            'results': {'bindings': [{'p': {'type': 'uri', 'value': 'http://dbpedia.org/ontology/birthPlace'},
+                                      'o': {'type': 'literal', 'xml:lang': 'en', 'value': 'Berlin'}},
+                                     {'p': {'type': 'uri', 'value': 'http://dbpedia.org/ontology/spouse'}}]}}
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_evicts_least_recently_used():
+    cache = qc.LRUCache(max_entries=2)
+    cache.set('a', 1, 1)
+    cache.set('b', 2, 1)
+    assert cache.get('a') == 1
+    cache.set('c', 3, 1)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_bounded_by_bytes():
+    cache = qc.LRUCache(max_bytes=10)
+    cache.set('a', 1, 6)
+    cache.set('b', 2, 6)
+    assert cache.get('a') is None and cache.get('b') == 2
+    # Too big to be cached at all
+    cache.set('c', 3, 11)
+    assert cache.get('c') is None
+    # Replacing an entry doesn't count it twice
+    cache.set('b', 4, 6)
+    assert cache.stats()['bytes'] == 6
+
+
+def test_lru_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(qc.time, 'time', clock)
+    cache = qc.LRUCache(ttl=10)
+    cache.set('a', 1, 1)
+    clock.now += 5
+    assert cache.get('a') == 1
+    clock.now += 6
+    assert cache.get('a') is None
+    assert len(cache) == 0 and cache.stats()['bytes'] == 0
+
+
+def test_project_and_encoding_round_trip():
+    projected = qc.project(RESPONSE)
+    assert projected['results']['bindings'][0]['o'] == {'value': 'Berlin'}
+    assert qc.decode(qc.encode(projected)) == projected
+    assert qc.decode(qc.encode(qc.project({'head': {}, 'boolean': True}))) == {'boolean': True}
+
+
+def test_sqlite_cache(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(qc.time, 'time', clock)
+    cache = qc.SQLiteCache(str(tmp_path / 'cache' / 'sparql.db'), ttl=10)
+    cache.set('k', b'value')
+    assert cache.get('k') == b'value' and cache.get('missing') is None
+    # Another process (connection) sees it
+    assert qc.SQLiteCache(cache.location).get('k') == b'value'
+    clock.now += 11
+    assert cache.get('k') is None
+    cache.purge()
+    assert cache.stats() == {'hits': 1, 'misses': 2}
+
+
+def test_query_cache_promotes_shared_hits(tmp_path):
+    shared = qc.SQLiteCache(str(tmp_path / 'sparql.db'))
+    writer = qc.QueryCache(shared=shared)
+    result = qc.project(RESPONSE)
+    writer.set('SELECT ..', result)
+
+    reader = qc.QueryCache(local=qc.LRUCache(), shared=shared)
+    assert reader.get('SELECT ..') == result
+    assert reader.get('SELECT ..') == result
+    assert reader.get('ASK ..') is None
+    stats = reader.stats()
+    assert stats['local']['hits'] == 1 and stats['shared']['hits'] == 1
+
+
+def test_shared_tier_uses_the_wire_format():
+    class Shared(qc.CacheBackend):
+        def __init__(self):
+            qc.CacheBackend.__init__(self)
+            self.blobs = {}
+
+        def _get(self, key):
+            return self.blobs.get(key)
+
+        def _set(self, key, value, ttl):
+            self.blobs[key] = value
+
+    shared = Shared()
+    result = qc.project(RESPONSE)
+    qc.QueryCache(shared=shared).set('SELECT ..', result)
+    assert qc.decode(shared.blobs[qc.cache_key('SELECT ..')]) == result
+
+    shared.blobs[qc.cache_key('ASK ..')] = qc.encode({'boolean': False})
+    local = qc.LRUCache()
+    assert qc.QueryCache(local=local, shared=shared).get('ASK ..') == {'boolean': False}
+    assert local.stats()['bytes'] == len(qc._pack({'boolean': False}))
+
+
+def test_empty_results_expire_sooner(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(qc.time, 'time', clock)
+    empty = {'head': {'vars': ['p']}, 'results': {'bindings': []}}
+    shared = qc.SQLiteCache(str(tmp_path / 'sparql.db'), ttl=3600)
+    cache = qc.QueryCache(local=qc.LRUCache(), shared=shared, empty_ttl=60)
+    cache.set('empty', empty)
+    cache.set('full', qc.project(RESPONSE))
+    cache.set('ask', {'boolean': False})
+
+    clock.now += 61
+    assert cache.get('empty') is None and shared.get(qc.cache_key('empty')) is None
+    assert cache.get('full') is not None and cache.get('ask') == {'boolean': False}
+    # Never longer than the tier's own ttl
+    clock.now += 3600
+    assert shared.get(qc.cache_key('full')) is None
+
+
+class Blocking(qc.CacheBackend):
+    """ A shared tier whose round trips only complete once the event loop has moved on """
+
+    def __init__(self):
+        qc.CacheBackend.__init__(self)
+        self.blobs = {}
+        self.loop_moved_on = threading.Event()
+        self.waits = []
+
+    def _get(self, key):
+        self.waits.append(self.loop_moved_on.wait(2))
+        return self.blobs.get(key)
+
+    def _set(self, key, value, ttl):
+        self.waits.append(self.loop_moved_on.wait(2))
+        self.blobs[key] = value
+
+
+def test_async_shared_tier_off_the_event_loop():
+    shared = Blocking()
+    cache = qc.QueryCache(local=qc.LRUCache(), shared=shared)
+    result = qc.project(RESPONSE)
+
+    async def main():
+        written = asyncio.ensure_future(cache.aset('SELECT ..', result))
+        read = asyncio.ensure_future(cache.aget('ASK ..'))
+        await asyncio.sleep(0.01)
+        shared.loop_moved_on.set()
+        await written
+        return await read
+
+    assert asyncio.run(main()) is None
+    assert shared.waits == [True, True]
+    # Local hits don't leave the loop
+    assert asyncio.run(cache.aget('SELECT ..')) == result and len(shared.waits) == 2
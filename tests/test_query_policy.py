@@ -0,0 +1,38 @@
+import pytest
+
+from utils import query_policy as qp
+
+
+def test_budgets_per_kind():
+    budgets = qp.QueryBudgets()
+    assert budgets.timeout('hop2') == 10.0 and budgets.timeout('never seen') == 2.0
+
+
+def test_timeout_adapts_after_warmup():
+    budgets = qp.QueryBudgets(budgets={'default': 2.0, 'hop2': 10.0}, minimum=0.5, warmup=5)
+    for _ in range(4):
+        budgets.observe('hop2', 1.0)
+    assert budgets.timeout('hop2') == 10.0
+    budgets.observe('hop2', 1.0)
+    # mean 1s, deviation shrinking from 0.5s: well under the budget
+    assert 1.0 < budgets.timeout('hop2') < 3.0
+    for _ in range(100):
+        budgets.observe('hop2', 0.01)
+    assert budgets.timeout('hop2') == 0.5
+    for _ in range(100):
+        budgets.observe('hop2', 60.0)
+    assert budgets.timeout('hop2') == 10.0
+
+
+def test_stats():
+    budgets = qp.QueryBudgets()
+    budgets.observe('answer', 0.2)
+    budgets.count('answer', 'timeouts')
+    budgets.count('answer', 'retries')
+    assert budgets.stats() == {'answer': {'requests': 1, 'timeouts': 1, 'retries': 1, 'failures': 0, 'timeout': 10.0}}
+
+
+@pytest.mark.parametrize('attempt', range(6))
+def test_backoff_bounded(attempt):
+    policy = qp.RetryPolicy(base=0.05, cap=1.0)
+    assert all(0 <= policy.backoff(attempt) <= min(1.0, 0.05 * 2 ** attempt) for _ in range(50))
@@ -0,0 +1,72 @@
+import importlib
+import types
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+# A three word embedding; anything else embeds to zeros
+WORDS = {'birth': [1.0, 0.0, 0.0], 'place': [0.0, 1.0, 0.0], 'spouse': [0.0, 0.0, 2.0]}
+LABELS = {'http://dbpedia.org/ontology/birthPlace': 'birth place',
+          'http://dbpedia.org/ontology/spouse': 'spouse',
+          'http://dbpedia.org/property/xyz': 'xyz'}
+
+
+class FakeDBPedia:
+    def get_label(self, uri):
+        return LABELS[uri]
+
+
+@pytest.fixture
+def relation_index(monkeypatch):
+    """ utils.relation_index, with the embeddings (which need fastai and the vectors on disk) faked """
+    import utils
+    ei = types.ModuleType('embeddings_interface')
+    ei.vocabularize = lambda tokens, **kwargs: np.array([sorted(WORDS).index(t) + 2 if t in WORDS else 1 for t in tokens])
+    ei.vectorize = lambda tokens, _embedding=None, **kwargs: np.array([WORDS.get(t, [0.0] * 3) for t in tokens])
+    nlutils = types.ModuleType('natural_language_utilities')
+    nlutils.tokenize = lambda label: label.split()
+    nlutils.create_dir = lambda location: __import__('os').makedirs(location, exist_ok=True)
+    for name, module in [('embeddings_interface', ei), ('natural_language_utilities', nlutils)]:
+        monkeypatch.setitem(sys.modules, 'utils.' + name, module)
+        monkeypatch.setattr(utils, name, module, raising=False)
+    monkeypatch.delitem(sys.modules, 'utils.relation_index', raising=False)
+    return importlib.import_module('utils.relation_index')
+
+
+def test_build_and_load(relation_index, tmp_path):
+    location = str(tmp_path / 'relation_index')
+    relations = [b'<http://dbpedia.org/ontology/birthPlace>', 'http://dbpedia.org/ontology/spouse',
+                 'http://dbpedia.org/property/xyz', 'http://dbpedia.org/ontology/spouse']
+    relation_index.build(relations, location, FakeDBPedia(), embedding='glove')
+
+    index = relation_index.RelationIndex(location)
+    assert len(index) == 3 and index.embedding == 'glove'
+    assert '<http://dbpedia.org/ontology/birthPlace>' in index and 'http://dbpedia.org/ontology/child' not in index
+    assert index.row('http://dbpedia.org/ontology/child') is None
+    assert index.label(b'http://dbpedia.org/ontology/birthPlace') == 'birth place'
+    assert list(index.token_ids('http://dbpedia.org/ontology/birthPlace')) == [2, 3]
+    assert np.allclose(index.vector('http://dbpedia.org/ontology/birthPlace'), [2 ** -0.5, 2 ** -0.5, 0])
+    assert np.allclose(index.vector('http://dbpedia.org/ontology/spouse'), [0, 0, 1])
+    # Embeds to a zero vector: not scored
+    assert index.vector('http://dbpedia.org/property/xyz') is None
+    assert list(index.token_ids('http://dbpedia.org/property/xyz')) == [1]
+
+
+def test_empty_index(relation_index, tmp_path):
+    index = relation_index.build([], str(tmp_path / 'relation_index'), FakeDBPedia())
+    assert len(index) == 0 and 'http://dbpedia.org/ontology/spouse' not in index
+
+
+def test_vocabularize_relation(relation_index, tmp_path):
+    index = relation_index.build(['http://dbpedia.org/ontology/spouse'], str(tmp_path / 'relation_index'), FakeDBPedia())
+
+    class Unreachable:
+        def get_label(self, uri):
+            raise AssertionError('%s should be read from the index' % uri)
+
+    assert relation_index.vocabularize_relation('http://dbpedia.org/ontology/spouse', Unreachable(), index) == [4]
+    # Not in the index (or no index): labelled live
+    assert relation_index.vocabularize_relation('http://dbpedia.org/ontology/birthPlace', FakeDBPedia(), index) == [2, 3]
+    assert relation_index.vocabularize_relation('http://dbpedia.org/ontology/spouse', FakeDBPedia()) == [4]
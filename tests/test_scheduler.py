@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from scheduler import MicroBatcher
+
+
+class Recorder:
+    def __init__(self, fn=lambda x: x * 2):
+        self.fn = fn
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, requests):
+        with self.lock:
+            self.batches.append(list(requests))
+        return [self.fn(request) for request in requests]
+
+
+def test_concurrent_requests_batched():
+    run = Recorder()
+    batcher = MicroBatcher(run, window_ms=200, max_batch=4, name='test')
+    futures = [batcher.submit(i) for i in range(4)]
+    assert [future.result(5) for future in futures] == [0, 2, 4, 6]
+    # max_batch reached: one call, without waiting for the window
+    assert run.batches == [[0, 1, 2, 3]]
+    assert batcher(5) == 10
+    assert batcher.batches == 2 and batcher.requests == 5
+
+
+def test_batches_split_at_max_batch():
+    run = Recorder()
+    batcher = MicroBatcher(run, window_ms=200, max_batch=2)
+    assert [future.result(5) for future in [batcher.submit(i) for i in range(5)]] == [0, 2, 4, 6, 8]
+    assert all(len(batch) <= 2 for batch in run.batches) and sum(run.batches, []) == list(range(5))
+
+
+def test_bad_request_doesnt_fail_the_others():
+    def fn(request):
+        if request == 'bad':
+            raise ValueError(request)
+        return request.upper()
+
+    run = Recorder(fn)
+    batcher = MicroBatcher(run, window_ms=200, max_batch=3)
+    futures = [batcher.submit(request) for request in ['a', 'bad', 'c']]
+    assert futures[0].result(5) == 'A' and futures[2].result(5) == 'C'
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    # The batch, then each request on its own
+    assert run.batches == [['a', 'bad', 'c'], ['a'], ['bad'], ['c']]
+    # The batcher is still working
+    assert batcher('d') == 'D'
+
+
+def test_missing_outputs_fail_the_request():
+    def run(requests):
+        # Drops the outputs of the requests it can't handle instead of raising
+        return [request for request in requests if request != 'dropped']
+
+    batcher = MicroBatcher(run, window_ms=200, max_batch=3)
+    futures = [batcher.submit(request) for request in ['a', 'dropped', 'c']]
+    assert futures[0].result(5) == 'a' and futures[2].result(5) == 'c'
+    with pytest.raises(ValueError):
+        futures[1].result(5)
@@ -0,0 +1,90 @@
+from concurrent.futures import Future
+import socket
+import zlib
+
+import pytest
+
+try:
+    import numpy as np
+    import server
+    from utils import dbpedia_interface as dbi
+    from utils import local_triple_store as lts
+    from datasetPreparation import entity_subgraph as es
+except Exception as e:
+    # server.py loads the embeddings at import, and needs torch, bottle, fastai ..
+    pytest.skip("server.py can't be loaded here (%r)" % (e,), allow_module_level=True)
+
+BERLIN = 'http://dbpedia.org/resource/Berlin'
+QUESTION = 'Which country is Berlin in?'
+TRIPLES = [
+    (BERLIN, 'http://dbpedia.org/ontology/country', 'http://dbpedia.org/resource/Germany'),
+    (BERLIN, 'http://dbpedia.org/ontology/leader', 'http://dbpedia.org/resource/Kai_Wegner'),
+    ('http://dbpedia.org/resource/Germany', 'http://dbpedia.org/ontology/capital', BERLIN),
+    ('http://dbpedia.org/resource/Germany', 'http://dbpedia.org/ontology/currency', 'http://dbpedia.org/resource/Euro'),
+    ('http://dbpedia.org/resource/Kai_Wegner', 'http://dbpedia.org/ontology/party', 'http://dbpedia.org/resource/CDU'),
+]
+
+
+class Network:
+    """ Stands in for DBpedia and EARL while recording """
+
+    def __init__(self):
+        self.store = lts.LocalTripleStore()
+        for triple in TRIPLES:
+            self.store.add(*triple)
+
+    def mount(self, prefix, pool_maxsize=None):
+        pass
+
+    def sparql(self, endpoint, query, timeout=None):
+        return self.store.query(query)
+
+    def post_json(self, url, data=None, headers=None, timeout=None):
+        return {'ertypes': ['entity'], 'rerankedlists': {'0': [[1.0, BERLIN]]}}
+
+
+class Model:
+    """ A MicroBatcher stand in, answering every request with fn(request) """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def submit(self, request):
+        future = Future()
+        future.set_result(self.fn(request))
+        return future
+
+    def __call__(self, request):
+        return self.fn(request)
+
+
+def serve(monkeypatch, dbp):
+    monkeypatch.setattr(server, 'dbp', dbp)
+    monkeypatch.setattr(server, 'subgraph_maker', es.CreateSubgraph(dbp, [], {}, qald=False))
+    monkeypatch.setattr(server, 'relation_index', None)
+    monkeypatch.setattr(server, 'parameter_dict', {'corechainmodel': 'bilstm_dot', 'candidate_budget_ms': 0,
+                                                   'stream_candidates': False, 'candidate_top_k': 10})
+    # 'list' questions without rdf constraints, and a score for every path which depends only on the path
+    monkeypatch.setattr(server, 'batchers', {
+        'intent': Model(lambda question: np.eye(3)[server.qa.INTENTS.index('list')]),
+        'rdftype': Model(lambda question: np.eye(3)[server.qa.RDFTYPES.index('none')]),
+        'corechain': Model(lambda request: np.array([zlib.crc32(str(list(path)).encode('utf-8'))
+                                                     for path in request[1]], dtype=np.float64))})
+    return server.answer_question(QUESTION)
+
+
+def test_answer_question_replayed_offline(tmp_path, monkeypatch):
+    fixtures = str(tmp_path / 'fixtures.sqlite')
+    recorded = serve(monkeypatch, dbi.DBPedia(caching=False, mode='record', fixtures=fixtures, transport=Network()))
+    assert recorded['entities'] == [BERLIN] and recorded['sparql']
+
+    def offline(*args, **kwargs):
+        raise AssertionError('Replaying went to the network')
+    monkeypatch.setattr(socket.socket, 'connect', offline)
+
+    dbp = dbi.DBPedia(caching=False, mode='replay', fixtures=fixtures)
+    replayed = serve(monkeypatch, dbp)
+    # Answers come out of a set
+    assert sorted(replayed.pop('answers')) == sorted(recorded.pop('answers'))
+    assert replayed == recorded
+    assert dbp.transport.store.misses == 0 and dbp.transport.store.hits > 0
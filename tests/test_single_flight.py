@@ -0,0 +1,91 @@
+import threading
+import asyncio
+import time
+
+import pytest
+
+from utils import single_flight as sf
+
+
+def test_concurrent_callers_share_one_call():
+    flight = sf.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('q', fetch)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('q', fetch))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while flight.stats()['shared'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert results == ['result'] * 4 and len(calls) == 1
+    assert flight.stats() == {'calls': 1, 'shared': 3, 'errors_served': 0}
+    # Done: the next call runs again
+    assert flight.do('q', lambda: 'again') == 'again'
+
+
+def test_failure_remembered_for_error_ttl(monkeypatch):
+    flight = sf.SingleFlight(error_ttl=5)
+    now = [1000.0]
+    monkeypatch.setattr(sf.time, 'time', lambda: now[0])
+
+    def broken():
+        raise ValueError('endpoint down')
+
+    with pytest.raises(ValueError):
+        flight.do('q', broken)
+    with pytest.raises(ValueError):
+        flight.do('q', lambda: 'not called')
+    assert flight.stats()['errors_served'] == 1
+
+    now[0] += 6
+    assert flight.do('q', lambda: 'back') == 'back'
+
+
+def test_failure_not_remembered_without_error_ttl():
+    flight = sf.SingleFlight(error_ttl=0)
+    with pytest.raises(ValueError):
+        flight.do('q', lambda: int('x'))
+    assert flight.do('q', lambda: 1) == 1
+
+
+def test_async_callers_share_one_call():
+    flight = sf.AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def main():
+        return await asyncio.gather(*[flight.do('q', fetch) for _ in range(4)])
+
+    assert asyncio.run(main()) == ['result'] * 4 and len(calls) == 1
+    assert flight.stats()['shared'] == 3
+
+
+def test_async_failure_reaches_every_caller():
+    flight = sf.AsyncSingleFlight()
+
+    async def broken():
+        await asyncio.sleep(0.01)
+        raise ValueError('endpoint down')
+
+    async def main():
+        return await asyncio.gather(*[flight.do('q', broken) for _ in range(3)], return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
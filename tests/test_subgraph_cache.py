@@ -0,0 +1,68 @@
+import pytest
+
+from datasetPreparation import neighbourhood_index as ni
+from datasetPreparation import subgraph_cache as sc
+
+DBO = 'http://dbpedia.org/ontology/'
+
+
+def neighbourhood(*right):
+    return ni.Neighbourhood([DBO + p for p in right], [], {}, {})
+
+
+def key(entity):
+    return ('http://dbpedia.org/resource/' + entity, sc.blacklist_version([DBO + 'wikiPageWikiLink']), False)
+
+
+def test_lru_bounded_by_bytes():
+    size = sc.entry_size(neighbourhood('country'))
+    cache = sc.SubgraphCache(max_bytes=2 * size)
+    cache.put(key('Berlin'), neighbourhood('country'))
+    cache.put(key('Paris'), neighbourhood('country'))
+    assert cache.get(key('Berlin')) is not None
+    cache.put(key('Rome'), neighbourhood('country'))
+    assert cache.get(key('Paris')) is None and cache.get(key('Berlin')) is not None
+    assert cache.stats() == {'entries': 2, 'bytes': 2 * size, 'hits': 2, 'misses': 1}
+
+
+def test_blacklist_version():
+    assert sc.blacklist_version(['a', 'b']) == sc.blacklist_version(['b', 'a']) != sc.blacklist_version(['a'])
+
+
+def test_merge_keeps_every_expansion_and_leaves_entries_alone():
+    cache = sc.SubgraphCache()
+    entry = neighbourhood('country', 'leader')
+    cache.put(key('Berlin'), entry)
+
+    # Two questions expanding the same entity, each on its own copy
+    first = entry._replace(hop2_right={DBO + 'country': ([DBO + 'currency'], [])})
+    second = entry._replace(hop2_right={DBO + 'leader': ([DBO + 'party'], [])})
+    cache.merge(key('Berlin'), first)
+    cache.merge(key('Berlin'), second)
+
+    merged = cache.get(key('Berlin'))
+    assert merged.hop2_right == {DBO + 'country': ([DBO + 'currency'], []), DBO + 'leader': ([DBO + 'party'], [])}
+    assert entry.hop2_right == {} and first.hop2_right == {DBO + 'country': ([DBO + 'currency'], [])}
+    assert cache.stats()['bytes'] == sc.entry_size(merged)
+
+
+def test_save_load(tmp_path):
+    location = str(tmp_path / 'subgraph.pickle')
+    cache = sc.SubgraphCache()
+    cache.put(key('Berlin'), neighbourhood('country'))
+    cache.put(key('Paris'), neighbourhood('mayor'))
+    cache.save(location)
+
+    loaded = sc.SubgraphCache.load(location)
+    assert loaded.get(key('Paris')) == neighbourhood('mayor') and len(loaded) == 2
+    # Too small for both: the most recently used one is kept
+    small = sc.SubgraphCache.load(location, max_bytes=sc.entry_size(neighbourhood('mayor')))
+    assert len(small) == 1 and small.get(key('Paris')) is not None
+
+
+def test_load_missing_or_corrupt(tmp_path):
+    assert len(sc.SubgraphCache.load(str(tmp_path / 'missing.pickle'))) == 0
+    corrupt = tmp_path / 'corrupt.pickle'
+    corrupt.write_bytes(b'not a pickle')
+    with pytest.warns(UserWarning):
+        assert len(sc.SubgraphCache.load(str(corrupt))) == 0
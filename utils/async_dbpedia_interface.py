@@ -0,0 +1,368 @@
+"""
+	asyncio twin of DBPedia (see utils/dbpedia_interface.py): the same queries, as coroutines, over aiohttp.
+
+	Threads stop paying off beyond a few dozen concurrent queries. With this, one thread (one event loop)
+		can keep hundreds of queries in flight, eg. while expanding subgraphs or fetching answers of many questions.
+
+	AsyncDBPedia is a DBPedia: same constructor, templates, endpoint selection and cache.
+		Only the methods which shoot queries are redefined (as coroutines). get_label etc. stay as they are.
+	Pass cache=dbp.cache to share the cache of an existing (blocking) DBPedia.
+	At most max_concurrency queries are in flight at any time.
+
+	The cache's local tier is consulted on the event loop; its shared tier (redis/sqlite) in the loop's default executor
+		(see QueryCache.aget/aset), so that a round trip to it never holds up the other queries in flight.
+
+	Needs aiohttp (pip install aiohttp), which nothing else in the repo does.
+
+	Usage:
+		async with AsyncDBPedia(caching=False, local_caching=True) as adbp:
+			right, left = await adbp.get_properties('http://dbpedia.org/resource/Donald_Trump', label=False)
+			subgraphs = await asyncio.gather(*[adbp.get_hop2_subgraph(uri, p) for p in right])
+"""
+from operator import itemgetter
+import asyncio
+import warnings
+import time
+import re
+
+import aiohttp
+
+try:
+    import natural_language_utilities as nlutils
+    import http_transport as ht
+    import endpoint_pool as ep
+    import single_flight as sf
+    import query_cache as qc
+    from dbpedia_interface import (DBPedia, PAGE_SIZE, HOP2_PAGE_SIZE, ASK_RE_PATTERN, SLICED_RE_PATTERN,
+                                   property_key, CHECK_URL, GET_CLASS_PATH, GET_SUPERCLASS, GET_SUBJECT, GET_OBJECT,
+                                   GET_SAME_AS, GET_TYPE_OF_RESOURCE, GET_ENTITIES_OF_CLASS,
+                                   GET_RIGHT_PROPERTIES_OF_RESOURCE, GET_LEFT_PROPERTIES_OF_RESOURCE,
+                                   GET_RIGHT_PROPERTIES_OF_RESOURCE_WITH_OBJECTS,
+                                   GET_LEFT_PROPERTIES_OF_RESOURCE_WITH_OBJECTS,
+                                   GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTY,
+                                   GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY,
+                                   GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTIES,
+                                   GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTIES)
+    from goodies import SparqlQueryError
+except ImportError:
+    from utils import natural_language_utilities as nlutils
+    from utils import http_transport as ht
+    from utils import endpoint_pool as ep
+    from utils import single_flight as sf
+    from utils import query_cache as qc
+    from utils.dbpedia_interface import (DBPedia, PAGE_SIZE, HOP2_PAGE_SIZE, ASK_RE_PATTERN, SLICED_RE_PATTERN,
+                                         property_key, CHECK_URL, GET_CLASS_PATH, GET_SUPERCLASS, GET_SUBJECT,
+                                         GET_OBJECT, GET_SAME_AS, GET_TYPE_OF_RESOURCE, GET_ENTITIES_OF_CLASS,
+                                         GET_RIGHT_PROPERTIES_OF_RESOURCE, GET_LEFT_PROPERTIES_OF_RESOURCE,
+                                         GET_RIGHT_PROPERTIES_OF_RESOURCE_WITH_OBJECTS,
+                                         GET_LEFT_PROPERTIES_OF_RESOURCE_WITH_OBJECTS,
+                                         GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTY,
+                                         GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY,
+                                         GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTIES,
+                                         GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTIES)
+    from utils.goodies import SparqlQueryError
+
+DBPEDIA_PREFIXES = ['http://dbpedia.org/ontology/', 'http://dbpedia.org/property/']
+
+
+def is_endpoint_failure(exception):
+    """ aiohttp's version of http_transport.is_endpoint_failure: timeouts don't count """
+    if isinstance(exception, asyncio.TimeoutError):
+        # Including aiohttp.ServerTimeoutError, a ClientConnectionError too
+        return False
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status >= 500
+    return isinstance(exception, aiohttp.ClientConnectionError)
+
+
+def is_timeout(exception):
+    return isinstance(exception, asyncio.TimeoutError)
+
+
+async def _aiter(items):
+    """ Iterates a list or an async generator alike """
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def _values(response, variable):
+    return [x[variable][u'value'].encode('ascii', 'ignore') for x in response[u'results'][u'bindings']]
+
+
+class AsyncDBPedia(DBPedia):
+    def __init__(self, *args, max_concurrency=200, cache=None, **kwargs):
+        """
+            max_concurrency: queries in flight at a time
+            cache: query_cache.QueryCache to use instead of making one (eg. that of a blocking DBPedia)
+            everything else: same as DBPedia
+        """
+        pool_maxsize = kwargs.get('pool_maxsize', None)
+        DBPedia.__init__(self, *args, **kwargs)
+        if cache is not None:
+            self.cache = cache
+        self.endpoints.is_failure = is_endpoint_failure
+        self.flight = sf.AsyncSingleFlight(kwargs.get('error_ttl', 5.0))
+
+        self.max_concurrency = max_concurrency
+        self.pool_maxsize = pool_maxsize or ht.POOL_MAXSIZE
+        # Made on first use, since they belong to the running event loop
+        self._session, self._semaphore = None, None
+
+    def _ensure_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.pool_maxsize)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def shoot_custom_query(self, _custom_query, _kind='default'):
+        """
+			Shoot any custom query and get the SPARQL results as a dictionary.
+			Same timeouts, retries and errors as DBPedia.shoot_custom_query.
+		"""
+        caching_answer = await self.cache.aget(_custom_query)
+        if caching_answer is not None:
+            return caching_answer
+
+        return await self.flight.do(_custom_query, lambda: self._fetch(_custom_query, _kind))
+
+    async def _request(self, endpoint, _custom_query, timeout):
+        if self.mode == 'replay':
+            return await self.transport.asparql(endpoint, _custom_query, timeout)
+        if self.triples:
+            # Answered in process (local_triple_store.py): nothing to wait for
+            return self.transport.sparql(endpoint, _custom_query, timeout)
+        start = time.time()
+        response = await self._http_request(endpoint, _custom_query, timeout)
+        if self.mode == 'record':
+            self.transport.record(_custom_query, response, time.time() - start)
+        return response
+
+    async def _http_request(self, endpoint, _custom_query, timeout):
+        session = self._ensure_session()
+        headers = {'Accept': ht.SPARQL_JSON}
+        timeout = aiohttp.ClientTimeout(total=timeout)
+        if len(_custom_query) <= ht.MAX_GET_LENGTH:
+            request = session.get(endpoint, params={'query': _custom_query}, headers=headers, timeout=timeout)
+        else:
+            request = session.post(endpoint, data={'query': _custom_query}, headers=headers, timeout=timeout)
+        async with request as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def _fetch(self, _custom_query, _kind):
+        self._ensure_session()
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                async with self._semaphore:
+                    with self.endpoints.request() as endpoint:
+                        caching_answer = qc.project(
+                            await self._request(endpoint, _custom_query, self.budgets.timeout(_kind)))
+                break
+            except ep.EndpointsUnavailable as e:
+                self.budgets.count(_kind, 'failures')
+                raise SparqlQueryError(_custom_query, e, attempt + 1)
+            except Exception as e:
+                timeout = is_timeout(e)
+                if timeout:
+                    self.budgets.count(_kind, 'timeouts')
+                if not (timeout or is_endpoint_failure(e)) or attempt >= self.retry.max_retries:
+                    self.budgets.count(_kind, 'failures')
+                    raise SparqlQueryError(_custom_query, e, attempt + 1)
+                self.budgets.count(_kind, 'retries')
+                await asyncio.sleep(self.retry.backoff(attempt))
+                attempt += 1
+
+        self.budgets.observe(_kind, time.time() - start)
+        await self.cache.aset(_custom_query, caching_answer)
+        return caching_answer
+
+    async def iter_pages(self, _query, _kind='default', _page_size=PAGE_SIZE):
+        """
+            Async generator; see DBPedia.iter_pages
+        """
+        page = _query if callable(_query) else (lambda offset: '%s LIMIT %d OFFSET %d' % (_query, _page_size, offset))
+        offset = 0
+        while True:
+            response = await self.shoot_custom_query(page(offset), _kind)
+            yield response
+            if len(response[u'results'][u'bindings']) < _page_size:
+                return
+            offset = offset + _page_size
+
+    async def iter_bindings(self, _query, _kind='default', _page_size=PAGE_SIZE):
+        async for response in self.iter_pages(_query, _kind, _page_size):
+            for binding in response[u'results'][u'bindings']:
+                yield binding
+
+    async def get_properties_of_resource(self, _resource_uri, _with_connected_resource=False, right=True):
+        if not nlutils.has_url(_resource_uri):
+            _resource_uri = nlutils.convert_shorthand_to_uri(_resource_uri)
+        _resource_uri = '<' + _resource_uri + '>'
+        if _with_connected_resource:
+            template = GET_RIGHT_PROPERTIES_OF_RESOURCE_WITH_OBJECTS if right else GET_LEFT_PROPERTIES_OF_RESOURCE_WITH_OBJECTS
+        else:
+            template = GET_RIGHT_PROPERTIES_OF_RESOURCE if right else GET_LEFT_PROPERTIES_OF_RESOURCE
+        response = await self.shoot_custom_query(template % {'target_resource': _resource_uri}, 'properties')
+
+        if _with_connected_resource:
+            return [list(pair) for pair in zip(_values(response, u'property'), _values(response, u'resource'))]
+        return _values(response, u'property')
+
+    async def get_entities_of_class(self, _class_uri):
+        if not nlutils.has_url(_class_uri):
+            _class_uri = nlutils.convert_shorthand_to_uri(_class_uri)
+        bindings = self.iter_bindings(GET_ENTITIES_OF_CLASS % {'target_class': '<' + _class_uri + '>'}, 'lookup')
+        return [x[u'entity'][u'value'].encode('ascii', 'ignore') async for x in bindings]
+
+    async def get_type_of_resource(self, _resource_uri, _filter_dbpedia=False):
+        if not nlutils.has_url(_resource_uri):
+            _resource_uri = nlutils.convert_shorthand_to_uri(_resource_uri)
+        response = await self.shoot_custom_query(GET_TYPE_OF_RESOURCE % {'target_resource': '<' + _resource_uri + '>'}, 'lookup')
+        type_list = _values(response, u'type')
+        if _filter_dbpedia:
+            return [x for x in type_list if x[:28].decode() in DBPEDIA_PREFIXES]
+        return type_list
+
+    async def get_answer(self, _sparql_query):
+        if re.search(ASK_RE_PATTERN, _sparql_query, 0):
+            response = await self.shoot_custom_query(_sparql_query, 'answer')
+            return {'boolean': response['boolean']}
+
+        if re.search(SLICED_RE_PATTERN, _sparql_query):
+            responses = [await self.shoot_custom_query(_sparql_query, 'answer')]
+        else:
+            responses = self.iter_pages(_sparql_query, 'answer')
+
+        values = None
+        async for response in _aiter(responses):
+            if values is None:
+                values = {variable: [] for variable in response[u'head'][u'vars']}
+            for variable in values:
+                values[variable] += _values(response, variable)
+        return values
+
+    async def get_most_specific_class(self, _resource_uri):
+        if not nlutils.has_url(_resource_uri):
+            _resource_uri = nlutils.convert_shorthand_to_uri(_resource_uri)
+        classes = await self.get_type_of_resource(_resource_uri, _filter_dbpedia=True)
+
+        # Length of the path of every class to owl:Thing; the longest one is the most specific.
+        responses = await asyncio.gather(*[
+            self.shoot_custom_query(GET_CLASS_PATH % {'target_class': '<' + class_uri.decode() + '>'}, 'lookup')
+            for class_uri in classes])
+        length_array = [(class_uri, len(response[u'results'][u'bindings']))
+                        for class_uri, response in zip(classes, responses)]
+
+        if len(length_array) > 0:
+            return max(length_array, key=itemgetter(1))[0].decode()
+        return "http://www.w3.org/2002/07/owl#Thing"
+
+    async def _dbpedia_superclasses(self, _resource_uri):
+        specific_class_uri = "<" + await self.get_most_specific_class(_resource_uri) + ">"
+        response = await self.shoot_custom_query(GET_SUPERCLASS % {'target_class': specific_class_uri}, 'lookup')
+        return [x for x in _values(response, u'type') if x[:28].decode() in DBPEDIA_PREFIXES]
+
+    async def is_common_parent(self, _resource_uri_1, _resource_uri_2):
+        parents_1, parents_2 = await asyncio.gather(self._dbpedia_superclasses(_resource_uri_1),
+                                                    self._dbpedia_superclasses(_resource_uri_2))
+        return parents_1 == parents_2
+
+    async def get_parent(self, _resource_uri):
+        parents = await self._dbpedia_superclasses(_resource_uri)
+        if len(parents) >= 1:
+            return parents[0]
+        return "http://www.w3.org/2002/07/owl#Thing"
+
+    async def is_Url(self, url):
+        response = await self.shoot_custom_query(CHECK_URL % {'target_resource': url}, 'lookup')
+        return response["boolean"]
+
+    async def get_properties(self, _uri, _right=True, _left=True, label=True):
+        sides = ([True] if _right else []) + ([False] if _left else [])
+        properties = await asyncio.gather(*[self.get_properties_of_resource(_resource_uri=_uri, right=right)
+                                            for right in sides])
+        properties = [list(set(props)) for props in properties]
+        if label:
+            properties = [[nlutils.get_label_via_parsing(rel) for rel in props] for props in properties]
+        return tuple(properties) if len(properties) == 2 else properties[0]
+
+    async def get_entity(self, _resource_uri, _relation, outgoing=True):
+        template = GET_OBJECT if outgoing else GET_SUBJECT
+        response = await self.shoot_custom_query(template % {'target_resource': "<" + _resource_uri + ">",
+                                                             'property': "<" + _relation[0] + ">"}, 'lookup')
+        return [x[u'entity'][u'value'] for x in response[u'results'][u'bindings']]
+
+    async def get_dbpedia_URL(self, _uri):
+        url = _uri if _uri[0] == '<' else '<' + _uri + ('' if _uri[-1] == '>' else '>')
+        response = await self.shoot_custom_query(GET_SAME_AS % {'target_resource': url}, 'lookup')
+        return _values(response, u'entity') or None
+
+    async def get_hop2_subgraph(self, _resource_uri, _property_uri, right=False):
+        if _resource_uri[0] != '<':
+            _resource_uri = '<' + _resource_uri + '>'
+        if _property_uri[0] != '<':
+            _property_uri = '<' + _property_uri + '>'
+        template = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTY if right \
+            else GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY
+
+        bindings = self.iter_bindings(lambda offset: template % {'target_resource': _resource_uri,
+                                                                 'property': _property_uri, 'limit': HOP2_PAGE_SIZE,
+                                                                 'offset': offset},
+                                      'hop2', HOP2_PAGE_SIZE)
+
+        right_property_list, left_property_list = [], []
+        async for x in bindings:
+            if 'property1' in x:
+                right_property_list.append(x[u'property1'][u'value'].encode('ascii', 'ignore'))
+            if 'property2' in x:
+                left_property_list.append(x[u'property2'][u'value'].encode('ascii', 'ignore'))
+        return right_property_list, left_property_list
+
+    async def get_hop2_subgraph_batch(self, _resource_uri, _property_uris, right=False):
+        """
+            See DBPedia.get_hop2_subgraph_batch
+        """
+        if _resource_uri[0] != '<':
+            _resource_uri = '<' + _resource_uri + '>'
+        passed = {property_key(uri): uri for uri in _property_uris}
+        properties = ' '.join(dict.fromkeys('<' + uri.replace('<', '').replace('>', '') + '>' for uri in _property_uris))
+        template = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTIES if right \
+            else GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTIES
+
+        subgraphs = {uri: ([], []) for uri in _property_uris}
+        bindings = self.iter_bindings(lambda offset: template % {'target_resource': _resource_uri,
+                                                                 'properties': properties, 'limit': HOP2_PAGE_SIZE,
+                                                                 'offset': offset},
+                                      'hop2', HOP2_PAGE_SIZE)
+        async for x in bindings:
+            uri = passed.get(property_key(x[u'property'][u'value']))
+            if uri is None:
+                # Can't tell which property it's of
+                warnings.warn("Unexpected property %r in the 2-hop expansion of %s" % (x[u'property'][u'value'],
+                                                                                      _resource_uri))
+                continue
+            right_property_list, left_property_list = subgraphs[uri]
+            if 'property1' in x:
+                right_property_list.append(x[u'property1'][u'value'].encode('ascii', 'ignore'))
+            if 'property2' in x:
+                left_property_list.append(x[u'property2'][u'value'].encode('ascii', 'ignore'))
+
+        return subgraphs
@@ -13,15 +13,15 @@
 	Q: Ew this looks ugly.
 	A: I just discovered PEP8, go easy on me senpai.
 """
-from SPARQLWrapper import SPARQLWrapper, JSON
 from operator import itemgetter
+from urllib.parse import unquote
 from pprint import pprint
 import numpy as np
 import traceback
 import warnings
 import pickle
 import redis
-import json
+import time
 import re
 
 # Our scripts
@@ -31,6 +31,46 @@ try:
 except ImportError:
     from utils import natural_language_utilities as nlutils
 
+try:
+    import query_cache as qc
+except ImportError:
+    from utils import query_cache as qc
+
+try:
+    import http_transport as ht
+except ImportError:
+    from utils import http_transport as ht
+
+try:
+    import endpoint_pool as ep
+except ImportError:
+    from utils import endpoint_pool as ep
+
+try:
+    import single_flight as sf
+except ImportError:
+    from utils import single_flight as sf
+
+try:
+    import query_policy as qp
+except ImportError:
+    from utils import query_policy as qp
+
+try:
+    import fixture_transport as ft
+except ImportError:
+    from utils import fixture_transport as ft
+
+try:
+    import local_triple_store as lts
+except ImportError:
+    from utils import local_triple_store as lts
+
+try:
+    from goodies import SparqlQueryError
+except ImportError:
+    from utils.goodies import SparqlQueryError
+
 # try:
 #     import labels_mulitple_form
 # except ImportError:
@@ -45,7 +85,16 @@ DBPEDIA_ENDPOINTS = ['http://sda-srv01.iai.uni-bonn.de:8164/sparql']
 REDIS_HOSTNAME = 'sda-srv01'
 #REDIS_HOSTNAME  = '127.0.0.1'
 MAX_WAIT_TIME = 1.0
+# Health probe of the endpoints (see DBPedia.__init__, health_check_interval)
+PROBE_QUERY = 'ASK WHERE { ?s ?p ?o }'
+PROBE_TIMEOUT = 5.0
 ASK_RE_PATTERN = '(?i)ask\s*where'
+# Queries which already say which slice of the results they want aren't paginated (see get_answer)
+SLICED_RE_PATTERN = r'(?i)\b(limit|offset)\s+\d+'
+# Seconds an empty result is cached for: an entity missing from an endpoint (eg. a lagging mirror) may turn up soon
+EMPTY_TTL = 60.0
+# Rows fetched per query when paginating (see iter_pages). Virtuoso answers with at most these many anyway.
+PAGE_SIZE = 10000
 
 
 '''
@@ -104,7 +153,7 @@ GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTY = '''SELECT DISTINCT ?
                                                                 UNION
                                                                 {optional {?useless_resource_3 ?property2 ?useless_resource}}
                                                                 FILTER(!isLiteral(?useless_resource) && !isLiteral(?useless_resource_2) && !isLiteral(?useless_resource_3))
-                                                                } LIMIT 10000 OFFSET %(offset)s '''
+                                                                } LIMIT %(limit)s OFFSET %(offset)s '''
 GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY = '''SELECT DISTINCT ?property1 ?property2 
                                                                 WHERE {   
                                                                 ?useless_resource   %(property)s  %(target_resource)s.
@@ -112,23 +161,109 @@ GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY = '''SELECT DISTINCT ?p
                                                                 UNION
                                                                 {optional {?useless_resource_3 ?property2 ?useless_resource}}
                                                                 FILTER(!isLiteral(?useless_resource) && !isLiteral(?useless_resource_2) && !isLiteral(?useless_resource_3))
-                                                                } LIMIT 10000 OFFSET %(offset)s'''
+                                                                } LIMIT %(limit)s OFFSET %(offset)s'''
+# Batched versions of the two above: the same for every property in a VALUES block, results tagged with ?property.
+GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTIES = '''SELECT DISTINCT ?property ?property1 ?property2 
+                                                                WHERE {   
+                                                                VALUES ?property { %(properties)s }
+                                                                %(target_resource)s  ?property ?useless_resource .
+                                                                {optional {?useless_resource ?property1 ?useless_resource_2}}
+                                                                UNION
+                                                                {optional {?useless_resource_3 ?property2 ?useless_resource}}
+                                                                FILTER(!isLiteral(?useless_resource) && !isLiteral(?useless_resource_2) && !isLiteral(?useless_resource_3))
+                                                                } LIMIT %(limit)s OFFSET %(offset)s '''
+GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTIES = '''SELECT DISTINCT ?property ?property1 ?property2 
+                                                                WHERE {   
+                                                                VALUES ?property { %(properties)s }
+                                                                ?useless_resource   ?property  %(target_resource)s.
+                                                                {optional {?useless_resource ?property1 ?useless_resource_2}}
+                                                                UNION
+                                                                {optional {?useless_resource_3 ?property2 ?useless_resource}}
+                                                                FILTER(!isLiteral(?useless_resource) && !isLiteral(?useless_resource_2) && !isLiteral(?useless_resource_3))
+                                                                } LIMIT %(limit)s OFFSET %(offset)s'''
+# Page size of the queries above (their LIMIT)
+HOP2_PAGE_SIZE = PAGE_SIZE
+
+
+def property_key(uri):
+    """
+        The form batched hop2 results are matched to the properties sent on: no angle brackets, percent-decoded.
+        (endpoints don't always echo a uri back exactly as it was sent)
+    """
+    return unquote(uri.replace('<', '').replace('>', '').strip())
+
+
 class DBPedia:
-    def __init__(self, _method='round-robin', _verbose=False, _db_name=0, caching=True):
+    def __init__(self, _method='round-robin', _verbose=False, _db_name=0, caching=True, cache_backend=None,
+                 local_caching=False, local_cache_entries=100000, local_cache_bytes=256 * 1024 * 1024, cache_ttl=None,
+                 empty_ttl=EMPTY_TTL, transport=None, pool_maxsize=None, health_check_interval=None, eject_cooldown=30.0, error_ttl=5.0,
+                 timeouts=None, max_retries=2, mode=None, fixtures=None, replay_latency=None, triples=None):
+        """
+            caching: keep results in redis (shared across processes)
+            cache_backend: a query_cache.CacheBackend (eg. SQLiteCache) used as the shared tier instead of redis.
+            local_caching: keep parsed results in an in-process LRU, bounded by local_cache_entries and local_cache_bytes
+            cache_ttl: seconds after which cached results (both tiers) expire. None means never.
+            empty_ttl: seconds after which cached empty results (no bindings) expire, if sooner than cache_ttl.
+                None means as cache_ttl.
+            transport: http_transport.HTTPTransport to send the queries through. Defaults to the one shared by the process.
+            pool_maxsize: keep-alive connections kept per endpoint. Defaults to http_transport.POOL_MAXSIZE
+            _method: how to pick one of DBPEDIA_ENDPOINTS for a query (see utils/endpoint_pool.py, METHODS)
+            health_check_interval: probe every endpoint every these many seconds in the background. None means don't.
+            eject_cooldown: seconds a failing endpoint is left alone.
+            error_ttl: seconds for which a failed query keeps failing without being sent again (see utils/single_flight.py)
+            timeouts: query kind -> timeout budget in seconds. Defaults to query_policy.QUERY_TIMEOUTS
+            max_retries: times a query is resent after a timeout/an endpoint failure.
+                An endpoint is ejected once (max_retries + 1) * 2 attempts in a row fail on it,
+                ie. two queries failing on every attempt; timeouts don't count (see http_transport.is_endpoint_failure).
+
+            mode: None, 'record' or 'replay' (see utils/fixture_transport.py). Defaults to $KRANTIKARI_DBPEDIA_MODE
+            fixtures: the fixture store (sqlite file) to record to/replay from. Defaults to $KRANTIKARI_FIXTURES
+            replay_latency: delay injected before every replayed response (see utils/fixture_transport.py)
+            triples: N-Triples file(s) (comma separated) to answer the queries from, in process, instead of an endpoint
+                (see utils/local_triple_store.py). Defaults to $KRANTIKARI_TRIPLES
+
+            A query which fails for good raises SparqlQueryError (utils/goodies.py).
+        """
 
         # Explanation: selection_method is used to select from the DBPEDIA_ENDPOINTS, hoping that we're not blocked too soon
-        if _method in ['round-robin', 'random', 'select-one']:
-            self.selection_method = _method
-        else:
-            warnings.warn("Selection method not understood, proceeding with 'select-one'")
-            self.selection_method = 'select-one'
+        self.endpoints = ep.EndpointPool(DBPEDIA_ENDPOINTS, method=_method, cooldown=eject_cooldown,
+                                         max_failures=(max_retries + 1) * 2, is_failure=ht.is_endpoint_failure,
+                                         fail_fast=True)
+        self.budgets = qp.QueryBudgets(timeouts)
+        self.retry = qp.RetryPolicy(max_retries)
+        self.selection_method = self.endpoints.method
 
         self.verbose = _verbose
         self.sparql_endpoint = DBPEDIA_ENDPOINTS[0]
+        env_mode, env_fixtures = ft.from_environment()
+        self.mode = mode or env_mode
+        self.triples = triples or lts.from_environment()
+        if self.triples:
+            transport = lts.shared(self.triples)
+            # Local answers are cheaper than a round trip to redis
+            caching = False
+        self.transport = ft.wrap(transport if transport is not None else ht.shared(),
+                                 self.mode, fixtures or env_fixtures, replay_latency)
+        for endpoint in DBPEDIA_ENDPOINTS:
+            self.transport.mount(endpoint, pool_maxsize)
+        if health_check_interval and self.mode != 'replay' and not self.triples:
+            self.endpoints.start_probes(
+                lambda endpoint: self.transport.sparql(endpoint, PROBE_QUERY, timeout=PROBE_TIMEOUT),
+                interval=health_check_interval)
+        if self.mode is not None:
+            # Recording: every query has to reach the endpoint (and so the recorder), not just the ones missing
+            #   from an older cache. Replaying: results have to come from the fixtures only.
+            caching, cache_backend = False, None
         if caching:
             self.r = redis.StrictRedis(host=REDIS_HOSTNAME, port=6379, db=_db_name)
         else:
             self.r = False
+        # Concurrent callers of the same query share one request
+        self.flight = sf.SingleFlight(error_ttl)
+        self.cache = qc.QueryCache(
+            local=qc.LRUCache(local_cache_entries, local_cache_bytes, cache_ttl) if local_caching else None,
+            shared=cache_backend if cache_backend is not None else qc.RedisCache(self.r, cache_ttl) if caching else None,
+            empty_ttl=empty_ttl)
         try:
             self.labels = pickle.load(open('resources/labels.pickle'))
         except:
@@ -146,37 +281,96 @@ class DBPedia:
 			This function is to be called whenever we're making a call to DBPedia. Based on the selection mechanism selected at __init__,
 			this function tells which endpoint to use at every point.
 		"""
-        if self.selection_method == 'round-robin':
-            index = DBPEDIA_ENDPOINTS.index(self.sparql_endpoint)
-            return DBPEDIA_ENDPOINTS[index + 1] if index >= len(DBPEDIA_ENDPOINTS) else DBPEDIA_ENDPOINTS[0]
-        if self.selection_method == 'select-one':
-            return self.sparql_endpoint
+        return self.endpoints.select()
 
-    def shoot_custom_query(self, _custom_query):
+    def shoot_custom_query(self, _custom_query, _kind='default'):
         """
 			Shoot any custom query and get the SPARQL results as a dictionary.
+			_kind decides the timeout budget of the query (see utils/query_policy.py).
+			Raises SparqlQueryError if the query can not be answered.
 		"""
-        if self.r:
-            caching_answer = self.r.get(_custom_query)
-            if caching_answer:
-                # print "@caching layer"
-                return json.loads(caching_answer)
-            else:
-                sparql = SPARQLWrapper(self.select_sparql_endpoint())
-                sparql.setQuery(_custom_query)
-                sparql.setReturnFormat(JSON)
-                sparql.setTimeout(0.1)
-                caching_answer = sparql.query().convert()
-                self.r.set(_custom_query, json.dumps(caching_answer))
-                return caching_answer
-        else:
-            sparql = SPARQLWrapper(self.select_sparql_endpoint())
-            sparql.setQuery(_custom_query)
-            sparql.setReturnFormat(JSON)
-            sparql.setTimeout(0.1)
-            caching_answer = sparql.query().convert()
+        caching_answer = self.cache.get(_custom_query)
+        if caching_answer is not None:
+            # print "@caching layer"
             return caching_answer
 
+        return self.flight.do(_custom_query, lambda: self._fetch(_custom_query, _kind))
+
+    def _fetch(self, _custom_query, _kind):
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                with self.endpoints.request() as endpoint:
+                    caching_answer = qc.project(
+                        self.transport.sparql(endpoint, _custom_query, timeout=self.budgets.timeout(_kind)))
+                break
+            except ep.EndpointsUnavailable as e:
+                # Every circuit is open: fail right away
+                self.budgets.count(_kind, 'failures')
+                raise SparqlQueryError(_custom_query, e, attempt + 1)
+            except Exception as e:
+                timeout = ht.is_timeout(e)
+                if timeout:
+                    self.budgets.count(_kind, 'timeouts')
+                if not (timeout or ht.is_endpoint_failure(e)) or attempt >= self.retry.max_retries:
+                    self.budgets.count(_kind, 'failures')
+                    raise SparqlQueryError(_custom_query, e, attempt + 1)
+                self.budgets.count(_kind, 'retries')
+                time.sleep(self.retry.backoff(attempt))
+                attempt += 1
+
+        self.budgets.observe(_kind, time.time() - start)
+        self.cache.set(_custom_query, caching_answer)
+        return caching_answer
+
+    def iter_pages(self, _query, _kind='default', _page_size=PAGE_SIZE):
+        """
+            Yields the responses of a SELECT query page by page (LIMIT/OFFSET), stopping at the first short page.
+            A page is fetched only when the previous one has been consumed, so a huge result set never is in memory at once.
+
+        :param _query: str: query without LIMIT/OFFSET (they're appended),
+                        or fn(offset) -> the query of the page starting at offset (of at most _page_size rows)
+        :param _kind: see shoot_custom_query
+        :param _page_size: int
+        """
+        page = _query if callable(_query) else (lambda offset: '%s LIMIT %d OFFSET %d' % (_query, _page_size, offset))
+        offset = 0
+        while True:
+            response = self.shoot_custom_query(page(offset), _kind)
+            yield response
+            if len(response[u'results'][u'bindings']) < _page_size:
+                return
+            offset = offset + _page_size
+
+    def iter_bindings(self, _query, _kind='default', _page_size=PAGE_SIZE):
+        """
+            Same as iter_pages, but yields the bindings (rows) one by one.
+        """
+        for response in self.iter_pages(_query, _kind, _page_size):
+            for binding in response[u'results'][u'bindings']:
+                yield binding
+
+    def endpoint_stats(self):
+        """
+            Requests, failures, latency etc. of every endpoint (see utils/endpoint_pool.py)
+        """
+        return self.endpoints.stats()
+
+    def query_stats(self):
+        """
+            Requests, timeouts, retries, failures and the current timeout of every kind of query (see utils/query_policy.py)
+        """
+        return self.budgets.stats()
+
+    def cache_stats(self):
+        """
+            Hit/miss counters of every cache tier (see utils/query_cache.py), and of request coalescing (utils/single_flight.py)
+        """
+        stats = self.cache.stats()
+        stats['flight'] = self.flight.stats()
+        return stats
+
     def get_properties_on_resource(self, _resource_uri):
         """
 			Fetch properties that point to this resource.
@@ -187,7 +381,7 @@ class DBPedia:
             warnings.warn(
                 "The passed resource %s is not a proper URI but is in shorthand. This is strongly discouraged." % _resource_uri)
             _resource_uri = nlutils.convert_shorthand_to_uri(_resource_uri)
-        response = self.shoot_custom_query(GET_PROPERTIES_ON_RESOURCE % {'target_resource': _resource_uri})
+        response = self.shoot_custom_query(GET_PROPERTIES_ON_RESOURCE % {'target_resource': _resource_uri}, 'properties')
 
     def get_properties_of_resource(self, _resource_uri, _with_connected_resource=False, right=True):
         """
@@ -218,7 +412,7 @@ class DBPedia:
                 temp_query = GET_RIGHT_PROPERTIES_OF_RESOURCE % {'target_resource': _resource_uri}
             else:
                 temp_query = GET_LEFT_PROPERTIES_OF_RESOURCE % {'target_resource': _resource_uri}
-        response = self.shoot_custom_query(temp_query)
+        response = self.shoot_custom_query(temp_query, 'properties')
 
         try:
             if _with_connected_resource:
@@ -249,10 +443,10 @@ class DBPedia:
             _class_uri = nlutils.convert_shorthand_to_uri(_class_uri)
         # with SPARQLWrapper(self.sparql_endpoint) as sparql:
         _class_uri = '<' + _class_uri + '>'
-        response = self.shoot_custom_query(GET_ENTITIES_OF_CLASS % {'target_class': _class_uri})
+        bindings = self.iter_bindings(GET_ENTITIES_OF_CLASS % {'target_class': _class_uri}, 'lookup')
 
         try:
-            entity_list = [x[u'entity'][u'value'].encode('ascii', 'ignore') for x in response[u'results'][u'bindings']]
+            entity_list = [x[u'entity'][u'value'].encode('ascii', 'ignore') for x in bindings]
         except:
             # TODO: Find and handle exceptions appropriately
             traceback.print_exc()
@@ -271,7 +465,7 @@ class DBPedia:
                 "The passed resource %s is not a proper URI but probably a shorthand. This is strongly discouraged." % _resource_uri)
             _resource_uri = nlutils.convert_shorthand_to_uri(_resource_uri)
         _resource_uri = '<' + _resource_uri + '>'
-        response = self.shoot_custom_query(GET_TYPE_OF_RESOURCE % {'target_resource': _resource_uri})
+        response = self.shoot_custom_query(GET_TYPE_OF_RESOURCE % {'target_resource': _resource_uri}, 'lookup')
         try:
             type_list = [x[u'type'][u'value'].encode('ascii', 'ignore') for x in response[u'results'][u'bindings']]
         except:
@@ -293,23 +487,30 @@ class DBPedia:
 			NOTE: Only give it queries with one variable
 
 		"""
-        try:
-            response = self.shoot_custom_query(_sparql_query)
-        except:
-            traceback.print_exc()
-
         matcher = re.search(ASK_RE_PATTERN, _sparql_query, 0)
         values = {}
         if matcher:
+            response = self.shoot_custom_query(_sparql_query, 'answer')
             values['boolean'] = response['boolean']
             return values
-        # Now to parse the response
-        variables = [x for x in response[u'head'][u'vars']]
 
-        # NOTE: Assuming that there's only one variable
-        for index in range(0, len(variables)):
-            value = [x[variables[index]][u'value'].encode('ascii', 'ignore') for x in response[u'results'][u'bindings']]
-            values[variables[index]] = value
+        # Page through the results, unless the query asks for a slice of them itself
+        if re.search(SLICED_RE_PATTERN, _sparql_query):
+            pages = iter([self.shoot_custom_query(_sparql_query, 'answer')])
+        else:
+            pages = self.iter_pages(_sparql_query, 'answer')
+
+        # Now to parse the response
+        variables = None
+        for response in pages:
+            if variables is None:
+                variables = [x for x in response[u'head'][u'vars']]
+                for variable in variables:
+                    values[variable] = []
+
+            # NOTE: Assuming that there's only one variable
+            for variable in variables:
+                values[variable] += [x[variable][u'value'].encode('ascii', 'ignore') for x in response[u'results'][u'bindings']]
         return values
 
     def get_label(self, _resource_uri):
@@ -399,10 +600,7 @@ class DBPedia:
 
             # Preparing the query
             target_class = '<' + class_uri + '>'
-            try:
-                response = self.shoot_custom_query(GET_CLASS_PATH % {'target_class': target_class})
-            except:
-                traceback.print_exc()
+            response = self.shoot_custom_query(GET_CLASS_PATH % {'target_class': target_class}, 'lookup')
 
             # Parsing the Result
             try:
@@ -422,11 +620,8 @@ class DBPedia:
     def is_common_parent(self, _resource_uri_1, _resource_uri_2):
         specific_class_uri_1 = "<" + self.get_most_specific_class(_resource_uri_1) + ">"
         specific_class_uri_2 = "<" + self.get_most_specific_class(_resource_uri_2) + ">"
-        try:
-            response_uri_1 = self.shoot_custom_query(GET_SUPERCLASS % {'target_class': specific_class_uri_1})
-            response_uri_2 = self.shoot_custom_query(GET_SUPERCLASS % {'target_class': specific_class_uri_2})
-        except:
-            traceback.print_exc()
+        response_uri_1 = self.shoot_custom_query(GET_SUPERCLASS % {'target_class': specific_class_uri_1}, 'lookup')
+        response_uri_2 = self.shoot_custom_query(GET_SUPERCLASS % {'target_class': specific_class_uri_2}, 'lookup')
 
         # Parsing the results
         try:
@@ -449,11 +644,7 @@ class DBPedia:
 
     def get_parent(self, _resource_uri):
         specific_class_uri_1 = "<" + self.get_most_specific_class(_resource_uri) + ">"
-        try:
-            response_uri_1 = self.shoot_custom_query(GET_SUPERCLASS % {'target_class': specific_class_uri_1})
-        except:
-
-            print(traceback.print_exception())
+        response_uri_1 = self.shoot_custom_query(GET_SUPERCLASS % {'target_class': specific_class_uri_1}, 'lookup')
         try:
             results_1 = [x[u'type'][u'value'].encode('ascii', 'ignore') for x in
                          response_uri_1[u'results'][u'bindings']]
@@ -471,7 +662,7 @@ class DBPedia:
                 return "http://www.w3.org/2002/07/owl#Thing"
 
     def is_Url(self, url):
-        response = self.shoot_custom_query(CHECK_URL % {'target_resource': url})
+        response = self.shoot_custom_query(CHECK_URL % {'target_resource': url}, 'lookup')
         return response["boolean"]
 
     def get_properties(self, _uri, _right=True, _left=True, label=True):
@@ -511,7 +702,7 @@ class DBPedia:
         else:
             '''Query is to find subject '''
             temp_query = GET_SUBJECT % {'target_resource': _resource_uri, 'property': _relation}
-        response = self.shoot_custom_query(temp_query)
+        response = self.shoot_custom_query(temp_query, 'lookup')
         try:
             entity_list = [x[u'entity'][u'value'] for x in response[u'results'][u'bindings']]
             return entity_list
@@ -530,7 +721,7 @@ class DBPedia:
             else:
                 url = '<' + _uri
         query = GET_SAME_AS % {'target_resource':url}
-        response = self.shoot_custom_query(query)
+        response = self.shoot_custom_query(query, 'lookup')
         entity_list = [x[u'entity'][u'value'].encode('ascii', 'ignore') for x in response[u'results'][u'bindings']]
         if entity_list:
             return entity_list
@@ -543,46 +734,64 @@ class DBPedia:
         if _property_uri[0] != '<':
             _property_uri = '<' + _property_uri + '>'
 
-        offset = 0
-        if right:
-            query = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTY % {'target_resource':_resource_uri,
-                                                                                 'property':_property_uri,
-                                                                                 'offset' : offset}
-        else:
-            query = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY % {'target_resource': _resource_uri,
-                                                                                 'property': _property_uri,
-                                                                                 'offset': offset}
-
-        final_response = self.shoot_custom_query(query)
-
-        if len(final_response[u'results'][u'bindings']) > 99999:
-            offset_flag = True
-            while offset_flag:
-                offset = offset + 10000
-                if right:
-                    query = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTY % {
-                        'target_resource': _resource_uri,
-                        'property': _property_uri,
-                        'offset': offset}
-                else:
-                    query = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY % {
-                        'target_resource': _resource_uri,
-                        'property': _property_uri,
-                        'offset': offset}
-                response = self.shoot_custom_query(query)
-                final_response[u'results'][u'bindings'] = final_response[u'results'][u'bindings'] + response[u'results'][u'bindings']
-
-                if len(response[u'results'][u'bindings']) < 10000:
-                    offset_flag = False
-
-        right_property_list = [x[u'property1'][u'value'].encode('ascii', 'ignore') for x in
-                               final_response[u'results'][u'bindings'] if 'property1' in x.keys()]
-
-        left_property_list = [x[u'property2'][u'value'].encode('ascii', 'ignore') for x in
-                              final_response[u'results'][u'bindings'] if 'property2' in x.keys()]
+        template = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTY if right \
+            else GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTY
+        bindings = self.iter_bindings(lambda offset: template % {'target_resource': _resource_uri,
+                                                                 'property': _property_uri,
+                                                                 'limit': HOP2_PAGE_SIZE,
+                                                                 'offset': offset},
+                                      'hop2', HOP2_PAGE_SIZE)
+
+        right_property_list, left_property_list = [], []
+        for x in bindings:
+            if 'property1' in x.keys():
+                right_property_list.append(x[u'property1'][u'value'].encode('ascii', 'ignore'))
+            if 'property2' in x.keys():
+                left_property_list.append(x[u'property2'][u'value'].encode('ascii', 'ignore'))
 
         return right_property_list, left_property_list
 
+    def get_hop2_subgraph_batch(self, _resource_uri, _property_uris, right=False):
+        """
+            get_hop2_subgraph for many properties in one go: they are sent together in a VALUES block,
+                and the results are grouped by property here.
+            Pages through the results till a page comes back short.
+
+        :param _resource_uri: str: central entity
+        :param _property_uris: list of str: properties after which one needs the subgraph
+        :param right: same as get_hop2_subgraph
+        :return: dict: property uri (as passed) -> (right_property_list, left_property_list)
+        """
+        if _resource_uri[0] != '<':
+            _resource_uri = '<' + _resource_uri + '>'
+
+        # Remember which uri was passed for each property, to hand the results back under it.
+        passed = {property_key(uri): uri for uri in _property_uris}
+        properties = ' '.join(dict.fromkeys('<' + uri.replace('<', '').replace('>', '') + '>' for uri in _property_uris))
+        template = GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_RIGHT_PROPERTIES if right \
+            else GET_LEFT_RIGHT_PROPERTIES_OF_RESOURCE_WITH_LEFT_PROPERTIES
+
+        subgraphs = {uri: ([], []) for uri in _property_uris}
+        bindings = self.iter_bindings(lambda offset: template % {'target_resource': _resource_uri,
+                                                                 'properties': properties,
+                                                                 'limit': HOP2_PAGE_SIZE,
+                                                                 'offset': offset},
+                                      'hop2', HOP2_PAGE_SIZE)
+        for x in bindings:
+            uri = passed.get(property_key(x[u'property'][u'value']))
+            if uri is None:
+                # Can't tell which property it's of
+                warnings.warn("Unexpected property %r in the 2-hop expansion of %s" % (x[u'property'][u'value'],
+                                                                                      _resource_uri))
+                continue
+            right_property_list, left_property_list = subgraphs[uri]
+            if 'property1' in x.keys():
+                right_property_list.append(x[u'property1'][u'value'].encode('ascii', 'ignore'))
+            if 'property2' in x.keys():
+                left_property_list.append(x[u'property2'][u'value'].encode('ascii', 'ignore'))
+
+        return subgraphs
+
 
 if __name__ == '__main__':
     pass
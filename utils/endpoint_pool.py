@@ -0,0 +1,212 @@
+"""
+	Spreads queries over several (mirrored) SPARQL endpoints. Used by DBPedia (see utils/dbpedia_interface.py).
+
+	Selection methods:
+		round-robin:        one after the other
+		random:             uniformly at random
+		select-one:         always the first one
+		least-outstanding:  the one with the fewest requests in flight
+		latency-weighted:   at random, weighted by 1/(moving average of the latency)
+
+	Every endpoint has a circuit breaker:
+		closed:     requests flow.
+		open:       after max_failures failures in a row; no requests for cooldown seconds.
+		half open:  once the cooldown is over, a single trial request is let through.
+		            If it succeeds the circuit closes; if not, it opens again.
+	If every circuit is open, select raises EndpointsUnavailable (fail_fast),
+		or else the endpoint which comes back first is used anyway.
+	Optionally, a background thread probes every endpoint every few seconds (start_probes),
+		ejecting the ones which fail and bringing back the ones which recover.
+
+	Usage:
+		pool = EndpointPool(['http://a/sparql', 'http://b/sparql'], method='least-outstanding')
+		with pool.request() as endpoint:
+			response = transport.sparql(endpoint, query)
+		pool.stats()
+"""
+from contextlib import contextmanager
+import threading
+import warnings
+import random
+import time
+
+METHODS = ['round-robin', 'random', 'select-one', 'least-outstanding', 'latency-weighted']
+
+
+class EndpointsUnavailable(Exception):
+    """ Every endpoint's circuit is open """
+    pass
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests, self.failures = 0, 0
+        self.consecutive_failures = 0
+        self.latency = None             # exponential moving average, seconds
+        self.total_latency = 0.0
+        self.ejected_until = 0.0
+        self.ejections = 0
+
+    def healthy(self, now):
+        return self.ejected_until <= now
+
+    def admits(self, now, max_failures):
+        """ Whether a request can be sent now: circuit closed, or half open with no trial in flight """
+        if not self.healthy(now):
+            return False
+        return self.consecutive_failures < max_failures or self.outstanding == 0
+
+    def stats(self):
+        return {'requests': self.requests, 'failures': self.failures, 'outstanding': self.outstanding,
+                'latency': self.latency,
+                'mean_latency': self.total_latency / self.requests if self.requests else None,
+                'ejected': self.ejected_until > time.time(), 'ejections': self.ejections}
+
+
+class EndpointPool:
+    """
+        endpoints: list of urls
+        method: one of METHODS
+        max_failures: consecutive failures after which an endpoint is ejected
+        cooldown: seconds an ejected endpoint is left alone
+        is_failure: fn(exception) -> bool. Exceptions for which it is False (eg. a malformed query) don't count against the endpoint.
+        alpha: weight of the newest sample in the latency moving average
+        fail_fast: raise EndpointsUnavailable when no endpoint admits requests, instead of using one anyway
+    """
+
+    def __init__(self, endpoints, method='round-robin', max_failures=3, cooldown=30.0, is_failure=None, alpha=0.2,
+                 fail_fast=False):
+        if method not in METHODS:
+            warnings.warn("Selection method not understood, proceeding with 'select-one'")
+            method = 'select-one'
+
+        self.method = method
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.is_failure = is_failure if is_failure is not None else (lambda e: True)
+        self.alpha = alpha
+        self.fail_fast = fail_fast
+        self.rejected = 0
+
+        self.endpoints = [Endpoint(url) for url in endpoints]
+        self._next = 0
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def _candidates(self):
+        now = time.time()
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.admits(now, self.max_failures)]
+        if healthy:
+            return healthy
+        if self.fail_fast:
+            self.rejected += 1
+            raise EndpointsUnavailable("No SPARQL endpoint is available right now")
+        return [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+
+    def _select(self):
+        candidates = self._candidates()
+        if self.method == 'select-one':
+            return candidates[0]
+        if self.method == 'random':
+            return random.choice(candidates)
+        if self.method == 'least-outstanding':
+            return min(candidates, key=lambda endpoint: endpoint.outstanding)
+        if self.method == 'latency-weighted':
+            known = [endpoint.latency for endpoint in candidates if endpoint.latency]
+            # Endpoints not measured yet get the best latency seen, so that they're tried soon
+            default = min(known) if known else 1.0
+            weights = [1.0 / (endpoint.latency or default) for endpoint in candidates]
+            return random.choices(candidates, weights=weights)[0]
+
+        # round-robin, skipping the ejected ones
+        for _ in range(len(self.endpoints)):
+            endpoint = self.endpoints[self._next]
+            self._next = (self._next + 1) % len(self.endpoints)
+            if endpoint in candidates:
+                return endpoint
+        return candidates[0]
+
+    def select(self):
+        """ url of the endpoint to send the next request to. Raises EndpointsUnavailable (if fail_fast). """
+        with self._lock:
+            return self._select().url
+
+    @contextmanager
+    def request(self):
+        """
+            Picks an endpoint and accounts for the request made to it within the block (latency, failures).
+            Yields the url.
+        """
+        with self._lock:
+            endpoint = self._select()
+            endpoint.outstanding += 1
+        start = time.time()
+        # None: the block was left by a BaseException (GeneratorExit, KeyboardInterrupt, ..); nothing to hold against
+        #   the endpoint, but the request isn't outstanding any more either.
+        failed = None
+        try:
+            yield endpoint.url
+            failed = False
+        except Exception as e:
+            failed = self.is_failure(e)
+            raise
+        finally:
+            self._done(endpoint, time.time() - start, failed=failed)
+
+    def _done(self, endpoint, latency, failed):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed is None:
+                return
+            endpoint.requests += 1
+            endpoint.total_latency += latency
+            if failed:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.max_failures:
+                    self._eject(endpoint)
+            else:
+                endpoint.consecutive_failures = 0
+                endpoint.latency = latency if endpoint.latency is None \
+                    else self.alpha * latency + (1 - self.alpha) * endpoint.latency
+
+    def _eject(self, endpoint):
+        if endpoint.healthy(time.time()):
+            endpoint.ejections += 1
+            warnings.warn("Endpoint %s is failing. Leaving it alone for %s seconds." % (endpoint.url, self.cooldown))
+        endpoint.ejected_until = time.time() + self.cooldown
+
+    def start_probes(self, probe, interval=30.0):
+        """
+            Starts a daemon thread which calls probe(url) on every endpoint every interval seconds.
+            An endpoint whose probe raises is ejected; one whose probe returns is (re)admitted.
+        """
+        if self._prober is not None:
+            return
+
+        def _loop():
+            while True:
+                for endpoint in self.endpoints:
+                    try:
+                        probe(endpoint.url)
+                    except Exception:
+                        with self._lock:
+                            self._eject(endpoint)
+                        continue
+                    with self._lock:
+                        endpoint.ejected_until = 0.0
+                        endpoint.consecutive_failures = 0
+                time.sleep(interval)
+
+        self._prober = threading.Thread(target=_loop, name='endpoint-probes')
+        self._prober.daemon = True
+        self._prober.start()
+
+    def stats(self):
+        """ Per endpoint counters: {url: {...}}, and 'rejected': requests turned away as every circuit was open """
+        with self._lock:
+            stats = {endpoint.url: endpoint.stats() for endpoint in self.endpoints}
+        stats['rejected'] = self.rejected
+        return stats
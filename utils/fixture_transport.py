@@ -0,0 +1,189 @@
+"""
+	Record/replay of the traffic between DBPedia and its SPARQL endpoints, for benchmarking offline.
+	Calls to json APIs made through the same transport (post_json; eg. the entity linker, see server.get_entities)
+		are recorded and replayed alongside, so that a whole answer_question runs without the network.
+
+	record: queries go to the endpoints as usual; every query, its (projected) response and its latency
+		are also written to a fixture store (a sqlite file).
+	replay: no network at all. Responses are served from the fixture store, after an (optional) injected delay.
+		A query (or POST) which was never recorded raises FixtureMissing.
+
+	The mode is picked when a DBPedia is made (see DBPedia.__init__), or through the environment,
+		so that server.py, CreateSubgraph, data_creator_step1 etc. can be benchmarked untouched:
+		KRANTIKARI_DBPEDIA_MODE=record KRANTIKARI_FIXTURES=data/fixtures/lcquad.sqlite python data_creator_step1.py 0 100 lcquad
+		KRANTIKARI_DBPEDIA_MODE=replay KRANTIKARI_FIXTURES=data/fixtures/lcquad.sqlite python data_creator_step1.py 0 100 lcquad
+
+	Injected latency (replay):
+		None:           no delay
+		'recorded':     the latency seen when the query was recorded
+		a number:       that many seconds, for every query
+		fn() -> seconds: eg. lognormal(median=0.05, sigma=0.5)
+"""
+import asyncio
+import random
+import json
+import zlib
+import time
+import os
+
+try:
+    import query_cache as qc
+except ImportError:
+    from utils import query_cache as qc
+
+MODES = ['record', 'replay']
+DEFAULT_FIXTURES = 'data/fixtures/dbpedia.sqlite'
+
+
+class FixtureMissing(KeyError):
+    """ Replaying a query which was not recorded """
+    pass
+
+
+def post_key(url, data):
+    """ What stands for the query of a POST in the fixture store """
+    if not isinstance(data, str):
+        data = json.dumps(data, sort_keys=True)
+    return 'POST %s\n%s' % (url, data)
+
+
+class FixtureStore(qc.SQLiteCache):
+    """
+        query (hashed, see query_cache.cache_key) -> query text, encoded response (query_cache.encode), latency
+        POSTs are kept the same way, under post_key, with their responses as zlib compressed json.
+    """
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS fixtures (key TEXT PRIMARY KEY, query TEXT, response BLOB, latency REAL)'
+
+    def record(self, query, response, latency):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO fixtures (key, query, response, latency) VALUES (?, ?, ?, ?)',
+                               (qc.cache_key(query), query, qc.encode(qc.project(response)), latency))
+
+    def lookup(self, query):
+        """ (response, latency), or raises FixtureMissing """
+        row = self._connection().execute('SELECT response, latency FROM fixtures WHERE key = ?',
+                                         (qc.cache_key(query),)).fetchone()
+        if row is None:
+            self.misses += 1
+            raise FixtureMissing(query)
+        self.hits += 1
+        return qc.decode(row[0]), row[1]
+
+    def record_post(self, url, data, response, latency):
+        key = post_key(url, data)
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO fixtures (key, query, response, latency) VALUES (?, ?, ?, ?)',
+                               (qc.cache_key(key), key, zlib.compress(json.dumps(response).encode('utf-8')), latency))
+
+    def lookup_post(self, url, data):
+        """ (response, latency), or raises FixtureMissing """
+        key = post_key(url, data)
+        row = self._connection().execute('SELECT response, latency FROM fixtures WHERE key = ?',
+                                         (qc.cache_key(key),)).fetchone()
+        if row is None:
+            self.misses += 1
+            raise FixtureMissing(key)
+        self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode('utf-8')), row[1]
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM fixtures').fetchone()[0]
+
+
+def lognormal(median, sigma=0.5):
+    """ Latency distribution: log normal, with the given median (seconds) """
+    return lambda: random.lognormvariate(0, sigma) * median
+
+
+class RecordingTransport:
+    """
+        Wraps an http_transport.HTTPTransport, writing down every SPARQL query sent through it.
+    """
+    mode = 'record'
+
+    def __init__(self, transport, store):
+        self.transport = transport
+        self.store = store
+
+    def mount(self, prefix, pool_maxsize=None):
+        self.transport.mount(prefix, pool_maxsize)
+
+    def record(self, query, response, latency):
+        self.store.record(query, response, latency)
+
+    def sparql(self, endpoint, query, timeout=None):
+        start = time.time()
+        response = self.transport.sparql(endpoint, query, timeout=timeout)
+        self.record(query, response, time.time() - start)
+        return response
+
+    def post_json(self, url, data=None, headers=None, timeout=None):
+        start = time.time()
+        response = self.transport.post_json(url, data=data, headers=headers, timeout=timeout)
+        self.store.record_post(url, data, response, time.time() - start)
+        return response
+
+
+class ReplayTransport:
+    """
+        Stands in for an http_transport.HTTPTransport, answering SPARQL queries from a FixtureStore.
+        latency: see the top of this file
+    """
+    mode = 'replay'
+
+    def __init__(self, store, latency=None):
+        self.store = store
+        self.latency = latency
+
+    def mount(self, prefix, pool_maxsize=None):
+        pass
+
+    def _delay(self, recorded):
+        if self.latency is None:
+            return 0.0
+        if self.latency == 'recorded':
+            return recorded or 0.0
+        if callable(self.latency):
+            return self.latency()
+        return float(self.latency)
+
+    def sparql(self, endpoint, query, timeout=None):
+        response, recorded = self.store.lookup(query)
+        delay = self._delay(recorded)
+        if delay:
+            time.sleep(delay)
+        return response
+
+    async def asparql(self, endpoint, query, timeout=None):
+        response, recorded = self.store.lookup(query)
+        delay = self._delay(recorded)
+        if delay:
+            await asyncio.sleep(delay)
+        return response
+
+    def post_json(self, url, data=None, headers=None, timeout=None):
+        response, recorded = self.store.lookup_post(url, data)
+        delay = self._delay(recorded)
+        if delay:
+            time.sleep(delay)
+        return response
+
+
+def from_environment():
+    """ (mode, fixture location) asked for by KRANTIKARI_DBPEDIA_MODE and KRANTIKARI_FIXTURES """
+    return os.environ.get('KRANTIKARI_DBPEDIA_MODE') or None, os.environ.get('KRANTIKARI_FIXTURES', DEFAULT_FIXTURES)
+
+
+def wrap(transport, mode, location, latency=None):
+    """
+        The transport DBPedia should use in the given mode (None: the transport itself).
+    """
+    if mode is None:
+        return transport
+    if mode not in MODES:
+        raise ValueError("DBPedia mode should be one of %s, not %r" % (MODES, mode))
+    store = FixtureStore(location)
+    if mode == 'record':
+        return RecordingTransport(transport, store)
+    return ReplayTransport(store, latency)
@@ -3,4 +3,11 @@ class NoPathsFound(Exception): pass
 class BadParameters(Exception):
     def __init___(self,dErrorArguments):
         Exception.__init__(self,"Unexpected value of parmeter {0}".format(dErrorArguments))
-        self.dErrorArguments = dErrorArguments
\ No newline at end of file
+        self.dErrorArguments = dErrorArguments
+class SparqlQueryError(Exception):
+    """ A SPARQL query which failed for good (after retries, or because no endpoint was available). """
+    def __init__(self, query, cause, attempts=1):
+        Exception.__init__(self, "SPARQL query failed after {0} attempt(s): {1!r}".format(attempts, cause))
+        self.query = query
+        self.cause = cause
+        self.attempts = attempts
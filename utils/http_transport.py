@@ -0,0 +1,117 @@
+"""
+	Pooled HTTP for everything that talks to remote services (SPARQL endpoints, the entity linker).
+
+	A question fires thousands of small SPARQL queries. Opening a TCP connection for every one of them
+		(which is what a fresh SPARQLWrapper does) costs about as much as the query itself.
+	An HTTPTransport keeps one requests.Session, with a pool of keep-alive connections per endpoint.
+		The session is shared by all threads; urllib3's pools are thread safe.
+
+	Usage:
+		transport = http_transport.shared()
+		transport.mount('http://localhost:8890/sparql', pool_maxsize=64)      # optional, per endpoint pool size
+		response = transport.sparql('http://localhost:8890/sparql', query)     # parsed json
+		response = transport.post(url, data=data, headers=headers)             # requests.Response
+		response = transport.post_json(url, data=data, headers=headers)        # parsed json (eg. the entity linker)
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Connections kept alive per endpoint (host). Raise it if there are more threads querying a single endpoint.
+POOL_MAXSIZE = 32
+# Endpoints (hosts) for which pools are kept
+POOL_CONNECTIONS = 10
+# Queries longer than this are POSTed instead, to keep clear of the URL length limits of servers.
+MAX_GET_LENGTH = 2000
+
+SPARQL_JSON = 'application/sparql-results+json'
+
+
+class HTTPTransport:
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._mounted = {}
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def mount(self, prefix, pool_maxsize=None):
+        """
+			Gives the urls starting with prefix (eg. an endpoint) a pool of their own.
+			Mounting the same prefix again is a no op.
+		"""
+        with self._lock:
+            if prefix in self._mounted:
+                return
+            self._mounted[prefix] = pool_maxsize or self.pool_maxsize
+            self.session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=self._mounted[prefix]))
+
+    def sparql(self, endpoint, query, timeout=None):
+        """
+			Runs the query on the endpoint.
+
+		:param endpoint: str: url of the SPARQL endpoint
+		:param query: str
+		:param timeout: seconds, or a (connect, read) tuple. None waits forever.
+		:return: dict: the json response ({'head': .., 'results': {'bindings': [..]}} or {'boolean': ..} for ASK)
+		"""
+        headers = {'Accept': SPARQL_JSON}
+        if len(query) <= MAX_GET_LENGTH:
+            response = self.session.get(endpoint, params={'query': query}, headers=headers, timeout=timeout)
+        else:
+            response = self.session.post(endpoint, data={'query': query}, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def post_json(self, url, data=None, headers=None, timeout=None):
+        """
+			POSTs data to a json API (eg. the entity linker). Raises for 4xx/5xx.
+
+		:return: the parsed json response
+		"""
+        response = self.session.post(url, data=data, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+def is_endpoint_failure(exception):
+    """
+		True if the exception says something about the endpoint (unreachable, 5xx),
+			rather than about the request (eg. a malformed query).
+		A query running past its timeout budget (a read timeout) is about the query: heavy ones do, on healthy endpoints.
+	"""
+    if isinstance(exception, requests.ConnectionError):
+        # Includes ConnectTimeout: the endpoint couldn't be reached in time
+        return True
+    if isinstance(exception, requests.HTTPError):
+        return exception.response is None or exception.response.status_code >= 500
+    return False
+
+
+def is_timeout(exception):
+    return isinstance(exception, requests.Timeout)
+
+
+_shared, _shared_lock = None, threading.Lock()
+
+
+def shared():
+    """
+		The HTTPTransport of this process (made on first call).
+	"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = HTTPTransport()
+        return _shared
@@ -0,0 +1,703 @@
+"""
+	An in-memory stand-in for the SPARQL endpoint: a subset of DBpedia (eg. the 2-hop neighbourhoods of all LC-QuAD
+		entities) loaded from N-Triples into hash indices, answering the queries this project sends.
+
+	It has the interface of http_transport.HTTPTransport (mount, sparql), so DBPedia uses it in place of the network:
+		store = LocalTripleStore.from_files(['data/dbpedia/lcquad_2hop.nt.gz'])
+		dbp = DBPedia(caching=False, transport=store)
+	or, for scripts which make their own DBPedia (server.py, data_creator_step1.py ...):
+		KRANTIKARI_TRIPLES=data/dbpedia/lcquad_2hop.nt.gz python data_creator_step1.py 0 500 lcquad
+
+	Supported SPARQL (everything in utils/dbpedia_interface.py, utils/query_graph_to_sparql.py, rdf_candidates etc.):
+		SELECT [DISTINCT] vars | * | COUNT([DISTINCT] ?v) | (COUNT(..) AS ?c),  ASK,  PREFIX
+		triple patterns (with ; and , lists), 'a', prefixed names, p* and p+ paths with a bound end
+		{ } UNION { },  OPTIONAL { },  VALUES ?v { .. },  FILTER with ! && || = != isLiteral isIRI isURI isBlank bound lang str
+		literals with language tags ("..."@en); datatypes are dropped
+		LIMIT, OFFSET
+	Anything else raises UnsupportedQuery.
+
+	NOTE: as with Virtuoso, a function of an unbound variable (eg. isLiteral(?unbound)) is false instead of an error.
+
+	Turtle files need rdflib. N-Triples (optionally gzipped) are parsed here.
+"""
+from itertools import islice
+import threading
+import gzip
+import sys
+import os
+import re
+
+try:
+    import rdflib
+except ImportError:
+    rdflib = None
+
+PREFIXES = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'dct': 'http://purl.org/dc/terms/',
+    'dbo': 'http://dbpedia.org/ontology/',
+    'dbp': 'http://dbpedia.org/property/',
+    'dbr': 'http://dbpedia.org/resource/',
+}
+RDF_TYPE = PREFIXES['rdf'] + 'type'
+XSD_INTEGER = PREFIXES['xsd'] + 'integer'
+
+
+class UnsupportedQuery(ValueError):
+    pass
+
+
+class Literal(str):
+    """
+        A literal's lexical form, and its language tag (lang, '' if it has none). The datatype is dropped.
+        Literals differing only in their language tag are different literals, as in SPARQL.
+    """
+
+    def __new__(cls, value, lang=''):
+        literal = str.__new__(cls, value)
+        literal.lang = lang.lower()
+        return literal
+
+    def __eq__(self, other):
+        return str.__eq__(self, other) and getattr(other, 'lang', '') == self.lang
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return str.__hash__(self)
+
+
+class BlankNode(str):
+    pass
+
+
+class Var(str):
+    pass
+
+
+def _kind(term):
+    if isinstance(term, Literal):
+        return 'literal'
+    if isinstance(term, BlankNode):
+        return 'bnode'
+    return 'uri'
+
+
+"""
+	N-Triples
+"""
+_NT_LINE = re.compile(r'^\s*(<[^>]*>|_:\S+)\s+(<[^>]*>)\s+(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[\w-]+|\^\^<[^>]*>)?)\s*\.\s*$')
+_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|.)')
+_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def _unescape(text):
+    def _sub(match):
+        escape = match.group(1)
+        if escape[0] in 'uU':
+            return chr(int(escape[1:], 16))
+        return _ESCAPES.get(escape, escape)
+    return _ESCAPE.sub(_sub, text)
+
+
+def _nt_term(token):
+    if token[0] == '<':
+        return sys.intern(token[1:-1])
+    if token[0] == '_':
+        return BlankNode(token)
+    end = token.rindex('"')
+    return Literal(_unescape(token[1:end]), token[end + 2:] if token[end + 1:end + 2] == '@' else '')
+
+
+def parse_ntriples(lines):
+    """ Yields (s, p, o) of every triple; malformed lines are skipped """
+    for line in lines:
+        match = _NT_LINE.match(line)
+        if match:
+            yield _nt_term(match.group(1)), _nt_term(match.group(2)), _nt_term(match.group(3))
+
+
+"""
+	SPARQL (the subset described at the top)
+"""
+_TOKEN = re.compile(r'''
+     (?P<space>\s+|\#[^\n]*)
+    |(?P<iri><[^<>"{}|^`\\\s]*>)
+    |(?P<var>[?$][A-Za-z_][\w]*)
+    |(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')(?:@[A-Za-z][\w-]*|\^\^(?:<[^>]*>|[\w-]*:[\w-]*))?
+    |(?P<number>[+-]?\d+(?:\.\d+)?)
+    |(?P<op>&&|\|\||!=|<=|>=|[{}().,;*+!=<>])
+    |(?P<name>[A-Za-z_][\w-]*(?::(?:[\w\-%]|\.(?=[\w\-%]))*)?|:(?:[\w\-%]|\.(?=[\w\-%]))*)
+''', re.X)
+
+_FUNCTIONS = ['isliteral', 'isiri', 'isuri', 'isblank', 'bound', 'lang', 'str']
+
+
+def _tokenize(query):
+    tokens, position = [], 0
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if match is None:
+            raise UnsupportedQuery("Can't parse the query at: %r" % query[position:position + 30])
+        position = match.end()
+        if match.lastgroup != 'space':
+            # Strings keep their language tag/datatype suffix
+            tokens.append((match.lastgroup, match.group(0 if match.lastgroup == 'string' else match.lastgroup)))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, query):
+        self.tokens = _tokenize(query)
+        self.i = 0
+        self.prefixes = dict(PREFIXES)
+
+    def peek(self, offset=0):
+        if self.i + offset < len(self.tokens):
+            return self.tokens[self.i + offset]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.i += 1
+        return token
+
+    def keyword(self, *words):
+        """ Consumes the next token if it's one of the (case insensitive) keywords """
+        kind, value = self.peek()
+        if kind == 'name' and value.lower() in words:
+            self.i += 1
+            return value.lower()
+        return None
+
+    def expect(self, value):
+        token = self.next()
+        if token[1] != value:
+            raise UnsupportedQuery("Expected %r, found %r" % (value, token[1]))
+
+    def term(self, token=None):
+        kind, value = token or self.next()
+        if kind == 'iri':
+            return sys.intern(value[1:-1])
+        if kind == 'var':
+            return Var(value[1:])
+        if kind == 'string':
+            end = value.rindex(value[0])
+            return Literal(_unescape(value[1:end]), value[end + 2:] if value[end + 1:end + 2] == '@' else '')
+        if kind == 'number':
+            return Literal(value)
+        if kind == 'name':
+            if value == 'a':
+                return RDF_TYPE
+            if ':' in value:
+                prefix, local = value.split(':', 1)
+                if prefix.startswith('_'):
+                    return BlankNode(value)
+                if prefix not in self.prefixes:
+                    raise UnsupportedQuery("Unknown prefix %s" % prefix)
+                return sys.intern(self.prefixes[prefix] + local)
+            if value.lower() in ('true', 'false'):
+                return Literal(value.lower())
+        raise UnsupportedQuery("Unexpected %r" % value)
+
+    def parse(self):
+        while self.keyword('prefix'):
+            name = self.next()[1]
+            self.prefixes[name.rstrip(':')] = self.term()[:]
+
+        form = self.keyword('select', 'ask')
+        if form is None:
+            raise UnsupportedQuery("Only SELECT and ASK queries are supported")
+        query = {'form': form, 'distinct': False, 'projection': [], 'limit': None, 'offset': 0}
+
+        if form == 'select':
+            query['distinct'] = self.keyword('distinct', 'reduced') is not None
+            while self.peek()[1] != '{' and not (self.peek()[0] == 'name' and self.peek()[1].lower() == 'where'):
+                query['projection'].append(self.projection(len(query['projection'])))
+            if not query['projection']:
+                raise UnsupportedQuery("Nothing to select")
+
+        self.keyword('where')
+        query['where'] = self.group()
+
+        while self.peek()[0] is not None:
+            modifier = self.keyword('limit', 'offset')
+            if modifier is None:
+                raise UnsupportedQuery("Unsupported solution modifier %r" % (self.peek()[1],))
+            query[modifier] = int(self.next()[1])
+        return query
+
+    def projection(self, index):
+        kind, value = self.peek()
+        if value == '*':
+            self.next()
+            return ('*',)
+        if kind == 'var':
+            return ('var', self.term())
+        if value == '(':
+            self.next()
+            aggregate = self.aggregate(None)
+            if self.keyword('as') is None:
+                raise UnsupportedQuery("Expected AS")
+            alias = self.term()
+            self.expect(')')
+            return aggregate[:3] + (str(alias),)
+        if kind == 'name' and value.lower() == 'count':
+            # Virtuoso names an unaliased aggregate like this
+            return self.aggregate('callret-%d' % index)
+        raise UnsupportedQuery("Unsupported projection %r" % value)
+
+    def aggregate(self, name):
+        if self.keyword('count') is None:
+            raise UnsupportedQuery("COUNT is the only aggregate supported")
+        self.expect('(')
+        distinct = self.keyword('distinct') is not None
+        target = self.next()
+        self.expect(')')
+        return ('count', None if target[1] == '*' else self.term(target), distinct, name)
+
+    def group(self):
+        self.expect('{')
+        elements, triples = [], []
+
+        def flush():
+            if triples:
+                elements.append(('bgp', list(triples)))
+                del triples[:]
+
+        while True:
+            kind, value = self.peek()
+            if kind is None:
+                raise UnsupportedQuery("Unbalanced braces")
+            if value == '}':
+                self.next()
+                break
+            if value == '.':
+                self.next()
+            elif value == '{':
+                flush()
+                groups = [self.group()]
+                while self.keyword('union'):
+                    groups.append(self.group())
+                elements.append(('union', groups) if len(groups) > 1 else ('group', groups[0]))
+            elif self.keyword('optional'):
+                flush()
+                elements.append(('optional', self.group()))
+            elif self.keyword('filter'):
+                flush()
+                elements.append(('filter', self.expression()))
+            elif self.keyword('values'):
+                flush()
+                elements.append(self.values())
+            else:
+                self.triples(triples)
+        flush()
+        return elements
+
+    def triples(self, triples):
+        subject = self.term()
+        while True:
+            predicate = self.path()
+            while True:
+                triples.append((subject, predicate, self.term()))
+                if self.peek()[1] != ',':
+                    break
+                self.next()
+            if self.peek()[1] != ';':
+                return
+            self.next()
+            if self.peek()[1] in ('.', '}'):
+                return
+
+    def path(self):
+        predicate = self.term()
+        if self.peek()[1] in ('*', '+') and not isinstance(predicate, Var):
+            return (self.next()[1], predicate)
+        return predicate
+
+    def values(self):
+        variables = []
+        if self.peek()[1] == '(':
+            self.next()
+            while self.peek()[1] != ')':
+                variables.append(self.term())
+            self.next()
+            single = False
+        else:
+            variables.append(self.term())
+            single = True
+        self.expect('{')
+        rows = []
+        while self.peek()[1] != '}':
+            if single:
+                rows.append((self.value(),))
+            else:
+                self.expect('(')
+                row = []
+                while self.peek()[1] != ')':
+                    row.append(self.value())
+                self.next()
+                rows.append(tuple(row))
+        self.next()
+        return ('values', variables, rows)
+
+    def value(self):
+        if self.keyword('undef'):
+            return None
+        return self.term()
+
+    # FILTER expressions: or -> and -> unary -> comparison -> primary
+    def expression(self):
+        left = self.conjunction()
+        while self.peek()[1] == '||':
+            self.next()
+            left = ('||', left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.unary()
+        while self.peek()[1] == '&&':
+            self.next()
+            left = ('&&', left, self.unary())
+        return left
+
+    def unary(self):
+        if self.peek()[1] == '!':
+            self.next()
+            return ('!', self.unary())
+        left = self.primary()
+        if self.peek()[1] in ('=', '!='):
+            operator = self.next()[1]
+            return (operator, left, self.primary())
+        return left
+
+    def primary(self):
+        kind, value = self.peek()
+        if value == '(':
+            self.next()
+            expression = self.expression()
+            self.expect(')')
+            return expression
+        if kind == 'name' and value.lower() in _FUNCTIONS:
+            self.next()
+            self.expect('(')
+            argument = self.expression()
+            self.expect(')')
+            return ('call', value.lower(), argument)
+        return ('term', self.term())
+
+
+def _value(expression, solution):
+    """ Evaluates a FILTER expression. None stands for unbound/error. """
+    operator = expression[0]
+    if operator == 'term':
+        term = expression[1]
+        return solution.get(term) if isinstance(term, Var) else term
+    if operator == '!':
+        return not _value(expression[1], solution)
+    if operator == '&&':
+        return bool(_value(expression[1], solution)) and bool(_value(expression[2], solution))
+    if operator == '||':
+        return bool(_value(expression[1], solution)) or bool(_value(expression[2], solution))
+    if operator in ('=', '!='):
+        left, right = _value(expression[1], solution), _value(expression[2], solution)
+        if left is None or right is None:
+            return False
+        equal = str(left) == str(right) and _kind(left) == _kind(right) and \
+            getattr(left, 'lang', '') == getattr(right, 'lang', '')
+        return equal if operator == '=' else not equal
+
+    # Function calls
+    name, argument = expression[1], expression[2]
+    if name == 'bound':
+        return argument[0] == 'term' and argument[1] in solution
+    value = _value(argument, solution)
+    if value is None:
+        return None
+    if name == 'isliteral':
+        return isinstance(value, Literal)
+    if name in ('isiri', 'isuri'):
+        return _kind(value) == 'uri'
+    if name == 'isblank':
+        return isinstance(value, BlankNode)
+    if name == 'str':
+        return Literal(value)
+    if name == 'lang':
+        return Literal(value.lang) if isinstance(value, Literal) else Literal('')
+
+
+class LocalTripleStore:
+    def __init__(self):
+        self._spo = {}
+        self._ops = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def add(self, s, p, o):
+        objects = self._spo.setdefault(s, {}).setdefault(p, set())
+        if o in objects:
+            return
+        objects.add(o)
+        self._ops.setdefault(o, {}).setdefault(p, set()).add(s)
+        self._size += 1
+
+    def load(self, location):
+        """ Adds the triples of an N-Triples (.nt, .nt.gz) file, or of anything rdflib can read """
+        if location.endswith('.nt') or location.endswith('.nt.gz'):
+            opener = gzip.open if location.endswith('.gz') else open
+            with opener(location, 'rt', encoding='utf-8') as f:
+                for s, p, o in parse_ntriples(f):
+                    self.add(s, p, o)
+            return self
+
+        if rdflib is None:
+            raise ImportError("rdflib is needed to load %s. Convert it to N-Triples, or pip install rdflib." % location)
+        graph = rdflib.Graph()
+        graph.parse(location)
+        for s, p, o in graph:
+            self.add(*[Literal(str(t), t.language or '') if isinstance(t, rdflib.Literal) else
+                       BlankNode('_:' + str(t)) if isinstance(t, rdflib.BNode) else sys.intern(str(t))
+                       for t in (s, p, o)])
+        return self
+
+    @classmethod
+    def from_files(cls, locations):
+        store = cls()
+        for location in locations:
+            store.load(location)
+        return store
+
+    # As an http_transport.HTTPTransport
+    def mount(self, prefix, pool_maxsize=None):
+        pass
+
+    def sparql(self, endpoint, query, timeout=None):
+        return self.query(query)
+
+    def match(self, s, p, o):
+        """ Yields the (s, p, o) triples matching the pattern; None matches anything. """
+        if s is not None:
+            predicates = self._spo.get(s, {})
+            for predicate in (predicates if p is None else [p]):
+                objects = predicates.get(predicate, ())
+                if o is None:
+                    for obj in objects:
+                        yield s, predicate, obj
+                elif o in objects:
+                    yield s, predicate, o
+        elif o is not None:
+            predicates = self._ops.get(o, {})
+            for predicate in (predicates if p is None else [p]):
+                for subject in predicates.get(predicate, ()):
+                    yield subject, predicate, o
+        else:
+            # Neither end bound: a scan
+            for subject, predicates in self._spo.items():
+                for predicate in (predicates if p is None else [p]):
+                    for obj in predicates.get(predicate, ()):
+                        yield subject, predicate, obj
+
+    def _reachable(self, start, predicate, forward, include_start):
+        """ Nodes reachable from start following predicate (p* / p+) """
+        seen, frontier = set(), [start]
+        if include_start:
+            seen.add(start)
+            yield start
+        while frontier:
+            node = frontier.pop()
+            index = self._spo if forward else self._ops
+            for neighbour in index.get(node, {}).get(predicate, ()):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    yield neighbour
+                    frontier.append(neighbour)
+
+    def _match_triple(self, triple, solution):
+        """ Yields the solution extended by every match of the triple pattern """
+        bound = [solution.get(term, None) if isinstance(term, Var) else term for term in (triple[0], triple[2])]
+        s, o = bound
+        predicate = triple[1]
+
+        if isinstance(predicate, tuple):
+            # Path: p* or p+
+            modifier, predicate = predicate
+            if s is None and o is None:
+                raise UnsupportedQuery("Paths need a bound subject or object")
+            forward = s is not None
+            for node in self._reachable(s if forward else o, predicate, forward, modifier == '*'):
+                if forward and o is not None:
+                    # Both ends bound: just whether o is reachable
+                    if node == o:
+                        yield solution
+                        return
+                    continue
+                extended = self._extend(solution, triple[2] if forward else triple[0], node)
+                if extended is not None:
+                    yield extended
+            return
+
+        p = solution.get(predicate, None) if isinstance(predicate, Var) else predicate
+        for match in self.match(s, p, o):
+            extended = solution
+            for term, value in zip(triple, match):
+                if isinstance(term, Var):
+                    extended = self._extend(extended, term, value)
+                    if extended is None:
+                        break
+            if extended is not None:
+                yield extended
+
+    @staticmethod
+    def _extend(solution, var, value):
+        if not isinstance(var, Var):
+            return solution
+        if var in solution:
+            return solution if solution[var] == value else None
+        extended = dict(solution)
+        extended[var] = value
+        return extended
+
+    def _bgp(self, triples, solution):
+        """ Joins the triples, most selective (most bound terms) first """
+        if not triples:
+            yield solution
+            return
+
+        def bound(triple):
+            return sum(1 for term in triple if not isinstance(term, Var) or term in solution)
+        first = max(triples, key=bound)
+        rest = [triple for triple in triples if triple is not first]
+        for extended in self._match_triple(first, solution):
+            for result in self._bgp(rest, extended):
+                yield result
+
+    def _group(self, elements, solutions):
+        filters = [element[1] for element in elements if element[0] == 'filter']
+        for element in elements:
+            kind = element[0]
+            if kind == 'bgp':
+                solutions = self._join(element[1], solutions)
+            elif kind == 'group':
+                solutions = self._group(element[1], solutions)
+            elif kind == 'union':
+                solutions = self._union(element[1], list(solutions))
+            elif kind == 'optional':
+                solutions = self._optional(element[1], solutions)
+            elif kind == 'values':
+                solutions = self._values(element[1], element[2], solutions)
+        for solution in solutions:
+            if all(_value(expression, solution) for expression in filters):
+                yield solution
+
+    def _join(self, triples, solutions):
+        for solution in solutions:
+            for result in self._bgp(triples, solution):
+                yield result
+
+    def _union(self, groups, solutions):
+        for group in groups:
+            for result in self._group(group, solutions):
+                yield result
+
+    def _optional(self, group, solutions):
+        for solution in solutions:
+            extended = list(self._group(group, [solution]))
+            for result in (extended or [solution]):
+                yield result
+
+    def _values(self, variables, rows, solutions):
+        for solution in solutions:
+            for row in rows:
+                extended = solution
+                for var, value in zip(variables, row):
+                    if value is not None:
+                        extended = self._extend(extended, var, value)
+                        if extended is None:
+                            break
+                if extended is not None:
+                    yield extended
+
+    def query(self, query):
+        """
+            Runs a query, returning what a SPARQL endpoint would: {'head': .., 'results': {'bindings': ..}} / {'boolean': ..}
+        """
+        parsed = _Parser(query).parse()
+        solutions = self._group(parsed['where'], [{}])
+
+        if parsed['form'] == 'ask':
+            return {'head': {}, 'boolean': next(iter(solutions), None) is not None}
+
+        projection = parsed['projection']
+        aggregates = [column for column in projection if column[0] == 'count']
+        if aggregates:
+            solutions = list(solutions)
+            row = {}
+            for _, target, distinct, name in aggregates:
+                values = [solution.get(target) for solution in solutions] if target is not None else solutions
+                values = [value for value in values if value is not None]
+                if distinct:
+                    values = set(values) if target is not None else set(tuple(sorted(v.items())) for v in values)
+                row[name] = {'type': 'typed-literal', 'datatype': XSD_INTEGER, 'value': str(len(values))}
+            return {'head': {'vars': [column[3] for column in aggregates]}, 'results': {'bindings': [row]}}
+
+        if projection[0][0] == '*':
+            solutions = list(solutions)
+            variables = []
+            for solution in solutions:
+                variables += [var for var in solution if var not in variables]
+        else:
+            variables = [column[1] for column in projection]
+
+        rows = ([(var, solution[var]) for var in variables if var in solution] for solution in solutions)
+        if parsed['distinct']:
+            rows = _unique(rows)
+        end = parsed['offset'] + parsed['limit'] if parsed['limit'] is not None else None
+        bindings = [{str(var): _binding(value) for var, value in row} for row in islice(rows, parsed['offset'], end)]
+        return {'head': {'vars': [str(var) for var in variables]}, 'results': {'bindings': bindings}}
+
+
+def _binding(value):
+    """ A term as a SPARQL JSON results binding """
+    binding = {'type': _kind(value), 'value': str(value)}
+    if getattr(value, 'lang', ''):
+        binding['xml:lang'] = value.lang
+    return binding
+
+
+def _unique(rows):
+    seen = set()
+    for row in rows:
+        key = tuple(row)
+        if key not in seen:
+            seen.add(key)
+            yield row
+
+
+_shared, _shared_lock = {}, threading.Lock()
+
+
+def shared(locations):
+    """
+        The store of these files (a comma separated str, or a list) for this process, loaded on first call.
+    """
+    if isinstance(locations, str):
+        locations = [location for location in locations.split(',') if location]
+    key = tuple(locations)
+    with _shared_lock:
+        if key not in _shared:
+            _shared[key] = LocalTripleStore.from_files(locations)
+        return _shared[key]
+
+
+def from_environment():
+    """ The N-Triples file(s) asked for by KRANTIKARI_TRIPLES, if any """
+    return os.environ.get('KRANTIKARI_TRIPLES') or None
@@ -0,0 +1,346 @@
+"""
+	Caches for SPARQL results, used by DBPedia.shoot_custom_query (see utils/dbpedia_interface.py).
+
+	Two tiers:
+		local:  LRUCache, in process. Holds parsed results, bounded by number of entries and (serialized) bytes.
+		shared: a CacheBackend, shared by every process. Holds compact, compressed encodings (see below).
+			RedisCache: a redis server.
+			SQLiteCache: a single file (no server); safe to use from many processes at once.
+	A hit in the shared tier is promoted to the local one. Either tier can be left out.
+
+	Results are cached projected (see project): only the values of the bindings are kept,
+		not their type/datatype/language tags, which nobody reads.
+	In the shared tier,
+		keys are 'sparql:v<SCHEMA_VERSION>:<128 bit hash of the query>'
+		values are zlib compressed json of {'v': [variables], 'r': [[value of every variable (None if unbound)], ...]}
+			or {'b': true/false} for ASK queries.
+	Bump SCHEMA_VERSION whenever the encoding changes; entries in the old one are then simply never read.
+
+	Empty results (no bindings) are kept for a short while only (QueryCache's empty_ttl): an entity missing now
+		may well be there once a lagging mirror catches up. Failed queries aren't cached at all (see single_flight.py).
+
+	Every tier keeps hit/miss counters; QueryCache.stats() reports them all.
+
+	Coroutines (AsyncDBPedia) use QueryCache.aget/aset: the local tier is asked on the event loop,
+		the shared one (a round trip to redis, or the disk) from a thread of the loop's executor.
+
+	NOTE: Results handed out by the local tier are the cached objects themselves. Don't modify them.
+"""
+from collections import OrderedDict
+import threading
+import asyncio
+import hashlib
+import sqlite3
+import json
+import math
+import zlib
+import time
+import os
+
+SCHEMA_VERSION = 1
+
+
+def cache_key(query):
+    """ Key of a query in the shared tier """
+    return 'sparql:v%d:%s' % (SCHEMA_VERSION, hashlib.blake2b(query.encode('utf-8'), digest_size=16).hexdigest())
+
+
+def project(response):
+    """
+        The SPARQL json response with just the values of its bindings: {'var': {'value': ..}} instead of
+            {'var': {'type': .., 'value': .., 'datatype'/'xml:lang': ..}}. This is what gets cached.
+    """
+    if 'boolean' in response:
+        return {'boolean': response['boolean']}
+    return {'head': {'vars': response['head']['vars']},
+            'results': {'bindings': [{variable: {'value': value['value']} for variable, value in binding.items()}
+                                     for binding in response['results']['bindings']]}}
+
+
+def _pack(result):
+    if 'boolean' in result:
+        return json.dumps({'b': result['boolean']})
+    variables = result['head']['vars']
+    rows = [[binding[variable]['value'] if variable in binding else None for variable in variables]
+            for binding in result['results']['bindings']]
+    return json.dumps({'v': variables, 'r': rows}, separators=(',', ':'))
+
+
+def _unpack(packed):
+    packed = json.loads(packed)
+    if 'b' in packed:
+        return {'boolean': packed['b']}
+    variables = packed['v']
+    return {'head': {'vars': variables},
+            'results': {'bindings': [{variable: {'value': value} for variable, value in zip(variables, row)
+                                      if value is not None} for row in packed['r']]}}
+
+
+def _encode(result):
+    """ (encode(result), bytes before compression: what the local tier accounts the entry by) """
+    packed = _pack(result).encode('utf-8')
+    return zlib.compress(packed), len(packed)
+
+
+def _decode(blob):
+    """ (decode(blob), bytes before compression) """
+    packed = zlib.decompress(blob)
+    return _unpack(packed.decode('utf-8')), len(packed)
+
+
+def encode(result):
+    """ A projected result -> bytes, as kept in the shared tier """
+    return _encode(result)[0]
+
+
+def decode(blob):
+    """ Inverse of encode """
+    return _decode(blob)[0]
+
+
+def _shorter(ttl, other):
+    """ The shorter of two ttls (None: never expires) """
+    if ttl is None or other is None:
+        return other if ttl is None else ttl
+    return min(ttl, other)
+
+
+class LRUCache:
+    """
+        Thread safe LRU, bounded by the number of entries and the sum of their sizes (bytes).
+        ttl: seconds after which an entry is considered stale. None means never.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=256 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._store = OrderedDict()     # key -> (value, size, expires at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size, expires = self._store.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires is not None and expires < time.time():
+                self._bytes -= size
+                self.misses += 1
+                return None
+
+            self._store[key] = (value, size, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size, ttl=None):
+        """
+        :param size: int: bytes this entry is accounted for (eg. length of its json dump)
+        :param ttl: seconds after which this entry is stale, if sooner than self.ttl
+        """
+        if size > self.max_bytes:
+            return
+
+        ttl = _shorter(self.ttl, ttl)
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._store:
+                self._bytes -= self._store.pop(key)[1]
+            self._store[key] = (value, size, expires)
+            self._bytes += size
+
+            while len(self._store) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._store.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._store), 'bytes': self._bytes}
+
+
+class CacheBackend:
+    """
+        Interface of the shared tier: a key value store of bytes, visible to every process.
+        ttl: seconds after which an entry expires. None means never.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        """ Returns the stored bytes, or None """
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """ ttl: seconds after which this entry expires, if sooner than self.ttl """
+        self._set(key, value, _shorter(self.ttl, ttl))
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class RedisCache(CacheBackend):
+    """
+        client: redis.StrictRedis
+    """
+
+    def __init__(self, client, ttl=None):
+        CacheBackend.__init__(self, ttl)
+        self.client = client
+
+    def _get(self, key):
+        return self.client.get(key)
+
+    def _set(self, key, value, ttl):
+        self.client.set(key, value, ex=int(math.ceil(ttl)) if ttl is not None else None)
+
+
+class SQLiteCache(CacheBackend):
+    """
+        A single sqlite file. Several processes (eg. the shards of parallel_data_creation.sh) can share it:
+            the db is in WAL mode (readers don't block the writer), and writers wait up to busy_timeout for the lock.
+        Every thread gets its own connection.
+    """
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)'
+
+    def __init__(self, location, ttl=None, busy_timeout=30.0):
+        CacheBackend.__init__(self, ttl)
+        self.location = location
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+        if os.path.dirname(location):
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(self.SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.location, timeout=self.busy_timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _get(self, key):
+        row = self._connection().execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def _set(self, key, value, ttl):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)', (key, value, expires))
+
+    def purge(self):
+        """ Drops the expired entries from the file """
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?', (time.time(),))
+
+
+class QueryCache:
+    """
+        local: LRUCache or None
+        shared: CacheBackend or None
+        empty_ttl: seconds for which results without bindings are kept (in either tier). None: as long as any other.
+
+        Results passed to set should be projected (see project).
+    """
+
+    def __init__(self, local=None, shared=None, empty_ttl=None):
+        self.local = local
+        self.shared = shared
+        self.empty_ttl = empty_ttl
+
+    def _ttl(self, result):
+        """ ttl of the result, if shorter than the tiers' own """
+        if 'boolean' not in result and not result['results']['bindings']:
+            return self.empty_ttl
+        return None
+
+    def get(self, query):
+        """
+            Returns the parsed result of the query, or None if no tier has it.
+        """
+        if self.local is not None:
+            result = self.local.get(query)
+            if result is not None:
+                return result
+
+        if self.shared is not None:
+            return self._get_shared(query)
+
+        return None
+
+    def _get_shared(self, query):
+        """ The result from the shared tier (promoted to the local one), or None """
+        blob = self.shared.get(cache_key(query))
+        if not blob:
+            return None
+        result, size = _decode(blob)
+        if self.local is not None:
+            self.local.set(query, result, size, self._ttl(result))
+        return result
+
+    async def aget(self, query, executor=None):
+        """
+            get, for coroutines: the shared tier is asked in executor (default: the loop's), not on the event loop.
+        """
+        if self.local is not None:
+            result = self.local.get(query)
+            if result is not None:
+                return result
+
+        if self.shared is not None:
+            return await asyncio.get_running_loop().run_in_executor(executor, self._get_shared, query)
+
+        return None
+
+    def set(self, query, result):
+        ttl = self._ttl(result)
+        if self.shared is not None:
+            blob, size = _encode(result)
+            self.shared.set(cache_key(query), blob, ttl)
+        else:
+            # Nothing to compress for; just the size
+            size = len(_pack(result).encode('utf-8'))
+        if self.local is not None:
+            self.local.set(query, result, size, ttl)
+
+    async def aset(self, query, result, executor=None):
+        """
+            set, for coroutines: the shared tier is written to in executor (default: the loop's), not on the event loop.
+        """
+        if self.shared is None:
+            self.set(query, result)
+            return
+        await asyncio.get_running_loop().run_in_executor(executor, self.set, query, result)
+
+    def stats(self):
+        return {'local': self.local.stats() if self.local is not None else None,
+                'shared': self.shared.stats() if self.shared is not None else None}
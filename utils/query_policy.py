@@ -0,0 +1,85 @@
+"""
+	Timeouts and retries of SPARQL queries (see DBPedia.shoot_custom_query in utils/dbpedia_interface.py).
+
+	Queries come in kinds (eg. 'properties', 'hop2', 'answer'), each with a timeout budget of its own.
+		Once a kind has seen a few queries, its timeout follows their latency (as TCP does its RTO:
+		mean + 4 deviations), staying between minimum and the budget.
+		So a stuck request is given up on soon after it is clearly slower than its peers, but never later than the budget.
+
+	Failed requests (timeouts, unreachable/5xx endpoints) are retried a bounded number of times,
+		sleeping a random time (full jitter) of up to base * 2^attempt seconds in between.
+		Only unreachable/5xx endpoints count against the endpoint (its circuit breaker, utils/endpoint_pool.py); timeouts don't.
+
+	Requests, timeouts, retries and failures are counted per kind (QueryBudgets.stats).
+"""
+from collections import defaultdict
+import threading
+import random
+
+# Seconds a query of each kind may take, at most. Kinds not here get the 'default' one.
+QUERY_TIMEOUTS = {'default': 2.0, 'lookup': 2.0, 'properties': 2.0, 'answer': 10.0, 'hop2': 10.0}
+
+
+class QueryBudgets:
+    """
+        budgets: kind -> seconds (see QUERY_TIMEOUTS)
+        minimum: the adaptive timeout never goes below this
+        warmup: latencies observed (per kind) before the timeout starts to adapt
+        alpha, beta: weights of the newest sample in the moving mean and deviation of the latency
+    """
+
+    def __init__(self, budgets=None, minimum=0.5, warmup=20, alpha=0.125, beta=0.25):
+        self.budgets = dict(QUERY_TIMEOUTS if budgets is None else budgets)
+        self.minimum = minimum
+        self.warmup = warmup
+        self.alpha, self.beta = alpha, beta
+
+        self._lock = threading.Lock()
+        self._latency = {}      # kind -> [mean, deviation, samples]
+        self._counts = defaultdict(lambda: {'requests': 0, 'timeouts': 0, 'retries': 0, 'failures': 0})
+
+    def budget(self, kind):
+        return self.budgets.get(kind, self.budgets['default'])
+
+    def timeout(self, kind):
+        budget = self.budget(kind)
+        latency = self._latency.get(kind)
+        if latency is None or latency[2] < self.warmup:
+            return budget
+        return min(budget, max(self.minimum, latency[0] + 4 * latency[1]))
+
+    def observe(self, kind, latency):
+        """ A query of this kind succeeded, and took latency seconds. """
+        with self._lock:
+            self._counts[kind]['requests'] += 1
+            if kind not in self._latency:
+                self._latency[kind] = [latency, latency / 2.0, 1]
+                return
+            mean, deviation, samples = self._latency[kind]
+            deviation = (1 - self.beta) * deviation + self.beta * abs(latency - mean)
+            mean = (1 - self.alpha) * mean + self.alpha * latency
+            self._latency[kind] = [mean, deviation, samples + 1]
+
+    def count(self, kind, event):
+        """ event: 'timeouts', 'retries' or 'failures' """
+        with self._lock:
+            self._counts[kind][event] += 1
+
+    def stats(self):
+        with self._lock:
+            return {kind: dict(counts, timeout=self.timeout(kind)) for kind, counts in self._counts.items()}
+
+
+class RetryPolicy:
+    """
+        max_retries: retries after the first attempt
+        base, cap: the n-th retry waits uniformly in [0, min(cap, base * 2^n)] seconds
+    """
+
+    def __init__(self, max_retries=2, base=0.05, cap=1.0):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
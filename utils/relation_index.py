@@ -0,0 +1,133 @@
+'''
+    Label, token ids and unit mean embedding of every known relation (the keys of relations.pickle),
+        computed once at data creation (data_creator_step2.py) rather than on every request.
+
+    Used by CreateSubgraph (to rank candidate predicates) and server.py (to vocabularize paths).
+        Relations missing from the index are handled as before (parsed, tokenized and embedded on the fly).
+
+    On disk, a directory of numpy arrays, memory mapped when loaded:
+        meta.json       {'embedding': .., 'relations': [uri, ..], 'labels': [label, ..]}
+        token_ids.npy   token ids (ei.vocabularize) of all the labels, one after the other
+        offsets.npy     relation i's token ids are token_ids[offsets[i]:offsets[i + 1]]
+        vectors.npy     (n, d) mean embedding of every label (with the given embedding), normalised
+        scored.npy      False where the label is blank or embeds to a zero vector (its row is then zeros)
+
+    Usage:
+        index = RelationIndex('data/data/common/relation_index')
+        index.label(uri), index.token_ids(uri), index.vector(uri)
+        vocabularize_relation(uri, dbp, index)     # falls back to dbp for relations not in the index
+'''
+import json
+import os
+
+import numpy as np
+
+try:
+    import natural_language_utilities as nlutils
+except ImportError:
+    from utils import natural_language_utilities as nlutils
+
+try:
+    import embeddings_interface as ei
+except ImportError:
+    from utils import embeddings_interface as ei
+
+
+def _uri(relation):
+    relation = relation.decode('utf-8') if isinstance(relation, bytes) else relation
+    return relation.replace('<', '').replace('>', '')
+
+
+def label_vector(label, embedding):
+    """
+        Unit vector of the mean embedding of label, or None if it is blank/a zero vector.
+        (as CreateSubgraph.similar_predicates scores predicates)
+    """
+    v = np.mean(ei.vectorize(nlutils.tokenize(label), _embedding=embedding).astype(np.float64), axis=0)
+    if np.sum(v) == 0.0 or label.strip() == "":
+        return None
+    return v / np.linalg.norm(v)
+
+
+def vocabularize_relation(relation, dbp, index=None):
+    """
+        Token ids (list) of the relation's label: from the index if it's there, else labelled (dbp) and tokenized live.
+        Used by server.py and QuestionAnswering.answer_many alike.
+    """
+    if index is not None and relation in index:
+        return index.token_ids(relation).tolist()
+    return ei.vocabularize(nlutils.tokenize(dbp.get_label(relation))).tolist()
+
+
+class RelationIndex:
+    def __init__(self, location):
+        self.location = location
+        meta = json.load(open(os.path.join(location, 'meta.json')))
+        self.embedding = meta['embedding']
+        self.relations = meta['relations']
+        self.labels = meta['labels']
+        self.rows = {uri: row for row, uri in enumerate(self.relations)}
+
+        self._token_ids = np.load(os.path.join(location, 'token_ids.npy'), mmap_mode='r')
+        self._offsets = np.load(os.path.join(location, 'offsets.npy'), mmap_mode='r')
+        self._vectors = np.load(os.path.join(location, 'vectors.npy'), mmap_mode='r')
+        self._scored = np.load(os.path.join(location, 'scored.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.relations)
+
+    def __contains__(self, relation):
+        return _uri(relation) in self.rows
+
+    def row(self, relation):
+        """ Row of the relation in the index, or None """
+        return self.rows.get(_uri(relation))
+
+    def label(self, relation):
+        return self.labels[self.rows[_uri(relation)]]
+
+    def token_ids(self, relation):
+        row = self.rows[_uri(relation)]
+        return np.array(self._token_ids[self._offsets[row]:self._offsets[row + 1]])
+
+    def vector(self, relation):
+        """ The unit label vector (with self.embedding), or None if the label has none """
+        row = self.rows[_uri(relation)]
+        return np.array(self._vectors[row]) if self._scored[row] else None
+
+
+def build(relations, location, dbp, embedding='ulmfit'):
+    """
+        Writes the index of the given relations to the directory location.
+
+    :param relations: iterable of relation uris (eg. the relations.pickle dict)
+    :param dbp: utils.dbpedia_interface.DBPedia, to label the relations with
+    :param embedding: the embedding the vectors are computed with (the one CreateSubgraph.EMBEDDING uses)
+    :return: RelationIndex
+    """
+    uris = list(dict.fromkeys(_uri(r) for r in relations))
+    labels, token_ids, offsets, vectors, scored = [], [], [0], [], []
+    for uri in uris:
+        label = dbp.get_label(uri)
+        ids = np.asarray(ei.vocabularize(nlutils.tokenize(label)), dtype=np.int64)
+        vector = label_vector(label, embedding)
+
+        labels.append(label)
+        token_ids.append(ids)
+        offsets.append(offsets[-1] + len(ids))
+        scored.append(vector is not None)
+        vectors.append(vector)
+
+    dim = next((len(v) for v in vectors if v is not None), 1)
+    vectors = np.stack([v if v is not None else np.zeros(dim) for v in vectors]) if vectors else np.zeros((0, dim))
+
+    nlutils.create_dir(location)
+    np.save(os.path.join(location, 'token_ids.npy'),
+            np.concatenate(token_ids) if token_ids else np.zeros(0, dtype=np.int64))
+    np.save(os.path.join(location, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(location, 'vectors.npy'), vectors)
+    np.save(os.path.join(location, 'scored.npy'), np.asarray(scored, dtype=bool))
+    # Last, so that a half written index doesn't load
+    json.dump({'embedding': embedding, 'relations': uris, 'labels': labels},
+              open(os.path.join(location, 'meta.json'), 'w+'))
+    return RelationIndex(location)
@@ -0,0 +1,147 @@
+"""
+	Request coalescing for DBPedia.shoot_custom_query (see utils/dbpedia_interface.py).
+
+	The cache is filled only once a query returns. Concurrent questions about the same (popular) entity
+		fire the same queries at the same time, and all of them miss.
+	With single flight, the first caller of a query runs it, and everyone asking for the same query meanwhile
+		waits for (and gets) that result.
+
+	Failures are remembered for error_ttl seconds: callers within that window get the same exception
+		without hitting the endpoint again.
+
+	SingleFlight is for threads; AsyncSingleFlight for coroutines (AsyncDBPedia).
+
+	Usage:
+		flight = SingleFlight(error_ttl=5.0)
+		result = flight.do(query, lambda: fetch(query))
+"""
+from concurrent.futures import Future
+import threading
+import asyncio
+import time
+
+
+class _RecentErrors:
+    """ key -> exception, for error_ttl seconds """
+
+    # Expired entries are dropped whenever there are more than these many
+    PRUNE_AT = 1000
+
+    def __init__(self, error_ttl):
+        self.error_ttl = error_ttl
+        self._errors = {}
+        self.errors_served = 0
+
+    def check(self, key):
+        """ Raises the exception recorded against the key, if still fresh. Call under the lock. """
+        if not self.error_ttl:
+            return
+        error = self._errors.get(key)
+        if error is None:
+            return
+        if error[1] < time.time():
+            del self._errors[key]
+            return
+        self.errors_served += 1
+        raise error[0]
+
+    def record(self, key, exception):
+        if not self.error_ttl:
+            return
+        now = time.time()
+        if len(self._errors) >= self.PRUNE_AT:
+            self._errors = {k: v for k, v in self._errors.items() if v[1] >= now}
+        self._errors[key] = (exception, now + self.error_ttl)
+
+
+class SingleFlight:
+    """
+        error_ttl: seconds for which a failure is handed out to the callers of the same key. 0/None to not remember them.
+    """
+
+    def __init__(self, error_ttl=5.0):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._recent_errors = _RecentErrors(error_ttl)
+
+        self.calls, self.shared = 0, 0
+
+    def do(self, key, fn):
+        """
+            Returns fn(), unless a call for the same key is already running, in which case its result is returned.
+        """
+        with self._lock:
+            self._recent_errors.check(key)
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                if isinstance(e, Exception):
+                    self._recent_errors.record(key, e)
+                del self._calls[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._calls[key]
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'errors_served': self._recent_errors.errors_served}
+
+
+class AsyncSingleFlight:
+    """
+        SingleFlight for coroutines. All callers have to be on the same event loop.
+    """
+
+    def __init__(self, error_ttl=5.0):
+        self._calls = {}
+        self._recent_errors = _RecentErrors(error_ttl)
+
+        self.calls, self.shared = 0, 0
+
+    async def do(self, key, coroutine_fn):
+        """
+            Returns await coroutine_fn(), unless a call for the same key is already running, in which case its result is returned.
+        """
+        self._recent_errors.check(key)
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            # Shielded: a caller giving up shouldn't cancel the call for everyone else.
+            return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self.calls += 1
+        try:
+            result = await coroutine_fn()
+        except BaseException as e:
+            del self._calls[key]
+            if isinstance(e, Exception):
+                self._recent_errors.record(key, e)
+                future.set_exception(e)
+                # Nobody might be waiting; don't let asyncio complain about an unretrieved exception.
+                future.exception()
+            else:
+                future.cancel()
+            raise
+
+        del self._calls[key]
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'errors_served': self._recent_errors.errors_served}